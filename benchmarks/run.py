@@ -0,0 +1,426 @@
+"""
+Throughput and latency of event handlers and rpc calls.
+
+Every case starts a service, sends it messages and measures the time from
+sending a message to its handler being done with it, or to the rpc reply.
+Runs on the in-memory broker unless ``--backend amqp`` is given.
+
+    $ python benchmarks/run.py --output results.json
+    $ python benchmarks/run.py --compare results.json
+"""
+import asyncio
+import itertools
+import json
+import platform
+import sys
+import time
+
+from contextlib import asynccontextmanager
+from typing import Annotated, Any, Callable, Dict, List, Optional
+
+import click
+
+from aio_pika import ExchangeType, Message
+from pydantic import BaseModel
+
+import uservice
+
+from uservice import Depends, RpcProxy, Service
+from uservice.bench import start_service, stop_service, summarize
+from uservice.contexts import ServiceContext
+from uservice.memory import reset_broker
+from uservice.settings import Settings
+from uservice.transport import connect
+
+
+SERVICE_NAME = 'bench'
+EXCHANGE_NAME = 'bench'
+ROUTING_KEY = 'bench.order'
+# Number of items in the order of each payload size.
+PAYLOAD_SIZES = {
+    'small': 1,
+    'medium': 20,
+    'large': 200,
+}
+SCENARIOS = ('event', 'event_pydantic', 'event_dependencies', 'rpc')
+
+
+class Item(BaseModel):
+    sku: str
+    quantity: int
+    price: float
+    tags: List[str]
+
+
+class Order(BaseModel):
+    id: int
+    customer: str
+    items: List[Item]
+
+
+def make_order(id: int, size: str) -> Dict[str, Any]:
+    return {
+        'id': id,
+        'customer': f'customer-{id}',
+        'items': [
+            {
+                'sku': f'sku-{idx}',
+                'quantity': idx,
+                'price': idx * 1.5,
+                'tags': ['a', 'b', 'c'],
+            }
+            for idx in range(PAYLOAD_SIZES[size])
+        ],
+    }
+
+
+class Recorder:
+    """
+    Latencies of the messages sent, by id.
+    """
+
+    def __init__(self):
+        self.sent_at: Dict[int, float] = {}
+        self.latencies: List[float] = []
+        self.expected = 0
+        self.done = asyncio.Event()
+
+    def expect(self, count: int) -> None:
+        self.sent_at.clear()
+        self.latencies = []
+        self.expected = count
+        self.done.clear()
+
+    def sent(self, id: int) -> None:
+        self.sent_at[id] = time.perf_counter()
+
+    def handled(self, id: int) -> None:
+        self.latencies.append(time.perf_counter() - self.sent_at.pop(id))
+        if len(self.latencies) == self.expected:
+            self.done.set()
+
+
+def add_event_handler(
+        service: Service,
+        scenario: str,
+        recorder: Recorder,
+        concurrency: int,
+) -> None:
+    handler = service.event_handler(
+        EXCHANGE_NAME,
+        ROUTING_KEY,
+        max_concurrency=concurrency,
+    )
+
+    if scenario == 'event':
+        @handler
+        async def handle(payload: dict):
+            recorder.handled(payload['id'])
+
+    elif scenario == 'event_pydantic':
+        @handler
+        async def handle(payload: Order):
+            recorder.handled(payload.id)
+
+    elif scenario == 'event_dependencies':
+        def get_settings(context):
+            return context.settings
+
+        async def get_session():
+            session = {}
+            yield session
+            session.clear()
+
+        async def get_repository(
+                session: Annotated[dict, Depends(get_session)],
+                settings: Annotated[Settings, Depends(get_settings)],
+        ):
+            return (session, settings)
+
+        async def get_customers(
+                repository: Annotated[tuple, Depends(get_repository)],
+                session: Annotated[dict, Depends(get_session)],
+        ):
+            return repository
+
+        async def get_orders(
+                repository: Annotated[tuple, Depends(get_repository)],
+        ):
+            return repository
+
+        @handler
+        async def handle(
+                payload: Order,
+                customers: Annotated[tuple, Depends(get_customers)],
+                orders: Annotated[tuple, Depends(get_orders)],
+        ):
+            recorder.handled(payload.id)
+
+
+async def bench_event(
+        settings: Settings,
+        scenario: str,
+        size: str,
+        concurrency: int,
+        messages: int,
+        warmup: int,
+) -> Dict[str, Any]:
+    recorder = Recorder()
+    service = Service(name=SERVICE_NAME, settings=settings)
+    add_event_handler(service, scenario, recorder, concurrency)
+    task = await start_service(service)
+
+    ids = itertools.count()
+    connection = await connect(settings)
+    async with connection:
+        channel = await connection.channel()
+        exchange = await channel.declare_exchange(
+            EXCHANGE_NAME,
+            ExchangeType.TOPIC,
+            durable=True,
+        )
+
+        async def send(count: int) -> float:
+            if not count:
+                return 0.0
+
+            bodies = [
+                (id, json.dumps(make_order(id, size)).encode())
+                for id in itertools.islice(ids, count)
+            ]
+            recorder.expect(count)
+            started_at = time.perf_counter()
+            for id, body in bodies:
+                recorder.sent(id)
+                await exchange.publish(
+                    Message(body, content_type='application/json'),
+                    ROUTING_KEY,
+                )
+
+            await recorder.done.wait()
+            return time.perf_counter() - started_at
+
+        await send(warmup)
+        elapsed = await send(messages)
+
+    await stop_service(service, task)
+    return summarize(recorder.latencies, elapsed)
+
+
+async def bench_rpc(
+        settings: Settings,
+        scenario: str,
+        size: str,
+        concurrency: int,
+        messages: int,
+        warmup: int,
+) -> Dict[str, Any]:
+    service = Service(name=SERVICE_NAME, settings=settings)
+
+    @service.rpc(max_concurrency=concurrency)
+    async def echo(order: dict):
+        return order
+
+    task = await start_service(service)
+    context = ServiceContext(name=f'{SERVICE_NAME}-client', settings=settings)
+    connection = await connect(settings)
+    async with connection:
+        proxy_dependency = RpcProxy(target_service=SERVICE_NAME)
+        async with asynccontextmanager(proxy_dependency)(connection, context) as proxy:
+            async def call(count: int):
+                # Every caller waits for its reply before the next call.
+                latencies = []
+                for _idx in range(count):
+                    started_at = time.perf_counter()
+                    await proxy.echo(order=order)
+                    latencies.append(time.perf_counter() - started_at)
+
+                return latencies
+
+            async def send(count: int):
+                started_at = time.perf_counter()
+                results = await asyncio.gather(*(
+                    call(count // concurrency) for _idx in range(concurrency)
+                ))
+                elapsed = time.perf_counter() - started_at
+                return list(itertools.chain.from_iterable(results)), elapsed
+
+            order = make_order(0, size)
+            await send(warmup)
+            latencies, elapsed = await send(messages)
+
+    await stop_service(service, task)
+    return summarize(latencies, elapsed)
+
+
+BENCHMARKS: Dict[str, Callable] = {
+    'event': bench_event,
+    'event_pydantic': bench_event,
+    'event_dependencies': bench_event,
+    'rpc': bench_rpc,
+}
+
+
+async def run_benchmarks(
+        settings: Settings,
+        scenarios: List[str],
+        sizes: List[str],
+        concurrencies: List[int],
+        messages: int,
+        warmup: int,
+) -> List[Dict[str, Any]]:
+    results = []
+    for scenario, size, concurrency in itertools.product(scenarios, sizes, concurrencies):
+        reset_broker()
+        result = await BENCHMARKS[scenario](
+            settings,
+            scenario,
+            size,
+            concurrency,
+            messages,
+            warmup,
+        )
+        result = {
+            'scenario': scenario,
+            'payload_size': size,
+            'concurrency': concurrency,
+            **result,
+        }
+        click.echo(
+            f"{scenario:<20} {size:<7} {concurrency:>5} "
+            f"{result['messages_per_second']:>10.1f} msg/s "
+            f"p50 {result['p50_ms']:>8.3f} ms p99 {result['p99_ms']:>8.3f} ms",
+            err=True,
+        )
+        results.append(result)
+
+    return results
+
+
+def result_key(result: Dict[str, Any]) -> tuple:
+    return (result['scenario'], result['payload_size'], result['concurrency'])
+
+
+def compare(
+        baseline: Dict[str, Any],
+        results: List[Dict[str, Any]],
+        max_regression: float,
+) -> bool:
+    """
+    Print the change from the baseline and return whether the throughput
+    of any case dropped by more than ``max_regression``.
+    """
+    previous = {result_key(result): result for result in baseline['results']}
+    regressed = False
+    click.echo(f"Compared to uservice {baseline['uservice']}:", err=True)
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+
+        throughput = result['messages_per_second'] / before['messages_per_second'] - 1
+        p99 = result['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0.0
+        flag = ''
+        if throughput < -max_regression:
+            regressed = True
+            flag = ' REGRESSED'
+
+        scenario, size, concurrency = result_key(result)
+        click.echo(
+            f"{scenario:<20} {size:<7} {concurrency:>5} "
+            f"throughput {throughput:>+7.1%} p99 {p99:>+7.1%}{flag}",
+            err=True,
+        )
+
+    return regressed
+
+
+@click.command()
+@click.option(
+    "--scenario",
+    "scenarios",
+    multiple=True,
+    type=click.Choice(SCENARIOS),
+    help="Scenarios to run, all by default.",
+)
+@click.option(
+    "--size",
+    "sizes",
+    multiple=True,
+    type=click.Choice(list(PAYLOAD_SIZES)),
+    help="Payload sizes to run, all by default.",
+)
+@click.option(
+    "--concurrency",
+    "concurrencies",
+    multiple=True,
+    type=int,
+    help="Messages handled at once, 1, 10 and 100 by default.",
+)
+@click.option("--messages", default=2000, show_default=True, help="Messages per case.")
+@click.option("--warmup", default=200, show_default=True, help="Messages sent before measuring.")
+@click.option(
+    "--backend",
+    default="memory",
+    type=click.Choice(["memory", "amqp"]),
+    show_default=True,
+    help="Broker to run on, amqp uses the AMQP__URL setting.",
+)
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the results as json.")
+@click.option(
+    "--compare",
+    "baseline_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Results of an earlier run to compare with.",
+)
+@click.option(
+    "--max-regression",
+    default=0.1,
+    show_default=True,
+    help="Exit with 1 if throughput dropped more than this fraction from --compare.",
+)
+def main(
+        scenarios,
+        sizes,
+        concurrencies,
+        messages: int,
+        warmup: int,
+        backend: str,
+        output: Optional[str],
+        baseline_path: Optional[str],
+        max_regression: float,
+):
+    settings = Settings(communication_backend=backend)
+    results = asyncio.run(run_benchmarks(
+        settings,
+        list(scenarios or SCENARIOS),
+        list(sizes or PAYLOAD_SIZES),
+        list(concurrencies or (1, 10, 100)),
+        messages,
+        warmup,
+    ))
+    report = {
+        'uservice': uservice.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': backend,
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        click.echo(json.dumps(report, indent=2))
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+        if compare(baseline, results, max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
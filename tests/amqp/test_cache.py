@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+
+from unittest.mock import patch
+
+from uservice.amqp.cache import MISSING, RpcCache, SingleFlight
+
+
+def test_cache_expires_entries():
+    cache = RpcCache(target_service='config', ttls={'get': 10})
+    key = cache.key('get', {'name': 'a'})
+
+    with patch('uservice.amqp.cache.time.monotonic', return_value=100):
+        cache.set(key, {'value': 1}, cache.generation)
+        assert cache.get(key) == {'value': 1}
+
+    with patch('uservice.amqp.cache.time.monotonic', return_value=110):
+        assert cache.get(key) is MISSING
+
+    assert not cache.entries
+
+
+def test_cache_evicts_least_recently_used():
+    cache = RpcCache(target_service='config', ttls={'get': 10}, maxsize=2)
+    keys = [cache.key('get', {'name': name}) for name in 'abc']
+
+    cache.set(keys[0], 0, cache.generation)
+    cache.set(keys[1], 1, cache.generation)
+    cache.get(keys[0])
+    cache.set(keys[2], 2, cache.generation)
+
+    assert list(cache.entries) == [keys[0], keys[2]]
+
+
+def test_cache_key_is_independent_of_argument_order():
+    cache = RpcCache(target_service='config', ttls={'get': 10})
+
+    assert cache.key('get', {'a': 1, 'b': [1, 2]}) == cache.key('get', {'b': [1, 2], 'a': 1})
+    assert cache.key('get', {'a': 1}) != cache.key('get', {'a': '1'})
+
+
+def test_cache_invalidate():
+    cache = RpcCache(target_service='config', ttls={'get': 10, 'list': 10})
+    for method, name in [('get', 'a'), ('get', 'b'), ('list', 'a')]:
+        cache.set(cache.key(method, {'name': name}), name, cache.generation)
+
+    cache.invalidate('get', {'name': 'a'})
+    assert len(cache.entries) == 2
+    cache.invalidate('get')
+    assert list(cache.entries) == [cache.key('list', {'name': 'a'})]
+    cache.invalidate()
+    assert not cache.entries
+
+
+def test_cache_ignores_results_of_calls_made_before_invalidating():
+    cache = RpcCache(target_service='config', ttls={'get': 10})
+    key = cache.key('get', {})
+    generation = cache.generation
+
+    cache.invalidate('get')
+    cache.set(key, 'stale', generation)
+
+    assert cache.get(key) is MISSING
+
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancelled_caller():
+    single_flight = SingleFlight(target_service='config', methods={'get'})
+    requests = []
+
+    async def request():
+        requests.append(1)
+        await asyncio.sleep(0.01)
+        return {'value': 1}
+
+    first = asyncio.ensure_future(single_flight.call('get', {'name': 'a'}, request))
+    second = asyncio.ensure_future(single_flight.call('get', {'name': 'a'}, request))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == ({'value': 1}, True)
+    assert len(requests) == 1
+    assert not single_flight.calls
+    assert single_flight.shared('get')
+    assert not single_flight.shared('set')
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_failures():
+    single_flight = SingleFlight(target_service='config')
+
+    async def request():
+        await asyncio.sleep(0.01)
+        raise ValueError()
+
+    results = await asyncio.gather(
+        single_flight.call('get', {}, request),
+        single_flight.call('get', {}, request),
+        return_exceptions=True,
+    )
+
+    assert [type(result) for result in results] == [ValueError, ValueError]
@@ -1,15 +1,17 @@
 import asyncio
 import pytest
+import pytest_asyncio
 import json
 
 from contextlib import asynccontextmanager
 from contextlib import nullcontext as does_not_raise
-from typing import Any
+from typing import Any, List
 
 from aio_pika import ExchangeType, Message
 from pydantic import BaseModel, ValidationError
 
-from uservice.amqp.events import AmqpEventHandler, AmqpEventPublisher
+from uservice.amqp.events import AmqpEventHandler, AmqpEventPublisher, Publisher
+from uservice.codecs import get_codec
 from uservice.contexts import ServiceContext
 
 
@@ -136,9 +138,412 @@ async def test_event_publisher(
     assert mock.await_count == count
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize('batch_window', [None, 0.01])
+async def test_event_publisher_batch(
+        mock,
+        connection,
+        settings,
+        event_handler,
+        exchange_name,
+        routing_key,
+        batch_window,
+):
+    context = ServiceContext(
+        name=exchange_name,
+        settings=settings,
+    )
+    event_handler.dependant.call = mock
+    event_handler.payload_type = Payload
+    event_publisher = AmqpEventPublisher(
+        publish_model=Payload,
+        batch_window=batch_window,
+    )
+    cm = asynccontextmanager(event_publisher)(connection, context)
+    async with cm as publish:
+        await publish.publish_many(
+            (routing_key, {'foo': foo}) for foo in range(5)
+        )
+        await publish(routing_key, {'foo': 5})
+
+    await asyncio.sleep(0.1)
+    assert mock.await_count == 6
+
+
+class BlockingPool:
+    """
+    A channel pool whose channels are only handed out once released, and
+    that fails publishes when asked to.
+    """
+
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.published = []
+        self.error = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        await self.released.wait()
+        yield self
+
+    async def get_exchange(self, name):
+        return self
+
+    async def publish(self, message, routing_key):
+        if self.error is not None:
+            raise self.error
+
+        self.published.append(routing_key)
+
+
+def blocking_publisher(pool):
+    return Publisher(
+        pool=pool,
+        exchange_name='test_publisher',
+        codec=get_codec('json'),
+        batch_window=0.001,
+        max_batch_size=2,
+    )
+
+
+@pytest.mark.asyncio
+async def test_event_publisher_discard_cancels_flushes():
+    pool = BlockingPool()
+    publisher = blocking_publisher(pool)
+    await publisher('event.a', {'foo': 1})
+    await asyncio.sleep(0.01)
+    [flush] = publisher.flushes
+    await publisher('event.b', {'foo': 2})
+
+    await publisher.discard()
+    pool.released.set()
+    await asyncio.sleep(0.01)
+
+    assert flush.cancelled()
+    assert publisher.flushes == []
+    assert pool.published == []
+
+
+@pytest.mark.asyncio
+async def test_event_publisher_close_waits_for_every_flush():
+    pool = BlockingPool()
+    pool.error = RuntimeError('Not confirmed')
+    publisher = blocking_publisher(pool)
+    await publisher('event.a', {'foo': 1})
+    await asyncio.sleep(0.01)
+    [flush] = publisher.flushes
+    await publisher('event.b', {'foo': 2})
+
+    pool.released.set()
+    with pytest.raises(RuntimeError):
+        await publisher.close()
+
+    assert flush.done()
+    assert publisher.flushes == []
+    assert publisher.pending == []
+
+
 @pytest.mark.asyncio
 async def test_event_handler_stop(
         event_handler,
 ):
     await event_handler.stop()
     assert event_handler.channel.is_closed
+
+
+async def publish_payloads(channel, exchange_name, routing_key, payloads):
+    exchange = await channel.get_exchange(exchange_name)
+    for payload in payloads:
+        await exchange.publish(Message(json.dumps(payload).encode()), routing_key)
+
+
+@pytest_asyncio.fixture
+async def start_handler(connection, service_name, settings, exchange_name):
+    """
+    Set up an event handler on its own routing key, started unless
+    ``start`` is False. Handlers still open are stopped after the test.
+    """
+    handlers = []
+
+    async def start(call, routing_key, *, start=True, **kwargs):
+        event_handler = AmqpEventHandler(
+            context=ServiceContext(name=service_name, settings=settings),
+            call=call,
+            exchange_name=exchange_name,
+            routing_key=routing_key,
+            **kwargs,
+        )
+        await event_handler.setup(connection)
+        handlers.append(event_handler)
+        if start:
+            await event_handler.start()
+
+        return event_handler
+
+    yield start
+
+    for event_handler in handlers:
+        if not event_handler.channel.is_closed:
+            await event_handler.stop()
+
+
+@pytest.mark.asyncio
+async def test_event_handler_max_concurrency(channel, exchange_name, start_handler):
+    running = []
+    peak = []
+
+    async def slow_handle(payload):
+        running.append(payload)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(payload)
+
+    event_handler = await start_handler(slow_handle, 'test_concurrency', max_concurrency=2)
+    await publish_payloads(
+        channel, exchange_name, 'test_concurrency', [{'foo': foo} for foo in range(6)],
+    )
+    await asyncio.sleep(0.5)
+    await event_handler.stop()
+
+    assert len(peak) == 6
+    assert max(peak) == 2
+
+
+@pytest.mark.asyncio
+async def test_event_handler_settles_failed_messages(channel, exchange_name, start_handler):
+    calls = []
+
+    async def failing_handle(payload):
+        calls.append(payload)
+        raise RuntimeError('Handler failed')
+
+    event_handler = await start_handler(failing_handle, 'test_failure', max_concurrency=2)
+    await publish_payloads(
+        channel, exchange_name, 'test_failure', [{'foo': foo} for foo in range(10)],
+    )
+    await asyncio.sleep(0.1)
+
+    # Failed messages do not hold on to a prefetch slot, they are retried
+    # once and then dropped.
+    assert sorted(calls, key=lambda payload: payload['foo']) == [
+        {'foo': foo} for foo in range(10) for _ in range(2)
+    ]
+    assert await event_handler.get_queue_depth() == 0
+    assert event_handler.in_flight == 0
+    await event_handler.stop()
+
+
+@pytest.mark.asyncio
+async def test_event_handler_retries_failed_message(channel, exchange_name, start_handler):
+    calls = []
+
+    async def flaky_handle(payload):
+        calls.append(payload)
+        if len(calls) == 1:
+            raise RuntimeError('Database unavailable')
+
+    event_handler = await start_handler(flaky_handle, 'test_retry')
+    await publish_payloads(channel, exchange_name, 'test_retry', [{'foo': 1}])
+    await asyncio.sleep(0.05)
+
+    # The message comes back after the failure, and is done the second time.
+    assert calls == [{'foo': 1}, {'foo': 1}]
+    assert await event_handler.get_queue_depth() == 0
+    assert event_handler.in_flight == 0
+    await event_handler.stop()
+
+
+@pytest.mark.asyncio
+async def test_event_handler_drain(channel, exchange_name, start_handler):
+    handled = []
+
+    async def slow_handle(payload):
+        await asyncio.sleep(0.2)
+        handled.append(payload)
+
+    event_handler = await start_handler(slow_handle, 'test_drain')
+    await publish_payloads(
+        channel, exchange_name, 'test_drain', [{'foo': foo} for foo in range(3)],
+    )
+    await asyncio.sleep(0.05)
+    await event_handler.cancel()
+    assert event_handler.in_flight == 3
+    assert not await event_handler.drain(timeout=0.01)
+    assert await event_handler.drain(timeout=1)
+    await event_handler.close()
+
+    assert len(handled) == 3
+    assert event_handler.channel.is_closed
+
+
+@pytest.mark.asyncio
+async def test_event_handler_queue_depth_and_busy_time(channel, exchange_name, start_handler):
+    async def slow_handle(payload):
+        await asyncio.sleep(0.1)
+
+    event_handler = await start_handler(slow_handle, 'test_depth', start=False)
+    await publish_payloads(
+        channel, exchange_name, 'test_depth', [{'foo': foo} for foo in range(3)],
+    )
+    assert await event_handler.get_queue_depth() == 3
+    assert event_handler.busy_time == 0
+
+    await event_handler.start()
+    await asyncio.sleep(0.3)
+    assert await event_handler.get_queue_depth() == 0
+    await event_handler.stop()
+
+    assert event_handler.busy_time >= 0.1
+    assert event_handler.handled == 3
+
+
+@pytest.mark.asyncio
+async def test_event_handler_logs_slow_messages(channel, exchange_name, start_handler, caplog):
+    async def slow_handle(payload):
+        await asyncio.sleep(0.05)
+
+    event_handler = await start_handler(slow_handle, 'test_slow', slow_threshold=0.04)
+    await publish_payloads(channel, exchange_name, 'test_slow', [{'foo': 1}])
+    await asyncio.sleep(0.1)
+    await event_handler.stop()
+
+    [record] = [r for r in caplog.records if r.getMessage().startswith('Slow message')]
+    assert 'slow_handle' in record.getMessage()
+    assert 'handler ' in record.getMessage()
+    assert 'outcome ok' in record.getMessage()
+
+
+@pytest.mark.asyncio
+async def test_event_handler_batch(channel, exchange_name, start_handler):
+    batches = []
+
+    async def handle_batch(payload: List[Payload]):
+        batches.append(payload)
+
+    event_handler = await start_handler(handle_batch, 'test_batch', batch_size=3, max_wait=0.1)
+    assert event_handler.payload_type is Payload
+    await publish_payloads(
+        channel, exchange_name, 'test_batch', [{'foo': foo} for foo in range(4)],
+    )
+
+    # The full batch is handled at once, the rest once max_wait has passed.
+    await asyncio.sleep(0.05)
+    assert batches == [[Payload(foo=0), Payload(foo=1), Payload(foo=2)]]
+    await asyncio.sleep(0.1)
+    assert batches[1:] == [[Payload(foo=3)]]
+
+    assert await event_handler.get_queue_depth() == 0
+    assert event_handler.in_flight == 0
+    assert event_handler.handled == 4
+    await event_handler.stop()
+
+
+@pytest.mark.asyncio
+async def test_event_handler_batch_failure_is_redelivered(channel, exchange_name, start_handler):
+    batches = []
+
+    async def handle_batch(payload: list):
+        batches.append(payload)
+        if len(batches) == 1:
+            raise RuntimeError('Database unavailable')
+
+    event_handler = await start_handler(handle_batch, 'test_batch_failure', batch_size=2)
+    await publish_payloads(
+        channel, exchange_name, 'test_batch_failure', [{'foo': foo} for foo in range(2)],
+    )
+    await asyncio.sleep(0.1)
+    await event_handler.stop()
+
+    assert len(batches) == 2
+    assert sorted(batches[1], key=lambda payload: payload['foo']) == batches[0]
+
+
+@pytest.mark.asyncio
+async def test_event_handler_batch_always_failing(channel, exchange_name, start_handler):
+    batches = []
+
+    async def handle_batch(payload: list):
+        batches.append(payload)
+        raise RuntimeError('Poison payload')
+
+    event_handler = await start_handler(handle_batch, 'test_batch_poison', batch_size=2)
+    await publish_payloads(
+        channel, exchange_name, 'test_batch_poison', [{'foo': foo} for foo in range(2)],
+    )
+    await asyncio.sleep(0.3)
+
+    # Retried once, then dropped.
+    assert len(batches) == 2
+    assert await event_handler.get_queue_depth() == 0
+    assert event_handler.in_flight == 0
+    await event_handler.stop()
+
+
+@pytest.mark.asyncio
+async def test_event_handler_batch_settle_failure(channel, exchange_name, start_handler):
+    event_handlers = []
+
+    async def handle_batch(payload: list):
+        # Acknowledging the batch fails once the channel is closed.
+        await event_handlers[0].channel.close()
+
+    event_handlers.append(
+        await start_handler(handle_batch, 'test_batch_settle', batch_size=2)
+    )
+    await publish_payloads(
+        channel, exchange_name, 'test_batch_settle', [{'foo': foo} for foo in range(2)],
+    )
+    await asyncio.sleep(0.05)
+
+    assert await event_handlers[0].drain(timeout=0.5)
+
+
+@pytest.mark.asyncio
+async def test_event_handler_logs_slow_batches(channel, exchange_name, start_handler, caplog):
+    async def handle_batch(payload: list):
+        await asyncio.sleep(0.1)
+
+    event_handler = await start_handler(
+        handle_batch,
+        'test_batch_slow',
+        batch_size=2,
+        max_wait=0.2,
+        slow_threshold=0.05,
+    )
+    await publish_payloads(channel, exchange_name, 'test_batch_slow', [{'foo': 1}])
+    await asyncio.sleep(0.35)
+    await event_handler.stop()
+
+    # Waiting for the batch does not make the message slow, handling it does.
+    messages = [r.getMessage() for r in caplog.records if r.getMessage().startswith('Slow')]
+    [message] = messages
+    assert message.startswith('Slow batch of 1 messages in handle_batch')
+    assert 'handler ' in message
+    assert 'outcome ok' in message
+
+
+@pytest.mark.parametrize('options', [{'max_concurrency': 5}, {'prefetch_count': 5}])
+def test_event_handler_batch_options(service_name, settings, options):
+    with pytest.raises(ValueError):
+        AmqpEventHandler(
+            context=ServiceContext(name=service_name, settings=settings),
+            call=handle,
+            exchange_name='source_events',
+            routing_key='test_batch_options',
+            batch_size=10,
+            **options,
+        )
+
+
+def test_event_handler_batch_needs_list_payload(service_name, settings):
+    async def handle_batch(payload: Payload):
+        pass
+
+    with pytest.raises(ValueError):
+        AmqpEventHandler(
+            context=ServiceContext(name=service_name, settings=settings),
+            call=handle_batch,
+            exchange_name='source_events',
+            routing_key='test_batch_payload',
+            batch_size=10,
+        )
@@ -0,0 +1,48 @@
+import pytest
+
+from aio_pika import ExchangeType
+
+from uservice.amqp.pool import ChannelPool, get_channel_pool
+from uservice.contexts import ServiceContext
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_reuses_channels(connection, channel):
+    await channel.declare_exchange('test_pool', type=ExchangeType.TOPIC)
+    pool = ChannelPool(connection, max_size=2)
+
+    async with pool.acquire() as first:
+        exchange = await first.get_exchange('test_pool')
+        async with pool.acquire() as second:
+            assert second is not first
+
+    async with pool.acquire() as pooled:
+        assert pooled is first
+        assert await pooled.get_exchange('test_pool') is exchange
+
+    await pool.close()
+    assert first.channel.is_closed
+    assert second.channel.is_closed
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_drops_closed_channels(connection):
+    pool = ChannelPool(connection, max_size=1)
+
+    async with pool.acquire() as pooled:
+        await pooled.channel.close()
+
+    assert pool.idle == []
+    async with pool.acquire() as fresh:
+        assert fresh is not pooled
+        assert not fresh.channel.is_closed
+
+    await pool.close()
+
+
+def test_get_channel_pool_per_connection(connection, settings):
+    context = ServiceContext(name='test_pool', settings=settings)
+    pool = get_channel_pool(connection, context)
+
+    assert get_channel_pool(connection, context) is pool
+    assert pool.max_size == settings.amqp.channel_pool_size
@@ -9,6 +9,7 @@ from pydantic import BaseModel
 from aio_pika import ExchangeType, Message
 from uservice.amqp.rpc import AmqpRpc, AmqpRpcProxy, RPC_QUEUE, RPC_REPLY_QUEUE, RPC_ROUTING_KEY
 from uservice.contexts import ServiceContext
+from uservice.metrics import RPC_CALLS
 
 
 class Response(BaseModel):
@@ -118,3 +119,95 @@ async def test_rpc_proxy(
     async with cm as proxy:
         result = await proxy.handle(**input)
         assert result == expects
+
+
+@pytest.mark.asyncio
+async def test_rpc_proxy_shared_reply_queue(
+        connection,
+        service_name,
+        settings,
+):
+    context = ServiceContext(
+        name='source',
+        settings=settings,
+    )
+    rpc_proxy = AmqpRpcProxy(target_service=service_name)
+    async with asynccontextmanager(rpc_proxy)(connection, context) as proxy:
+        results = await asyncio.gather(
+            *(proxy.handle(x=x, y=2) for x in range(5))
+        )
+        reply_listener = proxy.reply_listener
+
+    assert results == [{"foo": x * 2} for x in range(5)]
+    assert reply_listener.responses == {}
+
+    async with asynccontextmanager(rpc_proxy)(connection, context) as proxy:
+        assert proxy.reply_listener is reply_listener
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('codec', ['orjson', 'msgpack'])
+async def test_rpc_proxy_codec(
+        connection,
+        service_name,
+        settings,
+        codec,
+):
+    context = ServiceContext(
+        name='source',
+        settings=settings,
+    )
+    rpc_proxy = AmqpRpcProxy(target_service=service_name, codec=codec)
+    async with asynccontextmanager(rpc_proxy)(connection, context) as proxy:
+        assert await proxy.handle(x=2, y=4) == {"foo": 8}
+
+
+@pytest.mark.asyncio
+async def test_rpc_proxy_cache(
+        connection,
+        service_name,
+        settings,
+):
+    context = ServiceContext(
+        name='source',
+        settings=settings,
+    )
+    rpc_proxy = AmqpRpcProxy(target_service=service_name, cache={'handle': 60})
+    async with asynccontextmanager(rpc_proxy)(connection, context) as proxy:
+        first = await proxy.handle(x=2, y=3)
+        first['foo'] = 0
+        assert await proxy.handle(y=3, x=2) == {"foo": 6}
+        assert await proxy.handle(x=2, y=4) == {"foo": 8}
+
+    assert len(rpc_proxy.cache.entries) == 2
+    assert RPC_CALLS.values[(service_name, 'handle', 'cached')] == 1
+
+    rpc_proxy.invalidate('handle', x=2, y=3)
+    assert len(rpc_proxy.cache.entries) == 1
+    rpc_proxy.invalidate()
+    assert not rpc_proxy.cache.entries
+
+
+@pytest.mark.asyncio
+async def test_rpc_proxy_single_flight(
+        connection,
+        service_name,
+        settings,
+):
+    context = ServiceContext(
+        name='source',
+        settings=settings,
+    )
+    rpc_proxy = AmqpRpcProxy(target_service=service_name, single_flight=True)
+    requests = RPC_CALLS.values.get((service_name, 'handle', 'ok'), 0)
+    async with asynccontextmanager(rpc_proxy)(connection, context) as proxy:
+        results = await asyncio.gather(
+            *(proxy.handle(x=2, y=3) for _idx in range(5)),
+            proxy.handle(x=2, y=4),
+        )
+
+    assert results == [{"foo": 6}] * 5 + [{"foo": 8}]
+    assert len({id(result) for result in results}) == 6
+    assert RPC_CALLS.values[(service_name, 'handle', 'ok')] - requests == 2
+    assert RPC_CALLS.values[(service_name, 'handle', 'coalesced')] == 4
+    assert not rpc_proxy.single_flight.calls
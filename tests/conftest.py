@@ -1,3 +1,4 @@
+import os
 import pytest
 import pytest_asyncio
 import time
@@ -5,12 +6,21 @@ import asyncio
 import aio_pika
 from unittest.mock import AsyncMock
 from uservice.settings import Settings
+from uservice.transport import AMQP_BACKEND, connect
 
 from yarl import URL
 
+# Run on the in-memory broker, COMMUNICATION_BACKEND=amqp runs on RabbitMQ in
+# docker.
+os.environ.setdefault("COMMUNICATION_BACKEND", "memory")
+
 
 @pytest.fixture(scope="session", autouse=True)
-def rabbitmq_server():
+def rabbitmq_server(settings):
+    if settings.communication_backend != AMQP_BACKEND:
+        yield None
+        return
+
     import docker
     client = docker.from_env()
     container = client.containers.run(
@@ -54,8 +64,12 @@ def amqp_url(request, amqp_direct_url) -> URL:
 
 
 @pytest_asyncio.fixture(scope="session")
-async def connection(amqp_url):
-    conn = await aio_pika.connect(amqp_url)
+async def connection(settings, amqp_url):
+    if settings.communication_backend == AMQP_BACKEND:
+        conn = await aio_pika.connect(amqp_url)
+    else:
+        conn = await connect(settings)
+
     async with conn:
         yield conn
 
@@ -0,0 +1,213 @@
+import pytest
+
+from uservice.metrics import MESSAGES
+from uservice.supervisors.multiprocess import BACKOFF_BASE, Multiprocess, STABLE_AFTER
+
+
+class StubWorker:
+    """
+    Stands in for a WorkerProcess, alive until it is made to exit.
+    """
+
+    def __init__(self, pid, now, failures=0):
+        self.pid = pid
+        self.exitcode = None
+        self.failures = failures
+        self.started_at = self.last_heartbeat = now
+        self.restart_at = None
+        self.ready = False
+        self.recycling = False
+        self.stats = None
+        self.metrics = None
+        self.alive = True
+        self.joined = False
+        self.signals = []
+
+    def exit(self, exitcode=0):
+        self.alive = False
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return self.alive
+
+    def poll(self):
+        pass
+
+    def terminate(self):
+        self.signals.append('terminate')
+
+    def kill(self):
+        self.signals.append('kill')
+        self.exit(-9)
+
+    def join(self, timeout=None):
+        assert not self.alive
+        self.joined = True
+
+
+class StubMultiprocess(Multiprocess):
+    def __init__(self, workers=2, **kwargs):
+        super().__init__(target=None, workers=workers, heartbeat_timeout=10.0, **kwargs)
+        self.now = 0.0
+        self.started = []
+
+    def start_worker(self, failures=0):
+        process = StubWorker(100 + len(self.started), self.now, failures)
+        self.started.append(process)
+        return process
+
+    def start(self):
+        for _idx in range(self.workers):
+            self.processes.append(self.start_worker())
+
+    def tick(self, seconds=0.0):
+        self.now += seconds
+        self.monitor(self.now)
+
+
+@pytest.fixture
+def supervisor():
+    supervisor = StubMultiprocess()
+    supervisor.start()
+    return supervisor
+
+
+def test_died_worker_is_restarted(supervisor):
+    process = supervisor.processes[0]
+    process.exit(1)
+    supervisor.tick()
+
+    assert process.joined
+    assert supervisor.processes[0] is not process
+    assert supervisor.processes[0].failures == 1
+    assert supervisor.processes[1] is supervisor.started[1]
+
+
+def test_restarts_back_off_while_workers_keep_dying(supervisor):
+    delays = []
+    for _ in range(4):
+        process = supervisor.processes[0]
+        process.exit(1)
+        supervisor.tick()
+        restarted_at = supervisor.now
+        while supervisor.processes[0] is process:
+            supervisor.tick(0.5)
+
+        delays.append(supervisor.now - restarted_at)
+
+    assert delays == [0, BACKOFF_BASE, BACKOFF_BASE * 2, BACKOFF_BASE * 4]
+
+    # A worker that ran long enough is restarted right away again.
+    process = supervisor.processes[0]
+    supervisor.tick(STABLE_AFTER + 1)
+    process.exit(1)
+    supervisor.tick()
+    assert supervisor.processes[0] is not process
+    assert supervisor.processes[0].failures == 1
+
+
+def test_worker_without_heartbeat_is_killed(supervisor):
+    process = supervisor.processes[0]
+    supervisor.processes[1].last_heartbeat = 10.0
+    supervisor.tick(10.5)
+
+    assert process.signals == ['kill']
+    assert process.joined
+    assert supervisor.processes[0] is not process
+    assert supervisor.processes[1] is supervisor.started[1]
+
+
+def test_recycled_worker_is_replaced_and_joined_once_it_exits(supervisor):
+    process = supervisor.processes[0]
+    process.recycling = True
+    supervisor.tick()
+
+    assert supervisor.processes[0] is not process
+    assert supervisor.retiring == [process]
+    # It stops by itself, and is only joined once it has exited.
+    assert process.signals == []
+    supervisor.tick(0.5)
+    assert supervisor.retiring == [process]
+
+    process.exit()
+    supervisor.tick(0.5)
+    assert supervisor.retiring == []
+    assert process.joined
+
+
+def test_roll_replaces_workers_one_at_a_time(supervisor):
+    old = list(supervisor.processes)
+    supervisor.tick(1)
+    supervisor.should_reload = True
+    supervisor.tick(1)
+    replacement = supervisor.replacement
+    assert replacement is supervisor.started[-1]
+
+    # The old worker is only stopped once the new one consumes.
+    supervisor.tick(1)
+    assert old[0].signals == []
+    replacement.ready = True
+    supervisor.tick(1)
+    assert supervisor.processes == [replacement, old[1]]
+    assert old[0].signals == ['terminate']
+
+    # The next one is replaced once the last stopped worker exited.
+    supervisor.tick(1)
+    assert supervisor.replacement is None
+    old[0].exit()
+    supervisor.tick(1)
+    supervisor.tick(1)
+    supervisor.replacement.ready = True
+    supervisor.tick(1)
+    assert supervisor.processes == [replacement, supervisor.started[-1]]
+    assert old[1].signals == ['terminate']
+
+    old[1].exit()
+    supervisor.tick(1)
+    supervisor.tick(1)
+    assert supervisor.reload_at is None
+    assert len(supervisor.started) == 4
+
+
+def test_roll_keeps_old_workers_if_the_new_one_fails(supervisor):
+    old = list(supervisor.processes)
+    supervisor.tick(1)
+    supervisor.should_reload = True
+    supervisor.tick(1)
+    replacement = supervisor.replacement
+    replacement.exit(1)
+    supervisor.tick(1)
+
+    assert replacement.joined
+    assert supervisor.replacement is None
+    assert supervisor.reload_at is None
+    assert supervisor.processes == old
+    assert all(process.signals == [] for process in old)
+
+
+def messages(count):
+    return {MESSAGES.name: {('handle', 'ok'): float(count)}}
+
+
+def test_metrics_of_exited_workers_are_kept(supervisor):
+    first, second = supervisor.processes
+    first.metrics = messages(3)
+    second.metrics = messages(4)
+    supervisor.tick()
+    assert 'uservice_messages_total{entrypoint="handle",outcome="ok"} 7.0' in supervisor.render_metrics()
+
+    for _ in range(3):
+        process = supervisor.processes[0]
+        process.recycling = True
+        supervisor.tick(1)
+        process.exit()
+        supervisor.tick(1)
+        # The new worker reuses the pid of the one it replaced.
+        supervisor.processes[0].pid = process.pid
+        supervisor.processes[0].metrics = messages(1)
+        supervisor.tick(1)
+
+    # One snapshot per running worker, the exited ones are added up.
+    assert len(supervisor.worker_metrics) == 2
+    assert supervisor.retired_metrics[MESSAGES.name] == {('handle', 'ok'): 5.0}
+    assert 'uservice_messages_total{entrypoint="handle",outcome="ok"} 10.0' in supervisor.render_metrics()
@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+import enum
+import pytest
+
+from typing import Dict, List, Literal, Optional, Set
+
+from pydantic import BaseModel, conint, conlist, constr
+
+from uservice import Service
+from uservice.bench import LoadGenerator, generate_payload, validate_payload
+from uservice.cli.bench import run_bench
+
+
+class Color(enum.Enum):
+    red = 'red'
+    blue = 'blue'
+
+
+class Item(BaseModel):
+    sku: constr(min_length=8, max_length=12)
+    quantity: conint(ge=1, le=5)
+    tags: Set[str]
+    color: Color
+
+
+class Order(BaseModel):
+    id: int
+    created: datetime.datetime
+    items: List[Item]
+    notes: Optional[Dict[str, int]]
+    kind: Literal['online', 'store']
+    scores: conlist(int, min_items=5)
+
+
+@pytest.mark.parametrize('index', range(5))
+def test_generate_payload(index):
+    payload = generate_payload(Order, index, list_size=2)
+
+    validate_payload(Order, payload)
+    assert payload['id'] == index
+    assert len(payload['items']) == 2
+    assert len(payload['scores']) == 5
+
+
+@pytest.mark.asyncio
+async def test_load_generator():
+    async def send(index):
+        if index % 4 == 0:
+            raise ValueError()
+
+        await asyncio.sleep(0.001)
+
+    report = await LoadGenerator(send, rate=1000, concurrency=10, messages=20).run()
+
+    assert report['sent'] == 20
+    assert report['messages'] == 15
+    assert report['errors'] == 5
+    assert report['error_types'] == {'ValueError': 5}
+    assert report['seconds'] >= 0.019
+
+
+@pytest.mark.asyncio
+async def test_run_bench_rpc(settings):
+    if settings.communication_backend != 'memory':
+        pytest.skip('Only starts the service itself on the memory broker')
+
+    service = Service(name='test_bench', settings=settings)
+
+    @service.rpc()
+    async def total(order: Order, factor: int):
+        return len(order['items']) * factor
+
+    report = await run_bench(
+        service,
+        entrypoint_name='total',
+        payload=None,
+        list_size=3,
+        codec=None,
+        drain_timeout=1,
+        load_options={
+            'rate': None,
+            'concurrency': 5,
+            'messages': 50,
+            'duration': None,
+            'timeout': 5,
+        },
+    )
+
+    assert report['kind'] == 'rpc'
+    assert report['messages'] == 50
+    assert report['errors'] == 0
@@ -0,0 +1,44 @@
+import pytest
+
+from uservice.codecs import (
+    CodecError,
+    JsonCodec,
+    MsgpackCodec,
+    OrjsonCodec,
+    get_codec,
+    resolve_codec,
+)
+
+
+@pytest.mark.parametrize('name', ['json', 'orjson', 'msgpack'])
+def test_codec_roundtrip(name):
+    codec = get_codec(name)
+    data = {'foo': 1, 'bar': [1.5, 'baz', None]}
+
+    assert codec.decode(codec.encode(data)) == data
+
+
+def test_get_codec_unknown():
+    with pytest.raises(CodecError):
+        get_codec('yaml')
+
+
+@pytest.mark.parametrize(
+    'content_type,preferred,expects', [
+        (None, 'json', JsonCodec),
+        (None, 'orjson', OrjsonCodec),
+        (None, 'msgpack', JsonCodec),
+        ('application/json', 'orjson', OrjsonCodec),
+        ('application/msgpack', 'json', MsgpackCodec),
+        ('application/x-msgpack', 'orjson', MsgpackCodec),
+    ]
+)
+def test_resolve_codec(content_type, preferred, expects):
+    codec = resolve_codec(content_type, get_codec(preferred))
+
+    assert isinstance(codec, expects)
+
+
+def test_resolve_codec_unknown_content_type():
+    with pytest.raises(CodecError):
+        resolve_codec('text/plain', get_codec('json'))
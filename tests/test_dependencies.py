@@ -0,0 +1,211 @@
+import threading
+import pytest
+
+from contextlib import AsyncExitStack
+from typing import Annotated
+
+from uservice.dependencies import (
+    Dependant,
+    DependencyError,
+    Depends,
+    call_dependant,
+    solve_service_dependencies,
+)
+
+
+def get_a():
+    return 'a'
+
+
+async def get_b(a: Annotated[str, Depends(get_a)]):
+    return a + 'b'
+
+
+async def get_c(
+        a: Annotated[str, Depends(get_a)],
+        b: Annotated[str, Depends(get_b)],
+):
+    return a + b + 'c'
+
+
+async def get_resource(payload):
+    yield payload
+
+
+async def handle(
+        payload,
+        b: Annotated[str, Depends(get_b)],
+        c: Annotated[str, Depends(get_c)],
+):
+    return payload, b, c
+
+
+def test_dependant_plan():
+    dependant = Dependant(call=handle)
+
+    assert [dependency.call for dependency in dependant.plan] == [
+        get_a,
+        get_b,
+        get_c,
+    ]
+    assert not dependant.needs_stack
+
+
+@pytest.mark.asyncio
+async def test_dependant_resolves_shared_dependency_once():
+    calls = []
+
+    def counted():
+        calls.append(1)
+        return len(calls)
+
+    async def handle(
+            x: Annotated[int, Depends(counted)],
+            y: Annotated[int, Depends(counted)],
+            z: Annotated[int, Depends(counted, use_cache=False)],
+    ):
+        pass
+
+    dependant = Dependant(call=handle)
+    params = await dependant.prepare_params(None, {})
+
+    assert params == {'x': 1, 'y': 1, 'z': 2}
+
+
+@pytest.mark.asyncio
+async def test_dependant_prepare_params():
+    dependant = Dependant(call=handle)
+    params = await dependant.prepare_params(None, {'payload': 1, 'other': 2})
+
+    assert params == {'payload': 1, 'b': 'ab', 'c': 'aabc'}
+
+
+@pytest.mark.asyncio
+async def test_dependant_async_generator():
+    async def handle(resource: Annotated[int, Depends(get_resource)]):
+        pass
+
+    dependant = Dependant(call=handle)
+    assert dependant.needs_stack
+
+    async with AsyncExitStack() as stack:
+        params = await dependant.prepare_params(stack, {'payload': 1})
+
+    assert params == {'resource': 1}
+
+
+@pytest.mark.asyncio
+async def test_service_scoped_dependency():
+    events = []
+
+    async def get_pool(context):
+        events.append('open')
+        yield context
+        events.append('close')
+
+    async def get_client(pool: Annotated[str, Depends(get_pool, scope='service')]):
+        return pool + '-client'
+
+    async def handle(
+            payload,
+            pool: Annotated[str, Depends(get_pool, scope='service')],
+            client: Annotated[str, Depends(get_client)],
+    ):
+        pass
+
+    dependant = Dependant(call=handle)
+    assert not dependant.needs_stack
+
+    scoped = {}
+    async with AsyncExitStack() as stack:
+        await solve_service_dependencies(
+            stack=stack,
+            params={'context': 'service'},
+            dependant=dependant,
+            scoped=scoped,
+        )
+        for payload in range(3):
+            params = await dependant.prepare_params(None, {'payload': payload}, scoped)
+            assert params == {
+                'payload': payload,
+                'pool': 'service',
+                'client': 'service-client',
+            }
+
+        assert events == ['open']
+
+    assert events == ['open', 'close']
+
+
+@pytest.mark.asyncio
+async def test_dependency_in_both_scopes():
+    calls = []
+
+    async def get_counter():
+        calls.append(None)
+        return len(calls)
+
+    async def get_per_message(counter: Annotated[int, Depends(get_counter)]):
+        return counter
+
+    async def handle(
+            payload,
+            shared: Annotated[int, Depends(get_counter, scope='service')],
+            per_message: Annotated[int, Depends(get_per_message)],
+    ):
+        pass
+
+    dependant = Dependant(call=handle)
+    scoped = {}
+    await solve_service_dependencies(
+        stack=AsyncExitStack(),
+        params={'context': 'service'},
+        dependant=dependant,
+        scoped=scoped,
+    )
+    for payload in range(2):
+        params = await dependant.prepare_params(None, {'payload': payload}, scoped)
+        assert params == {'payload': payload, 'shared': 1, 'per_message': payload + 2}
+
+
+@pytest.mark.asyncio
+async def test_service_scoped_dependency_errors():
+    async def get_payload(payload):
+        return payload
+
+    async def handle(value: Annotated[int, Depends(get_payload, scope='service')]):
+        pass
+
+    dependant = Dependant(call=handle)
+    with pytest.raises(DependencyError):
+        await dependant.prepare_params(None, {'payload': 1})
+
+    with pytest.raises(DependencyError):
+        await solve_service_dependencies(
+            stack=AsyncExitStack(),
+            params={'context': 'service'},
+            dependant=dependant,
+            scoped={},
+        )
+
+    with pytest.raises(ValueError):
+        Depends(get_payload, scope='request')
+
+
+@pytest.mark.asyncio
+async def test_sync_dependant_runs_in_thread_pool():
+    def get_thread():
+        return threading.current_thread()
+
+    def handle(payload, thread: Annotated[threading.Thread, Depends(get_thread)]):
+        return payload, thread, threading.current_thread()
+
+    dependant = Dependant(call=handle)
+    assert not dependant.is_async
+
+    params = await dependant.prepare_params(None, {'payload': 1})
+    payload, dependency_thread, handler_thread = await call_dependant(dependant, params)
+
+    assert payload == 1
+    assert dependency_thread is not threading.main_thread()
+    assert handler_thread is not threading.main_thread()
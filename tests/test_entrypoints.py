@@ -0,0 +1,77 @@
+import os
+import pytest
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Annotated
+
+from uservice import Depends
+from uservice.contexts import ServiceContext
+from uservice.entrypoints import Entrypoint
+
+
+def square(x):
+    return x * x, os.getpid()
+
+
+async def async_square(x):
+    return x * x, os.getpid()
+
+
+@pytest.fixture
+def context(settings):
+    return ServiceContext(name='test_entrypoints', settings=settings)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('call', [square, async_square])
+async def test_entrypoint_process_executor(context, call):
+    entrypoint = Entrypoint(context=context, call=call, executor='process')
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        context.process_pool = pool
+        result, pid = await entrypoint.handle({'x': 3})
+
+    assert result == 9
+    assert pid != os.getpid()
+
+
+def test_entrypoint_executor_validation(context):
+    def local(x):
+        pass
+
+    with pytest.raises(ValueError):
+        Entrypoint(context=context, call=local, executor='process')
+
+    with pytest.raises(ValueError):
+        Entrypoint(context=context, call=square, executor='cluster')
+
+
+def get_client():
+    return object()
+
+
+def with_context(x, context):
+    pass
+
+
+def with_dependency(x, client=Depends(get_client)):
+    pass
+
+
+def with_annotated_dependency(x, client: Annotated[object, Depends(get_client)]):
+    pass
+
+
+@pytest.mark.parametrize('call', [with_context, with_dependency, with_annotated_dependency])
+def test_entrypoint_process_executor_rejects_unpicklable_params(context, call):
+    with pytest.raises(ValueError):
+        Entrypoint(context=context, call=call, executor='process')
+
+    Entrypoint(context=context, call=call)
+
+
+@pytest.mark.asyncio
+async def test_entrypoint_process_executor_needs_pool(context):
+    entrypoint = Entrypoint(context=context, call=square, executor='process')
+    context.process_pool = None
+    with pytest.raises(RuntimeError):
+        await entrypoint.handle({'x': 3})
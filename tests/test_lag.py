@@ -0,0 +1,52 @@
+import asyncio
+import json
+import time
+import pytest
+
+from aio_pika import Message
+
+from uservice.amqp.events import AmqpEventHandler
+from uservice.contexts import ServiceContext
+from uservice.lag import LoopLagMonitor
+from uservice.metrics import LOOP_BLOCKED, LOOP_LAG_SECONDS
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('options', [{}, {'batch_size': 2, 'max_wait': 0.01}])
+async def test_loop_lag_monitor_finds_blocking_entrypoint(
+        connection,
+        channel,
+        settings,
+        caplog,
+        options,
+):
+    async def block_loop(payload):
+        time.sleep(0.2)
+
+    event_handler = AmqpEventHandler(
+        context=ServiceContext(name='test_lag', settings=settings),
+        call=block_loop,
+        exchange_name='lag_events',
+        routing_key='test_lag',
+        **options,
+    )
+    await event_handler.setup(connection)
+    await event_handler.start()
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.05)
+    monitor.start()
+    lag_count = sum(LOOP_LAG_SECONDS.values.get((), [0])[:-1])
+    blocked = LOOP_BLOCKED.values.get(('block_loop',), 0)
+
+    exchange = await channel.get_exchange('lag_events')
+    await exchange.publish(Message(json.dumps({'foo': 1}).encode()), 'test_lag')
+    await asyncio.sleep(0.1)
+    monitor.stop()
+    await event_handler.stop()
+
+    assert LOOP_BLOCKED.values[('block_loop',)] == blocked + 1
+    assert sum(LOOP_LAG_SECONDS.values[()][:-1]) > lag_count
+    # The sum includes waking up late after the blocking call.
+    assert LOOP_LAG_SECONDS.values[()][-1] >= 0.15
+    [record] = [r for r in caplog.records if r.getMessage().startswith('Event loop blocked')]
+    assert 'in block_loop at:' in record.getMessage()
+    assert 'time.sleep(0.2)' in record.getMessage()
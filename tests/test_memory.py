@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+import pytest_asyncio
+
+from aio_pika import ExchangeType, Message
+from aio_pika.exceptions import ChannelInvalidStateError, ChannelNotFoundEntity
+
+from uservice import memory
+
+
+@pytest_asyncio.fixture
+async def memory_connection():
+    # A broker of its own, so the tests do not share it with other tests.
+    async with memory.Connection(memory.MemoryBroker()) as connection:
+        yield connection
+
+
+@pytest.mark.parametrize(
+    'pattern,routing_key,expects', [
+        ('a.b', 'a.b', True),
+        ('a.b', 'a.c', False),
+        ('a.*', 'a.b', True),
+        ('a.*', 'a.b.c', False),
+        ('a.#', 'a', True),
+        ('a.#', 'a.b.c', True),
+        ('#.c', 'a.b.c', True),
+        ('*.b.#', 'a.b', True),
+        ('*.b.#', 'b', False),
+    ]
+)
+def test_topic_matches(pattern, routing_key, expects):
+    assert memory.topic_matches(pattern, routing_key) is expects
+
+
+@pytest.mark.asyncio
+async def test_prefetch_and_redelivery(memory_connection):
+    channel = await memory_connection.channel()
+    exchange = await channel.declare_exchange('test', ExchangeType.TOPIC)
+    queue = await channel.declare_queue('test-prefetch')
+    await queue.bind(exchange, 'test.#')
+    await channel.set_qos(prefetch_count=2)
+
+    received = []
+
+    async def on_message(message):
+        received.append(message)
+
+    await queue.consume(on_message)
+    for idx in range(5):
+        await exchange.publish(Message(str(idx).encode()), 'test.prefetch')
+
+    await asyncio.sleep(0)
+    assert [message.body for message in received] == [b'0', b'1']
+    assert (await queue.declare()).message_count == 3
+
+    await received[1].ack(multiple=True)
+    await asyncio.sleep(0)
+    assert [message.body for message in received[2:]] == [b'2', b'3']
+
+    await channel.close()
+    other = await memory_connection.channel()
+    queue = await other.declare_queue('test-prefetch')
+    redelivered = []
+
+    async def on_redelivery(message):
+        redelivered.append(message)
+        await message.ack()
+
+    await queue.consume(on_redelivery)
+    await asyncio.sleep(0)
+    assert [message.body for message in redelivered] == [b'2', b'3', b'4']
+    assert [message.redelivered for message in redelivered] == [True, True, False]
+
+
+@pytest.mark.asyncio
+async def test_multiple_ack_marks_only_its_message_processed(memory_connection):
+    channel = await memory_connection.channel()
+    queue = await channel.declare_queue('test-multiple')
+    received = []
+
+    async def on_message(message):
+        received.append(message)
+
+    await queue.consume(on_message)
+    for idx in range(3):
+        await channel.default_exchange.publish(Message(str(idx).encode()), 'test-multiple')
+
+    await asyncio.sleep(0)
+    await received[1].ack(multiple=True)
+    assert [message.processed for message in received] == [False, True, False]
+    assert list(channel.unacked) == [received[2].delivery_tag]
+
+    # Like RabbitMQ, settling a message twice closes the channel, and its
+    # unacked messages are redelivered.
+    await received[0].ack()
+    assert channel.is_closed
+    other = await memory_connection.channel()
+    assert (await (await other.declare_queue('test-multiple')).declare()).message_count == 1
+    with pytest.raises(ChannelInvalidStateError):
+        await received[2].ack()
+
+
+@pytest.mark.asyncio
+async def test_exclusive_queue_deleted_with_connection():
+    connection = await memory.connect()
+    channel = await connection.channel()
+    await channel.declare_queue('test-exclusive', exclusive=True)
+    assert 'test-exclusive' in memory.get_broker().queues
+
+    await connection.close()
+    assert 'test-exclusive' not in memory.get_broker().queues
+
+
+@pytest.mark.asyncio
+async def test_get_missing_exchange(memory_connection):
+    channel = await memory_connection.channel()
+    with pytest.raises(ChannelNotFoundEntity):
+        await channel.get_exchange('missing')
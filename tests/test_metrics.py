@@ -0,0 +1,88 @@
+import asyncio
+import json
+import pytest
+
+from aio_pika import Message
+from pydantic import BaseModel
+
+from uservice.amqp.events import AmqpEventHandler
+from uservice.contexts import ServiceContext
+from uservice.metrics import MESSAGES, STAGE_SECONDS, Registry
+
+
+class Payload(BaseModel):
+    foo: int
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.counter('calls_total', 'Calls.', ('name',))
+    histogram = registry.histogram('call_seconds', 'Seconds.', ('name',), buckets=(0.1, 1.0))
+
+    counter.inc(('a',))
+    counter.inc(('a',), 2)
+    histogram.observe(('a',), 0.05)
+    histogram.observe(('a',), 0.5)
+    histogram.observe(('a',), 5)
+
+    assert registry.render().splitlines() == [
+        '# HELP calls_total Calls.',
+        '# TYPE calls_total counter',
+        'calls_total{name="a"} 3.0',
+        '# HELP call_seconds Seconds.',
+        '# TYPE call_seconds histogram',
+        'call_seconds_bucket{name="a",le="0.1"} 1',
+        'call_seconds_bucket{name="a",le="1.0"} 2',
+        'call_seconds_bucket{name="a",le="+Inf"} 3',
+        'call_seconds_sum{name="a"} 5.55',
+        'call_seconds_count{name="a"} 3',
+    ]
+
+
+def test_merge():
+    registry = Registry()
+    counter = registry.counter('calls_total', 'Calls.', ('name',))
+    histogram = registry.histogram('call_seconds', 'Seconds.', ('name',), buckets=(1.0,))
+
+    counter.inc(('a',))
+    histogram.observe(('a',), 0.5)
+    first = registry.snapshot()
+    counter.inc(('b',))
+    histogram.observe(('a',), 2)
+    second = registry.snapshot()
+
+    total = registry.merge([first, second])
+
+    assert total['calls_total'] == {('a',): 2.0, ('b',): 1.0}
+    assert total['call_seconds'] == {('a',): [2, 1, 3.0]}
+    # The snapshots are not changed by merging them.
+    assert first['call_seconds'] == {('a',): [1, 0, 0.5]}
+
+
+@pytest.mark.asyncio
+async def test_event_handler_metrics(connection, channel, settings):
+    async def handle_metrics(payload: Payload):
+        pass
+
+    event_handler = AmqpEventHandler(
+        context=ServiceContext(name='test_metrics', settings=settings),
+        call=handle_metrics,
+        exchange_name='metrics_events',
+        routing_key='test_metrics',
+    )
+    await event_handler.setup(connection)
+    await event_handler.start()
+
+    exchange = await channel.get_exchange('metrics_events')
+    for body in ({'foo': 1}, {'foo': 2}, {'bar': 1}):
+        message = Message(json.dumps(body).encode())
+        await exchange.publish(message, 'test_metrics')
+
+    await asyncio.sleep(0.1)
+    await event_handler.stop()
+
+    assert MESSAGES.values[('handle_metrics', 'ok')] == 2
+    assert MESSAGES.values[('handle_metrics', 'invalid')] == 1
+    for stage in ('decode', 'validate', 'dependencies', 'handler', 'ack'):
+        counts = STAGE_SECONDS.values[('handle_metrics', stage)]
+        assert sum(counts[:-1]) == (3 if stage == 'decode' else 2)
@@ -0,0 +1,33 @@
+import time
+
+from uservice.metrics import current_entrypoint
+from uservice.profiling import SamplingProfiler
+
+
+def burn(seconds):
+    deadline = time.process_time() + seconds
+    while time.process_time() < deadline:
+        pass
+
+
+def test_profiler_writes_stacks_per_entrypoint(tmp_path):
+    profiler = SamplingProfiler(directory=str(tmp_path), interval=0.001, prefix='test')
+
+    profiler.toggle()
+    token = current_entrypoint.set('handle_order')
+    try:
+        burn(0.1)
+    finally:
+        current_entrypoint.reset(token)
+    profiler.toggle()
+
+    assert not profiler.running
+    [path] = tmp_path.glob('test-*-handle_order.collapsed')
+    lines = path.read_text().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) > 0
+    assert any(
+        line.rsplit(' ', 1)[0].split(';')[-1].startswith('burn (')
+        for line in lines
+    )
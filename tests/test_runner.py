@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+
+from uservice import runner
+from uservice.runner import ServiceRunner, jitter
+from uservice.supervisors.worker import RECYCLE
+
+
+class FakeReporter:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, kind, *args):
+        self.sent.append((kind, *args))
+
+
+class FakeService:
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.started.set()
+        self.messages_handled = 0
+        self.exited = False
+
+    def handle_exit(self, sig, frame):
+        self.exited = True
+
+
+def recycling_runner(monkeypatch, rss, **limits):
+    monkeypatch.setattr(runner, 'RECYCLE_INTERVAL', 0.001)
+    monkeypatch.setattr(runner, 'RECYCLE_JITTER', 0)
+    monkeypatch.setattr(runner, 'get_rss', lambda: rss[0] * 1024 * 1024)
+    service_runner = ServiceRunner(service_str='example:service', **limits)
+    service_runner.loaded_service = FakeService()
+    return service_runner
+
+
+@pytest.mark.parametrize('limit', [None, 0, 10, 1000])
+def test_jitter(limit):
+    for _ in range(100):
+        value = jitter(limit)
+        if not limit:
+            assert value == limit
+        else:
+            assert limit <= value <= limit * 1.1
+
+
+@pytest.mark.asyncio
+async def test_recycle_after_max_messages(monkeypatch):
+    service_runner = recycling_runner(monkeypatch, [10], max_messages=5)
+    service = service_runner.loaded_service
+    reporter = FakeReporter()
+    task = asyncio.create_task(service_runner.recycle(reporter))
+    await asyncio.sleep(0.01)
+    assert not reporter.sent
+
+    service.messages_handled = 5
+    await asyncio.wait_for(task, 1)
+    assert reporter.sent == [(RECYCLE,)]
+    assert service.exited
+
+
+@pytest.mark.asyncio
+async def test_recycle_after_max_rss(monkeypatch):
+    rss = [10]
+    service_runner = recycling_runner(monkeypatch, rss, max_rss=20)
+    reporter = FakeReporter()
+    task = asyncio.create_task(service_runner.recycle(reporter))
+    await asyncio.sleep(0.01)
+    assert not reporter.sent
+
+    rss[0] = 20
+    await asyncio.wait_for(task, 1)
+    assert reporter.sent == [(RECYCLE,)]
+
+
+@pytest.mark.asyncio
+async def test_recycle_skips_rss_over_the_limit_at_start(monkeypatch, caplog):
+    service_runner = recycling_runner(monkeypatch, [30], max_rss=20)
+    reporter = FakeReporter()
+    await asyncio.wait_for(service_runner.recycle(reporter), 1)
+
+    assert not reporter.sent
+    assert not service_runner.loaded_service.exited
+    assert 'not recycled by memory' in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_recycle_by_messages_with_rss_over_the_limit_at_start(monkeypatch):
+    service_runner = recycling_runner(monkeypatch, [30], max_rss=20, max_messages=5)
+    service = service_runner.loaded_service
+    reporter = FakeReporter()
+    task = asyncio.create_task(service_runner.recycle(reporter))
+    await asyncio.sleep(0.01)
+    assert not reporter.sent
+
+    service.messages_handled = 5
+    await asyncio.wait_for(task, 1)
+    assert reporter.sent == [(RECYCLE,)]
@@ -0,0 +1,28 @@
+import asyncio
+import pytest
+
+from uservice import Service
+from uservice.settings import Settings
+from uservice.transport import connect
+
+
+@pytest.fixture
+def service():
+    return Service(name='test_service', settings=Settings(communication_backend='memory'))
+
+
+@pytest.mark.asyncio
+async def test_exit_before_setup(service):
+    service.handle_exit(None, None)
+    await asyncio.wait_for(service.run(), 1)
+
+    assert not service.should_exit.is_set()
+
+
+@pytest.mark.asyncio
+async def test_stop_before_start(service):
+    async with await connect(service.context.settings) as connection:
+        await service.setup(connection)
+        await service.stop()
+
+    assert service.lag_monitor is None
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import pytest
+
+from typing import Annotated
+
+from aio_pika import ExchangeType, Message
+
+from uservice import Depends, EventPublisher, RpcProxy, Service
+from uservice.bench import start_service, stop_service
+from uservice.settings import Settings
+from uservice.transport import connect
+from uservice.tracing import parse_traceparent
+
+
+@pytest.mark.parametrize(
+    'headers,expects', [
+        (
+            {'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'},
+            ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', True),
+        ),
+        (
+            {'traceparent': b'00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00'},
+            ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', False),
+        ),
+        ({'traceparent': '00-0af7651916cd43dd-b7ad6b7169203331-01'}, None),
+        ({'traceparent': 1}, None),
+        ({}, None),
+        (None, None),
+    ]
+)
+def test_parse_traceparent(headers, expects):
+    assert parse_traceparent(headers) == expects
+
+
+@pytest.mark.asyncio
+async def test_trace_across_rpc_and_publish(settings, tmp_path):
+    if settings.communication_backend != 'memory':
+        pytest.skip('Starts the service itself on the memory broker')
+
+    path = tmp_path / 'traces.jsonl'
+    settings = Settings(
+        communication_backend='memory',
+        tracing={'exporter': 'file', 'file_path': str(path)},
+    )
+    service = Service(name='test_tracing', settings=settings)
+    handled = asyncio.Event()
+
+    @service.rpc()
+    async def lookup(id: int):
+        return id
+
+    @service.event_handler('tracing_events', 'order.created')
+    async def handle_order(
+            payload: dict,
+            proxy: Annotated[RpcProxy, Depends(RpcProxy(target_service='test_tracing'))],
+            publish: Annotated[EventPublisher, Depends(EventPublisher())],
+    ):
+        await proxy.lookup(id=payload['id'])
+        await publish('order.checked', payload)
+        handled.set()
+
+    task = await start_service(service)
+    connection = await connect(settings)
+    try:
+        async with connection:
+            channel = await connection.channel()
+            await channel.declare_exchange('test_tracing', ExchangeType.TOPIC)
+            exchange = await channel.get_exchange('tracing_events')
+            await exchange.publish(Message(json.dumps({'id': 1}).encode()), 'order.created')
+            await asyncio.wait_for(handled.wait(), 1)
+    finally:
+        await stop_service(service, task)
+
+    spans = {
+        span['name']: span
+        for span in map(json.loads, path.read_text().splitlines())
+    }
+    assert set(spans) == {
+        'handle_order',
+        'test_tracing.lookup',
+        'lookup',
+        'publish test_tracing',
+    }
+    root = spans['handle_order']
+    assert root['parent_id'] is None
+    assert root['kind'] == 'consumer'
+    assert {span['trace_id'] for span in spans.values()} == {root['trace_id']}
+    assert spans['test_tracing.lookup']['parent_id'] == root['span_id']
+    assert spans['lookup']['parent_id'] == spans['test_tracing.lookup']['span_id']
+    assert spans['lookup']['kind'] == 'server'
+    assert spans['publish test_tracing']['parent_id'] == root['span_id']
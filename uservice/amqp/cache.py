@@ -0,0 +1,140 @@
+import asyncio
+import copy
+import json
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Collection, Dict, Hashable, List, Optional, Tuple
+
+
+MISSING = object()
+
+
+def call_key(target_service: str, method: str, kwargs: Dict[str, Any]) -> Tuple[Hashable, ...]:
+    """
+    The same key for calls with the same arguments, in any order.
+    """
+    arguments = json.dumps(kwargs, sort_keys=True, separators=(',', ':'), default=str)
+    return (target_service, method, arguments)
+
+
+class RpcCache:
+    """
+    Results of rpc calls to one service, by method and arguments.
+
+    Only the methods in ``ttls`` are cached, each for its own number of
+    seconds. Once ``maxsize`` results are cached the least recently used is
+    dropped. Callers get a copy of the result, so changing it does not
+    change the cached result.
+    """
+
+    def __init__(self, *, target_service: str, ttls: Dict[str, float], maxsize: int = 1024):
+        self.target_service = target_service
+        self.ttls = ttls
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+        # Changed by every invalidation, so results of calls made before it
+        # are not cached once they return.
+        self.generation = 0
+
+    def cacheable(self, method: str) -> bool:
+        return method in self.ttls
+
+    def key(self, method: str, kwargs: Dict[str, Any]) -> Tuple[Hashable, ...]:
+        return call_key(self.target_service, method, kwargs)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING
+
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self.entries[key]
+            return MISSING
+
+        self.entries.move_to_end(key)
+        return copy.deepcopy(value)
+
+    def set(self, key: Tuple[Hashable, ...], value: Any, generation: int) -> None:
+        if generation != self.generation:
+            return
+
+        method = key[1]
+        self.entries[key] = (time.monotonic() + self.ttls[method], copy.deepcopy(value))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, method: Optional[str] = None, kwargs: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Drop the cached results of a call, of every call of ``method``, or
+        every cached result without arguments.
+        """
+        self.generation += 1
+        if method is None:
+            self.entries.clear()
+        elif kwargs is not None:
+            self.entries.pop(self.key(method, kwargs), None)
+        else:
+            for key in [key for key in self.entries if key[1] == method]:
+                del self.entries[key]
+
+
+class SingleFlight:
+    """
+    Calls to one service that share a single request while one with the
+    same method and arguments is in flight.
+
+    Only the methods in ``methods`` are shared, all of them if it is None.
+    The request runs in its own task, so a caller that is cancelled does
+    not cancel it for the others. When a result is shared every caller gets
+    its own copy of it.
+    """
+
+    def __init__(self, *, target_service: str, methods: Optional[Collection[str]] = None):
+        self.target_service = target_service
+        self.methods = methods
+        # The task of the request in flight and the number of callers that
+        # joined it, by call.
+        self.calls: Dict[Tuple[Hashable, ...], List[Any]] = {}
+
+    def shared(self, method: str) -> bool:
+        return self.methods is None or method in self.methods
+
+    async def call(
+            self,
+            method: str,
+            kwargs: Dict[str, Any],
+            request: Callable[[], Awaitable[Any]],
+    ) -> Tuple[Any, bool]:
+        """
+        The result of the request in flight for the same call, or of a new
+        one made with ``request``, and whether an earlier call made it.
+        """
+        key = call_key(self.target_service, method, kwargs)
+        call = self.calls.get(key)
+        if call is not None:
+            call[1] += 1
+            return copy.deepcopy(await asyncio.shield(call[0])), True
+
+        task = asyncio.ensure_future(request())
+        call = self.calls[key] = [task, 0]
+        task.add_done_callback(lambda _task: self._done(key, call))
+        result = await asyncio.shield(task)
+        if call[1]:
+            # The caller that made the request resumes first, it copies the
+            # result before it can change it for the others.
+            result = copy.deepcopy(result)
+
+        return result, False
+
+    def _done(self, key: Tuple[Hashable, ...], call: List[Any]) -> None:
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+        task = call[0]
+        if not task.cancelled():
+            # Retrieved, so a failure is not logged when every caller was
+            # cancelled before it.
+            task.exception()
@@ -1,7 +1,9 @@
+import asyncio
 import logging
-import json
+import time
 
-from contextlib import AsyncExitStack
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Dict, Optional
 
 from aio_pika import (
     Connection,
@@ -11,8 +13,12 @@ from aio_pika import (
     Channel,
     IncomingMessage,
 )
+from pydantic import ValidationError
 
+from uservice.codecs import get_codec, resolve_codec
+from uservice.contexts import ServiceContext
 from uservice.entrypoints import Entrypoint
+from uservice.metrics import MESSAGES, current_entrypoint, current_stages, observe_stage
 
 
 logger = logging.getLogger('uservice')
@@ -21,12 +27,54 @@ EVENT_HANDLER_QUEUE = 'uservice-{}-{}-{}'
 RPC_QUEUE = 'rpc-{}'
 RPC_REPLY_QUEUE = 'rpc-reply-{}-{}'
 RPC_ROUTING_KEY = '{}.{}'
+# Stages in which a message waits for others, left out of its time when it
+# is compared to the slow threshold.
+WAIT_STAGES = ('batch',)
 
 
 class AmqpConsumer(Entrypoint):
+    span_kind = 'consumer'
+
+    def __init__(
+            self,
+            *,
+            context: ServiceContext,
+            call: Callable,
+            prefetch_count: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            codec: Optional[str] = None,
+            executor: Optional[str] = None,
+            slow_threshold: Optional[float] = None,
+    ):
+        super().__init__(context=context, call=call, executor=executor)
+        self.prefetch_count = prefetch_count
+        self.max_concurrency = max_concurrency
+        self.codec = get_codec(codec or context.settings.codec)
+        # Seconds after which a message is logged with a breakdown of where
+        # the time went.
+        if slow_threshold is None:
+            slow_threshold = context.settings.slow_handler_threshold
+        self.slow_threshold = slow_threshold
+
     async def setup(self, connection: Connection) -> None:
         self.connection = connection
         self.channel: Channel = await self.connection.channel()
+        prefetch_count = self.get_prefetch_count()
+        if prefetch_count:
+            await self.channel.set_qos(prefetch_count=prefetch_count)
+
+        if self.max_concurrency:
+            self.limiter = asyncio.Semaphore(self.max_concurrency)
+        else:
+            self.limiter = nullcontext()
+
+        self.in_flight = 0
+        self.handled = 0
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self._busy_time = 0.0
+        self._busy_since = 0.0
+
         self.exchange: Exchange = await self.channel.declare_exchange(
             **self.get_exchange_settings()
         )
@@ -38,16 +86,145 @@ class AmqpConsumer(Entrypoint):
     async def start(self) -> None:
         self.consumer_tag = await self.queue.consume(self.handle_message)
 
-    async def stop(self) -> None:
+    async def cancel(self) -> None:
         await self.queue.cancel(self.consumer_tag)
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        if self.in_flight:
+            logger.info(
+                'Waiting for %s messages in flight in %s',
+                self.in_flight,
+                self.dependant.name,
+            )
+
+        try:
+            await asyncio.wait_for(self.drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                'Stopping %s with %s messages still in flight',
+                self.dependant.name,
+                self.in_flight,
+            )
+            return False
+
+        return True
+
+    async def close(self) -> None:
         await self.channel.close()
 
     async def handle_message(self, message: IncomingMessage) -> None:
-        async with AsyncExitStack() as stack:
-            body = json.loads(message.body)
-            await self._handle_message(stack, body, message)
+        if not self.in_flight:
+            self._busy_since = time.monotonic()
+            self.drained.clear()
+
+        self.in_flight += 1
+        name = self.dependant.name
+        stages: Dict[str, float] = {}
+        token = current_entrypoint.set(name)
+        stages_token = current_stages.set(stages)
+        outcome = 'error'
+        started_at = None
+        try:
+            async with self.limiter:
+                with self.trace(message):
+                    started_at = time.perf_counter()
+                    codec = resolve_codec(message.content_type, self.codec)
+                    body = codec.decode(message.body)
+                    observe_stage(name, 'decode', started_at)
+                    await self._handle_message(body, message)
+                    outcome = 'ok'
+        except ValidationError:
+            outcome = 'invalid'
+            # An invalid message fails the same way again, it is dropped.
+            if not message.processed:
+                await message.reject(requeue=False)
+
+            raise
+        except Exception:
+            # Settled, so a failing message does not hold a prefetch slot
+            # until the channel is closed.
+            if not message.processed:
+                await self.settle_failed(message)
+
+            raise
+        finally:
+            MESSAGES.inc((name, outcome))
+            current_entrypoint.reset(token)
+            current_stages.reset(stages_token)
+            if started_at is not None and self.slow_threshold is not None:
+                elapsed = time.perf_counter() - started_at
+                waited = sum(stages.get(stage, 0.0) for stage in WAIT_STAGES)
+                if elapsed - waited >= self.slow_threshold:
+                    self.log_slow(message, elapsed, stages, outcome)
+
+            self.in_flight -= 1
+            self.handled += 1
+            if not self.in_flight:
+                self._busy_time += time.monotonic() - self._busy_since
+                self.drained.set()
+
+    async def settle_failed(self, message: IncomingMessage) -> None:
+        """
+        Requeue a message whose handler failed, so a passing failure is
+        retried, unless it failed before. Such a message is dropped, or
+        dead lettered if the queue has a dead letter exchange.
+        """
+        await message.nack(requeue=not message.redelivered)
+
+    def log_slow(
+            self,
+            message: IncomingMessage,
+            elapsed: float,
+            stages: Dict[str, float],
+            outcome: str,
+    ) -> None:
+        """
+        Log where the time of a message that took longer than the slow
+        threshold went.
+        """
+        breakdown = ', '.join(
+            f'{stage} {seconds * 1000:.1f} ms' for stage, seconds in stages.items()
+        )
+        logger.warning(
+            'Slow message in %s took %.1f ms (%s), routing key %s, outcome %s',
+            self.dependant.name,
+            elapsed * 1000,
+            breakdown,
+            message.routing_key,
+            outcome,
+        )
 
-    async def _handle_message(self, stack, body, message) -> None:
+    def trace(self, message: IncomingMessage) -> ContextManager:
+        """
+        A span around handling the message, continuing the trace of the
+        sender.
+        """
+        tracer = self.context.tracer
+        if tracer is None:
+            return nullcontext()
+
+        return tracer.span(
+            self.dependant.name,
+            self.span_kind,
+            headers=message.headers,
+            attributes={'routing_key': message.routing_key},
+        )
+
+    @property
+    def busy_time(self) -> float:
+        """
+        Seconds spent with at least one message in flight.
+        """
+        if self.in_flight:
+            return self._busy_time + time.monotonic() - self._busy_since
+
+        return self._busy_time
+
+    async def get_queue_depth(self) -> int:
+        declaration = await self.queue.declare()
+        return declaration.message_count
+
+    async def _handle_message(self, body, message) -> None:
         raise NotImplementedError
 
     def get_exchange_name(self):
@@ -59,6 +236,9 @@ class AmqpConsumer(Entrypoint):
     def get_queue_name(self):
         raise NotImplementedError
 
+    def get_prefetch_count(self) -> Optional[int]:
+        return self.prefetch_count or self.max_concurrency
+
     def get_queue_settings(self):
         return {
             'name': self.get_queue_name(),
@@ -1,14 +1,32 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import inspect
+import logging
+import time
+
+from contextlib import nullcontext
 from inspect import isclass
-from contextlib import AsyncExitStack
-from typing import Callable, Any, AsyncGenerator
+from typing import (
+    Callable, Any, AsyncGenerator, ContextManager, Optional, List, Set, Tuple, Iterable, Dict,
+    get_args, get_origin,
+)
 
 from aio_pika import IncomingMessage, Connection, Message
 from pydantic import BaseModel, ValidationError
+from pydantic.fields import ModelField
 
+from uservice.codecs import Codec, get_codec
 from uservice.contexts import ServiceContext
+from uservice.metrics import current_entrypoint, current_stages, observe_stage
+from uservice.tracing import Tracer, trace_headers
 from uservice.utils import create_field, serialize_payload
 from .consumer import AmqpConsumer
+from .pool import ChannelPool, get_channel_pool
+
 
+logger = logging.getLogger('uservice')
 
 EVENT_HANDLER_QUEUE = 'uservice-{}-{}-{}'
 
@@ -21,16 +39,51 @@ class AmqpEventHandler(AmqpConsumer):
             call: Callable,
             exchange_name: str,
             routing_key: str,
+            prefetch_count: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            codec: Optional[str] = None,
+            executor: Optional[str] = None,
+            slow_threshold: Optional[float] = None,
+            batch_size: Optional[int] = None,
+            max_wait: float = 0.1,
     ):
-        super().__init__(context=context, call=call)
+        super().__init__(
+            context=context,
+            call=call,
+            prefetch_count=prefetch_count,
+            max_concurrency=max_concurrency,
+            codec=codec,
+            executor=executor,
+            slow_threshold=slow_threshold,
+        )
         self.exchange_name = exchange_name
         self.routing_key = routing_key
-        self
         try:
             self.payload_type = self.dependant.required_params['payload'].annotation
         except KeyError:
             raise ValueError('Event handler function is missing required arugment "payload"')
 
+        # With a batch size the handler is called with a list of up to that
+        # many payloads, or the payloads received within ``max_wait``
+        # seconds of the first one.
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        if batch_size:
+            self.payload_type = get_batch_item_type(self.payload_type)
+            for option, value in (
+                    ('prefetch_count', prefetch_count),
+                    ('max_concurrency', max_concurrency),
+            ):
+                if value is not None and value < batch_size:
+                    raise ValueError(
+                        f'Event handler {option} {value} is less than its batch size {batch_size}'
+                    )
+
+        self.batch: List[Tuple[Any, IncomingMessage]] = []
+        self.batch_done: Optional[asyncio.Future] = None
+        self.batch_timer: Optional[asyncio.TimerHandle] = None
+        self.flushes: Set[asyncio.Task] = set()
+
     def get_exchange_name(self) -> str:
         return self.exchange_name
 
@@ -46,25 +99,188 @@ class AmqpEventHandler(AmqpConsumer):
 
     async def _handle_message(
             self,
-            stack: AsyncExitStack,
             payload: Any,
             message: IncomingMessage,
     ) -> None:
+        name = self.dependant.name
         if isclass(self.payload_type) and issubclass(self.payload_type, BaseModel):
+            started_at = time.perf_counter()
             try:
                 payload = self.payload_type(**payload)
             except ValidationError as e:
                 await message.ack()
                 raise e
 
-        params = await self.dependant.prepare_params(
-            stack, {
-                'payload': payload,
-                'connection': self.connection,
-                'context': self.context,
+            observe_stage(name, 'validate', started_at)
+
+        if self.batch_size:
+            await self.add_to_batch(payload, message)
+            return
+
+        # Dependencies are closed by the time the handler returns, so
+        # buffered publishes are confirmed before the message is acknowledged.
+        await self.handle({
+            'payload': payload,
+            'connection': self.connection,
+            'context': self.context,
         })
-        await self.dependant.call(**params)
+        started_at = time.perf_counter()
         await message.ack()
+        observe_stage(name, 'ack', started_at)
+
+    async def add_to_batch(self, payload: Any, message: IncomingMessage) -> None:
+        """
+        Add the payload to the next batch and wait for the batch to be
+        handled, so the message stays in flight until it is acknowledged.
+        """
+        loop = asyncio.get_running_loop()
+        if not self.batch:
+            self.batch_done = loop.create_future()
+            self.batch_timer = loop.call_later(self.max_wait, self.flush_batch)
+
+        self.batch.append((payload, message))
+        done = self.batch_done
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+
+        started_at = time.perf_counter()
+        try:
+            await asyncio.shield(done)
+        finally:
+            observe_stage(self.dependant.name, 'batch', started_at)
+
+    def flush_batch(self) -> None:
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+
+        if not self.batch:
+            return
+
+        batch, self.batch = self.batch, []
+        # Run in a context of its own, not in that of the message that
+        # started or filled the batch.
+        task = contextvars.Context().run(
+            asyncio.create_task,
+            self._handle_batch(batch, self.batch_done),
+        )
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def _handle_batch(
+            self,
+            batch: List[Tuple[Any, IncomingMessage]],
+            done: asyncio.Future,
+    ) -> None:
+        name = self.dependant.name
+        stages: Dict[str, float] = {}
+        current_entrypoint.set(name)
+        current_stages.set(stages)
+        # A multiple ack settles every earlier message on the channel, so
+        # batches are handled one at a time, in the order they filled.
+        try:
+            async with self.batch_lock:
+                started_at = time.perf_counter()
+                outcome = 'error'
+                try:
+                    with self.trace_batch(batch):
+                        await self.settle_batch(batch)
+                        outcome = 'ok'
+                finally:
+                    elapsed = time.perf_counter() - started_at
+                    if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+                        self.log_slow_batch(batch, elapsed, stages, outcome)
+        except asyncio.CancelledError:
+            done.cancel()
+            raise
+        except Exception as e:
+            done.set_exception(e)
+        else:
+            done.set_result(None)
+
+    def log_slow_batch(
+            self,
+            batch: List[Tuple[Any, IncomingMessage]],
+            elapsed: float,
+            stages: Dict[str, float],
+            outcome: str,
+    ) -> None:
+        breakdown = ', '.join(
+            f'{stage} {seconds * 1000:.1f} ms' for stage, seconds in stages.items()
+        )
+        logger.warning(
+            'Slow batch of %s messages in %s took %.1f ms (%s), outcome %s',
+            len(batch),
+            self.dependant.name,
+            elapsed * 1000,
+            breakdown,
+            outcome,
+        )
+
+    async def settle_batch(self, batch: List[Tuple[Any, IncomingMessage]]) -> None:
+        """
+        Call the handler with the payloads of the batch, and acknowledge
+        the batch, or settle every message as failed if the handler raises.
+        """
+        try:
+            await self.handle({
+                'payload': [payload for payload, _ in batch],
+                'connection': self.connection,
+                'context': self.context,
+            })
+        except Exception:
+            # One by one, messages that were redelivered are dropped while
+            # the others are retried, so a poison payload does not replay
+            # the batch forever.
+            for _, message in batch:
+                await self.settle_failed(message)
+
+            raise
+
+        started_at = time.perf_counter()
+        await batch[-1][1].ack(multiple=True)
+        observe_stage(self.dependant.name, 'ack', started_at)
+
+    def trace_batch(self, batch: List[Tuple[Any, IncomingMessage]]) -> ContextManager:
+        tracer = self.context.tracer
+        if tracer is None:
+            return nullcontext()
+
+        return tracer.span(
+            self.dependant.name,
+            self.span_kind,
+            attributes={'messages': len(batch)},
+        )
+
+    async def setup(self, connection: Connection) -> None:
+        await super().setup(connection)
+        self.batch_lock = asyncio.Lock()
+
+    async def cancel(self) -> None:
+        await super().cancel()
+        # No more messages join the batch, so it does not wait for them.
+        self.flush_batch()
+
+    def get_prefetch_count(self) -> Optional[int]:
+        # A batch can only fill when the broker sends enough messages ahead.
+        return super().get_prefetch_count() or self.batch_size
+
+
+def get_batch_item_type(annotation: Any) -> Any:
+    """
+    The type of each payload of a batch handler, annotated with a list of
+    payloads.
+    """
+    if annotation is Any or annotation is inspect.Signature.empty:
+        return Any
+
+    if annotation is list or get_origin(annotation) is list:
+        args = get_args(annotation)
+        return args[0] if args else Any
+
+    raise ValueError(
+        f'Batch event handler payload must be annotated as a list, not {annotation}'
+    )
 
 
 class AmqpEventPublisher:
@@ -72,6 +288,9 @@ class AmqpEventPublisher:
             self,
             *,
             publish_model: Any = None,
+            batch_window: Optional[float] = None,
+            max_batch_size: int = 500,
+            codec: Optional[str] = None,
     ):
         self.field = None
         if publish_model:
@@ -79,23 +298,171 @@ class AmqpEventPublisher:
                 name='publish_model',
                 type_=publish_model,
             )
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.codec = codec
 
     async def __call__(
             self,
             connection: Connection,
             context: ServiceContext,
-    ) -> AsyncGenerator[Callable, None]:
-        channel = await connection.channel()
-        exchange = await channel.get_exchange(context.name)
-
-        async def publish(routing_key: str, payload: Any):
-            body = serialize_payload(
-                field=self.field,
-                payload_content=payload,
+    ) -> AsyncGenerator[Publisher, None]:
+        publisher = Publisher(
+            pool=get_channel_pool(connection, context),
+            exchange_name=context.name,
+            tracer=context.tracer,
+            field=self.field,
+            codec=get_codec(self.codec or context.settings.codec),
+            batch_window=self.batch_window,
+            max_batch_size=self.max_batch_size,
+        )
+        try:
+            yield publisher
+        except BaseException:
+            await publisher.discard()
+            raise
+
+        await publisher.close()
+
+
+class Publisher:
+    """
+    Publishes events to the exchange of the service.
+
+    With a ``batch_window`` the publishes are buffered and sent together,
+    either when the window has passed, ``max_batch_size`` is reached or the
+    dependency is closed. Every batch is sent on one channel and waits for
+    the publisher confirms of the whole batch at once.
+    """
+
+    def __init__(
+            self,
+            *,
+            pool: ChannelPool,
+            exchange_name: str,
+            field: Optional[ModelField] = None,
+            codec: Codec,
+            batch_window: Optional[float] = None,
+            max_batch_size: int = 500,
+            tracer: Optional[Tracer] = None,
+    ):
+        self.pool = pool
+        self.exchange_name = exchange_name
+        self.tracer = tracer
+        self.field = field
+        self.codec = codec
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.pending: List[Tuple[str, bytes]] = []
+        self.flushes: List[asyncio.Task] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    async def __call__(self, routing_key: str, payload: Any) -> None:
+        body = serialize_payload(
+            field=self.field,
+            payload_content=payload,
+            codec=self.codec,
+        )
+        if self.batch_window is None:
+            await self.publish_batch([(routing_key, body)])
+            return
+
+        self.pending.append((routing_key, body))
+        if len(self.pending) >= self.max_batch_size:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.batch_window,
+                self._flush_in_background,
             )
-            await exchange.publish(Message(body), routing_key)
 
-        try:
-            yield publish
-        finally:
-            await channel.close()
+    async def publish_many(self, events: Iterable[Tuple[str, Any]]) -> None:
+        await self.publish_batch([
+            (
+                routing_key,
+                serialize_payload(
+                    field=self.field,
+                    payload_content=payload,
+                    codec=self.codec,
+                ),
+            )
+            for routing_key, payload in events
+        ])
+
+    async def publish_batch(self, batch: List[Tuple[str, bytes]]) -> None:
+        if not batch:
+            return
+
+        started_at = time.perf_counter()
+        if self.tracer is None:
+            await self._publish_batch(batch, None)
+        else:
+            with self.tracer.span(
+                    f'publish {self.exchange_name}',
+                    'producer',
+                    attributes={'messages': len(batch)},
+            ) as span:
+                await self._publish_batch(batch, trace_headers(span))
+
+        # Batches flushed by the timer keep the context they were started in,
+        # publishes made outside of any entrypoint are not recorded.
+        name = current_entrypoint.get()
+        if name:
+            observe_stage(name, 'publish', started_at)
+
+    async def _publish_batch(
+            self,
+            batch: List[Tuple[str, bytes]],
+            headers: Optional[Dict[str, Any]],
+    ) -> None:
+        async with self.pool.acquire() as channel:
+            exchange = await channel.get_exchange(self.exchange_name)
+            await asyncio.gather(*(
+                exchange.publish(
+                    Message(
+                        body,
+                        content_type=self.codec.content_type,
+                        headers=headers,
+                    ),
+                    routing_key,
+                )
+                for routing_key, body in batch
+            ))
+
+    async def flush(self) -> None:
+        self._cancel_timer()
+        batch, self.pending = self.pending, []
+        await self.publish_batch(batch)
+
+    def _flush_in_background(self) -> None:
+        self.timer = None
+        self.flushes.append(asyncio.ensure_future(self.flush()))
+
+    def _cancel_timer(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    async def close(self) -> None:
+        """
+        Publish the buffered events and wait for every batch to be
+        confirmed, also when one of them fails.
+        """
+        flushes, self.flushes = self.flushes, []
+        results = await asyncio.gather(self.flush(), *flushes, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def discard(self) -> None:
+        """
+        Drop the buffered events and cancel the batches being published,
+        so none are sent after the message failed.
+        """
+        self._cancel_timer()
+        self.pending = []
+        flushes, self.flushes = self.flushes, []
+        for flush in flushes:
+            flush.cancel()
+
+        await asyncio.gather(*flushes, return_exceptions=True)
@@ -0,0 +1,90 @@
+import asyncio
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List
+from weakref import WeakKeyDictionary
+
+from aio_pika import Connection, Channel, Exchange
+
+from uservice.contexts import ServiceContext
+
+
+class PooledChannel:
+    def __init__(self, channel: Channel):
+        self.channel = channel
+        self.exchanges: Dict[str, Exchange] = {}
+
+    async def get_exchange(self, name: str) -> Exchange:
+        try:
+            return self.exchanges[name]
+        except KeyError:
+            exchange = await self.channel.get_exchange(name)
+            self.exchanges[name] = exchange
+            return exchange
+
+
+class ChannelPool:
+    """
+    Channels borrowed by dependencies that publish, so that resolving a
+    dependency does not cost a channel open and close on the broker.
+    """
+
+    def __init__(
+            self,
+            connection: Connection,
+            *,
+            max_size: int,
+    ):
+        self.connection = connection
+        self.max_size = max_size
+        self.idle: List[PooledChannel] = []
+        self.semaphore = asyncio.Semaphore(max_size)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[PooledChannel]:
+        async with self.semaphore:
+            pooled = self._get_idle()
+            if pooled is None:
+                pooled = PooledChannel(await self.connection.channel())
+
+            try:
+                yield pooled
+            finally:
+                if not pooled.channel.is_closed:
+                    self.idle.append(pooled)
+
+    def _get_idle(self):
+        while self.idle:
+            pooled = self.idle.pop()
+            if not pooled.channel.is_closed:
+                return pooled
+
+        return None
+
+    async def close(self) -> None:
+        while self.idle:
+            pooled = self.idle.pop()
+            await pooled.channel.close()
+
+
+_channel_pools: WeakKeyDictionary = WeakKeyDictionary()
+
+
+def get_channel_pool(
+        connection: Connection,
+        context: ServiceContext,
+) -> ChannelPool:
+    try:
+        return _channel_pools[connection]
+    except KeyError:
+        pool = _channel_pools[connection] = ChannelPool(
+            connection,
+            max_size=context.settings.amqp.channel_pool_size,
+        )
+        return pool
+
+
+async def close_channel_pool(connection: Connection) -> None:
+    pool = _channel_pools.pop(connection, None)
+    if pool is not None:
+        await pool.close()
@@ -1,33 +1,56 @@
 from __future__ import annotations
 
 import asyncio
+import logging
+import time
 import uuid
-import json
 
-from typing import Callable, Any, Optional, AsyncGenerator
-from contextlib import AsyncExitStack
+from typing import Callable, Any, Collection, Optional, AsyncGenerator, Dict, Union
+from weakref import WeakKeyDictionary
 
-from aio_pika import IncomingMessage, Connection, Message, Exchange, Channel
+from aio_pika import IncomingMessage, Connection, Message, Channel, Queue
 
+from uservice.codecs import Codec, get_codec, resolve_codec
 from uservice.contexts import ServiceContext
+from uservice.metrics import RPC_CALLS, RPC_CALL_SECONDS, observe_stage
+from uservice.tracing import Tracer, trace_headers
 from uservice.utils import create_field, serialize_payload
+from .cache import MISSING, RpcCache, SingleFlight
 from .consumer import AmqpConsumer
+from .pool import ChannelPool, get_channel_pool
 
 
+logger = logging.getLogger('uservice')
+
 RPC_QUEUE = 'rpc-{}'
 RPC_REPLY_QUEUE = 'rpc-reply-{}-{}'
 RPC_ROUTING_KEY = '{}.{}'
 
 
 class AmqpRpc(AmqpConsumer):
+    span_kind = 'server'
+
     def __init__(
             self,
             *,
             context: ServiceContext,
             call: Callable,
             response_model: Optional[Any],
+            prefetch_count: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            codec: Optional[str] = None,
+            executor: Optional[str] = None,
+            slow_threshold: Optional[float] = None,
     ):
-        super().__init__(context=context, call=call)
+        super().__init__(
+            context=context,
+            call=call,
+            prefetch_count=prefetch_count,
+            max_concurrency=max_concurrency,
+            codec=codec,
+            executor=executor,
+            slow_threshold=slow_threshold,
+        )
         self.field = None
         if response_model:
             self.field = create_field(
@@ -46,30 +69,34 @@ class AmqpRpc(AmqpConsumer):
 
     async def _handle_message(
             self,
-            stack: AsyncExitStack,
             body: Any,
             message: IncomingMessage,
     ) -> None:
         reply_to = message.reply_to
         correlation_id = message.correlation_id
-        params = await self.dependant.prepare_params(
-            stack,
-            {
-                'connection': self.connection,
-                'context': self.context,
-                **body['kwargs'],
-            })
-        result = await self.dependant.call(**params)
+        result = await self.handle({
+            'connection': self.connection,
+            'context': self.context,
+            **body['kwargs'],
+        })
+        # Reply in the format of the request, which the caller understands.
+        codec = resolve_codec(message.content_type, self.codec)
         body = serialize_payload(
             field=self.field,
             payload_content=result,
+            codec=codec,
         )
         response = Message(
             body=body,
+            content_type=codec.content_type,
             correlation_id=correlation_id,
         )
+        name = self.dependant.name
+        started_at = time.perf_counter()
         await self.exchange.publish(response, reply_to)
+        started_at = observe_stage(name, 'publish', started_at)
         await message.ack()
+        observe_stage(name, 'ack', started_at)
 
 
 class AmqpRpcProxy:
@@ -77,111 +104,299 @@ class AmqpRpcProxy:
             self,
             *,
             target_service: str,
+            codec: Optional[str] = None,
+            cache: Optional[Dict[str, float]] = None,
+            cache_size: int = 1024,
+            single_flight: Union[bool, Collection[str]] = False,
     ):
         self.target_service = target_service
+        self.codec = codec
+        # Identical calls in flight at the same time share one request, for
+        # every method if True, or the methods named.
+        self.single_flight = None
+        if single_flight:
+            self.single_flight = SingleFlight(
+                target_service=target_service,
+                methods=None if single_flight is True else set(single_flight),
+            )
+        # Seconds to cache the results of each method for, by method name.
+        self.cache = None
+        if cache:
+            self.cache = RpcCache(
+                target_service=target_service,
+                ttls=cache,
+                maxsize=cache_size,
+            )
+
+    def invalidate(self, method: Optional[str] = None, **kwargs) -> None:
+        """
+        Drop cached results, of ``method`` called with ``kwargs``, of every
+        call of ``method``, or all of them.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(method, kwargs or None)
 
     async def __call__(
             self,
             connection: Connection,
             context: ServiceContext,
     ) -> AsyncGenerator[ServiceProxy, None]:
-        proxy: ServiceProxy
-        try:
-            channel = await connection.channel()
-            exchange = await channel.get_exchange(context.settings.amqp.rpc_exchange)
-            proxy = ServiceProxy(
-                channel=channel,
-                exchange=exchange,
-                service_name=context.name,
-                target_service=self.target_service,
-            )
-            yield proxy
-        finally:
-            await proxy.stop()
-            await channel.close()
+        yield ServiceProxy(
+            pool=get_channel_pool(connection, context),
+            exchange_name=context.settings.amqp.rpc_exchange,
+            reply_listener=await get_reply_listener(connection, context),
+            target_service=self.target_service,
+            codec=get_codec(self.codec or context.settings.codec),
+            tracer=context.tracer,
+            cache=self.cache,
+            single_flight=self.single_flight,
+        )
 
 
 class ServiceProxy:
     def __init__(
             self,
             *,
-            channel: Channel,
-            exchange: Exchange,
-            service_name: str,
+            pool: ChannelPool,
+            exchange_name: str,
+            reply_listener: RpcReplyListener,
             target_service: str,
+            codec: Codec,
+            tracer: Optional[Tracer] = None,
+            cache: Optional[RpcCache] = None,
+            single_flight: Optional[SingleFlight] = None,
     ):
-
-        self.channel = channel
-        self.exchange = exchange
-        self.service_name = service_name
+        self.pool = pool
+        self.exchange_name = exchange_name
+        self.reply_listener = reply_listener
         self.target_service = target_service
+        self.codec = codec
+        self.tracer = tracer
+        self.cache = cache
+        self.single_flight = single_flight
 
     def __getattr__(self, name) -> MethodProxy:
-        self.proxy = MethodProxy(
-            channel=self.channel,
-            exchange=self.exchange,
-            service_name=self.service_name,
+        return MethodProxy(
+            pool=self.pool,
+            exchange_name=self.exchange_name,
+            reply_listener=self.reply_listener,
             target_service=self.target_service,
             method_name=name,
+            codec=self.codec,
+            tracer=self.tracer,
+            cache=self.cache,
+            single_flight=self.single_flight,
         )
-        return self.proxy
-
-    async def stop(self) -> None:
-        await self.proxy.stop()
 
 
 class MethodProxy:
     def __init__(
             self,
             *,
-            channel: Channel,
-            exchange: Exchange,
-            service_name: str,
+            pool: ChannelPool,
+            exchange_name: str,
+            reply_listener: RpcReplyListener,
             target_service: str,
             method_name: str,
+            codec: Codec,
+            tracer: Optional[Tracer] = None,
+            cache: Optional[RpcCache] = None,
+            single_flight: Optional[SingleFlight] = None,
     ):
-        self.channel = channel
-        self.exchange = exchange
-        self.service_name = service_name
+        self.pool = pool
+        self.exchange_name = exchange_name
+        self.reply_listener = reply_listener
         self.target_service = target_service
         self.method_name = method_name
+        self.codec = codec
+        self.tracer = tracer
+        self.cache = cache
+        self.single_flight = single_flight
 
     async def __call__(self, **kwargs) -> Any:
-        reply_routing_key = await self.setup_reply_queue()
+        cache = self.cache
+        if cache is None or not cache.cacheable(self.method_name):
+            return await self.share(kwargs)
+
+        key = cache.key(self.method_name, kwargs)
+        result = cache.get(key)
+        if result is not MISSING:
+            RPC_CALLS.inc((self.target_service, self.method_name, 'cached'))
+            return result
+
+        generation = cache.generation
+        result = await self.share(kwargs)
+        cache.set(key, result, generation)
+        return result
+
+    async def share(self, kwargs: Dict[str, Any]) -> Any:
+        """
+        Join an identical call in flight when single flight is on.
+        """
+        single_flight = self.single_flight
+        if single_flight is None or not single_flight.shared(self.method_name):
+            return await self.request(kwargs)
+
+        result, shared = await single_flight.call(
+            self.method_name,
+            kwargs,
+            lambda: self.request(kwargs),
+        )
+        if shared:
+            RPC_CALLS.inc((self.target_service, self.method_name, 'coalesced'))
+
+        return result
+
+    def invalidate(self, **kwargs) -> None:
+        """
+        Drop the cached result of calling the method with ``kwargs``, or of
+        every call of the method without them.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self.method_name, kwargs or None)
+
+    async def request(self, kwargs: Dict[str, Any]) -> Any:
+        labels = (self.target_service, self.method_name)
+        started_at = time.perf_counter()
+        try:
+            if self.tracer is None:
+                result = await self._call(kwargs, None)
+            else:
+                with self.tracer.span(
+                        f'{self.target_service}.{self.method_name}',
+                        'client',
+                ) as span:
+                    result = await self._call(kwargs, trace_headers(span))
+        except Exception:
+            RPC_CALLS.inc((*labels, 'error'))
+            raise
+
+        RPC_CALLS.inc((*labels, 'ok'))
+        RPC_CALL_SECONDS.observe(labels, time.perf_counter() - started_at)
+        return result
+
+    async def _call(self, kwargs: Dict[str, Any], headers: Optional[Dict[str, Any]]) -> Any:
         body = serialize_payload(
             field=None,
             payload_content={'kwargs': kwargs},
+            codec=self.codec,
         )
-        self.correlation_id = str(uuid.uuid4())
+        correlation_id = str(uuid.uuid4())
+        response = self.reply_listener.expect(correlation_id)
         message = Message(
             body=body,
-            reply_to=reply_routing_key,
-            correlation_id=self.correlation_id,
-        )
-        self.response: asyncio.Future = asyncio.Future()
-        await self.exchange.publish(message, RPC_ROUTING_KEY.format(self.target_service, self.method_name))
-
-        await self.response
-        return self.response.result()
-
-    async def setup_reply_queue(self) -> str:
-        reply_routing_key = str(uuid.uuid4())
-        reply_queue_name = RPC_REPLY_QUEUE.format(self.service_name, reply_routing_key)
-        self.reply_queue = await self.channel.declare_queue(
-            reply_queue_name,
-            auto_delete=True,
+            content_type=self.codec.content_type,
+            reply_to=self.reply_listener.routing_key,
+            correlation_id=correlation_id,
+            headers=headers,
         )
-        await self.reply_queue.bind(self.exchange, reply_routing_key)
-        self.consumer_tag = await self.reply_queue.consume(self.handle_message)
-        return reply_routing_key
+        try:
+            async with self.pool.acquire() as channel:
+                exchange = await channel.get_exchange(self.exchange_name)
+                await exchange.publish(
+                    message,
+                    RPC_ROUTING_KEY.format(self.target_service, self.method_name),
+                )
+
+            return await response
+        finally:
+            self.reply_listener.discard(correlation_id)
+
+
+class RpcReplyListener:
+    """
+    A single reply queue shared by every rpc call made over a connection.
+
+    Replies are matched to the waiting caller by their correlation id.
+    """
+
+    def __init__(
+            self,
+            *,
+            connection: Connection,
+            context: ServiceContext,
+    ):
+        self.connection = connection
+        self.context = context
+        self.routing_key = str(uuid.uuid4())
+        self.responses: Dict[str, asyncio.Future] = {}
+        self.codec = get_codec(context.settings.codec)
+        self.consumer_tag: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        if self.consumer_tag is not None:
+            return
+
+        async with self._lock:
+            if self.consumer_tag is not None:
+                return
+
+            self.channel: Channel = await self.connection.channel()
+            exchange = await self.channel.get_exchange(
+                self.context.settings.amqp.rpc_exchange,
+            )
+            self.queue: Queue = await self.channel.declare_queue(
+                RPC_REPLY_QUEUE.format(self.context.name, self.routing_key),
+                exclusive=True,
+                auto_delete=True,
+            )
+            await self.queue.bind(exchange, self.routing_key)
+            self.consumer_tag = await self.queue.consume(
+                self.handle_message,
+                no_ack=True,
+            )
+
+    def expect(self, correlation_id: str) -> asyncio.Future:
+        response = asyncio.get_running_loop().create_future()
+        self.responses[correlation_id] = response
+        return response
+
+    def discard(self, correlation_id: str) -> None:
+        self.responses.pop(correlation_id, None)
 
     async def handle_message(self, message: IncomingMessage) -> None:
-        body = json.loads(message.body)
-        if message.correlation_id == self.correlation_id:
-            self.response.set_result(body)
+        response = self.responses.pop(message.correlation_id, None)
+        if response is None or response.done():
+            logger.debug(
+                'Dropping rpc reply with unknown correlation id %s',
+                message.correlation_id,
+            )
+            return
 
-        await message.ack()
+        codec = resolve_codec(message.content_type, self.codec)
+        response.set_result(codec.decode(message.body))
 
     async def stop(self) -> None:
-        await self.reply_queue.cancel(self.consumer_tag)
-        await self.reply_queue.delete()
+        if self.consumer_tag is None:
+            return
+
+        await self.queue.cancel(self.consumer_tag)
+        await self.queue.delete()
+        await self.channel.close()
+        self.consumer_tag = None
+
+
+_reply_listeners: WeakKeyDictionary = WeakKeyDictionary()
+
+
+async def get_reply_listener(
+        connection: Connection,
+        context: ServiceContext,
+) -> RpcReplyListener:
+    try:
+        reply_listener = _reply_listeners[connection]
+    except KeyError:
+        reply_listener = _reply_listeners[connection] = RpcReplyListener(
+            connection=connection,
+            context=context,
+        )
+
+    await reply_listener.start()
+    return reply_listener
+
+
+async def close_reply_listener(connection: Connection) -> None:
+    reply_listener = _reply_listeners.pop(connection, None)
+    if reply_listener is not None:
+        await reply_listener.stop()
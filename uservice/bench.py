@@ -0,0 +1,422 @@
+"""
+Load generation for ``uservice bench``.
+"""
+import asyncio
+import datetime
+import decimal
+import enum
+import inspect
+import statistics
+import time
+import uuid
+
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Union,
+)
+
+from aio_pika import Connection, Message
+from pydantic import BaseModel
+from pydantic.typing import get_args, get_origin
+
+from .amqp.events import AmqpEventHandler
+from .amqp.rpc import AmqpRpc, AmqpRpcProxy
+from .codecs import get_codec
+from .contexts import ServiceContext
+from .entrypoints import Entrypoint
+from .service import Service
+
+
+class BenchError(Exception):
+    pass
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, Any]:
+    """
+    Throughput and latency percentiles, in milliseconds, of ``latencies``
+    measured over ``elapsed`` seconds.
+    """
+    summary: Dict[str, Any] = {
+        'messages': len(latencies),
+        'seconds': round(elapsed, 6),
+        'messages_per_second': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+    if len(latencies) < 2:
+        latencies = latencies * 2 or [0.0, 0.0]
+
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    for percentile in (50, 90, 99):
+        summary[f'p{percentile}_ms'] = round(quantiles[percentile - 1] * 1000, 3)
+
+    summary['max_ms'] = round(max(latencies) * 1000, 3)
+    return summary
+
+
+def generate_value(annotation: Any, index: int, *, name: str = 'value', list_size: int = 3) -> Any:
+    """
+    A json value that validates as ``annotation``, varied by ``index``.
+    Constraints of pydantic constrained types are respected, validators
+    are not.
+    """
+    if annotation is inspect.Signature.empty or annotation is Any:
+        return f'{name}-{index}'
+
+    origin = get_origin(annotation)
+    if origin is Union:
+        args = [arg for arg in get_args(annotation) if arg is not type(None)]
+        return generate_value(args[0], index, name=name, list_size=list_size)
+
+    if origin is Literal:
+        return get_args(annotation)[0]
+
+    if origin in (list, set, frozenset, tuple):
+        args = get_args(annotation)
+        if origin is tuple and args and args[-1] is not Ellipsis:
+            return [
+                generate_value(arg, index, name=name, list_size=list_size)
+                for arg in args
+            ]
+
+        item = args[0] if args else Any
+        # Constrained lists and sets limit their size.
+        size = max(list_size, getattr(annotation, 'min_items', None) or 0)
+        size = min(size, getattr(annotation, 'max_items', None) or size)
+        if origin in (set, frozenset):
+            # Items of a set have to differ.
+            return [
+                generate_value(item, index * size + idx, name=name, list_size=list_size)
+                for idx in range(size)
+            ]
+
+        return [
+            generate_value(item, index, name=name, list_size=list_size)
+            for _idx in range(size)
+        ]
+
+    if origin is dict:
+        key, value = get_args(annotation) or (str, Any)
+        return {
+            generate_value(key, idx, name=name, list_size=list_size):
+                generate_value(value, index, name=name, list_size=list_size)
+            for idx in range(list_size)
+        }
+
+    if not inspect.isclass(annotation):
+        return f'{name}-{index}'
+
+    if issubclass(annotation, BaseModel):
+        return generate_payload(annotation, index, list_size=list_size)
+
+    if issubclass(annotation, enum.Enum):
+        members = list(annotation)
+        return members[index % len(members)].value
+
+    if issubclass(annotation, bool):
+        return index % 2 == 0
+
+    if issubclass(annotation, int):
+        return _bounded(annotation, index)
+
+    if issubclass(annotation, (float, decimal.Decimal)):
+        return float(_bounded(annotation, index))
+
+    if issubclass(annotation, str):
+        return _sized_string(annotation, f'{name}-{index}')
+
+    if issubclass(annotation, bytes):
+        return _sized_string(annotation, f'{name}-{index}')
+
+    if issubclass(annotation, datetime.datetime):
+        return datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).isoformat()
+
+    if issubclass(annotation, datetime.date):
+        return datetime.date(2024, 1, 1).isoformat()
+
+    if issubclass(annotation, uuid.UUID):
+        return str(uuid.UUID(int=index))
+
+    if issubclass(annotation, dict):
+        return {'index': index}
+
+    if issubclass(annotation, (list, tuple, set)):
+        return [index] * list_size
+
+    return f'{name}-{index}'
+
+
+def _bounded(annotation: Any, index: int) -> int:
+    lower = getattr(annotation, 'ge', None)
+    if lower is None and getattr(annotation, 'gt', None) is not None:
+        lower = int(annotation.gt) + 1
+
+    upper = getattr(annotation, 'le', None)
+    if upper is None and getattr(annotation, 'lt', None) is not None:
+        upper = int(annotation.lt) - 1
+
+    lower = int(lower) if lower is not None else 0
+    if upper is None:
+        return lower + index
+
+    return lower + index % max(int(upper) - lower + 1, 1)
+
+
+def _sized_string(annotation: Any, value: str) -> str:
+    min_length = getattr(annotation, 'min_length', None) or 0
+    max_length = getattr(annotation, 'max_length', None)
+    value = value.ljust(min_length, 'x')
+    if max_length is not None:
+        value = value[-max_length:]
+
+    return value
+
+
+def generate_payload(model: Any, index: int, *, list_size: int = 3) -> Any:
+    """
+    A json payload for the pydantic ``model``, or any other annotation.
+    """
+    if not (inspect.isclass(model) and issubclass(model, BaseModel)):
+        if model in (inspect.Signature.empty, dict, Any):
+            return {'index': index}
+
+        return generate_value(model, index, name='payload', list_size=list_size)
+
+    return {
+        field.alias: generate_value(
+            field.outer_type_,
+            index,
+            name=field.name,
+            list_size=list_size,
+        )
+        for field in model.__fields__.values()
+    }
+
+
+def validate_payload(model: Any, payload: Any) -> None:
+    if inspect.isclass(model) and issubclass(model, BaseModel):
+        model.parse_obj(payload)
+
+
+class LoadGenerator:
+    """
+    Calls ``send`` with the index of every message, at ``rate`` messages a
+    second or as fast as possible, with at most ``concurrency`` in flight,
+    until ``messages`` were sent or ``duration`` seconds passed.
+    """
+
+    def __init__(
+            self,
+            send: Callable[[int], Awaitable[Any]],
+            *,
+            rate: Optional[float] = None,
+            concurrency: int = 100,
+            messages: Optional[int] = None,
+            duration: Optional[float] = None,
+            timeout: float = 30.0,
+    ):
+        if messages is None and duration is None:
+            raise BenchError('Either the number of messages or a duration is needed')
+
+        self.send = send
+        self.rate = rate
+        self.concurrency = concurrency
+        self.messages = messages
+        self.duration = duration
+        self.timeout = timeout
+        self.latencies: List[float] = []
+        self.errors: Counter = Counter()
+        # Sends that started later than scheduled because of the
+        # concurrency limit.
+        self.late = 0
+
+    async def run(self) -> Dict[str, Any]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        started_at = time.perf_counter()
+        index = 0
+        while self.messages is None or index < self.messages:
+            scheduled_at = started_at + index / self.rate if self.rate else None
+            now = time.perf_counter()
+            if self.duration is not None and now - started_at >= self.duration:
+                break
+
+            if scheduled_at is not None and scheduled_at > now:
+                await asyncio.sleep(scheduled_at - now)
+
+            await semaphore.acquire()
+            if scheduled_at is not None and time.perf_counter() - scheduled_at > 0.01:
+                self.late += 1
+
+            task = asyncio.create_task(self.call(index))
+            task.add_done_callback(lambda _task: semaphore.release())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            index += 1
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+        elapsed = time.perf_counter() - started_at
+        return {
+            'sent': index,
+            **summarize(self.latencies, elapsed),
+            'errors': sum(self.errors.values()),
+            'error_types': dict(self.errors),
+            'late': self.late,
+        }
+
+    async def call(self, index: int) -> None:
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.send(index), self.timeout)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+        else:
+            self.latencies.append(time.perf_counter() - started_at)
+
+
+def find_entrypoint(entrypoints: List[Entrypoint], name: Optional[str]) -> Entrypoint:
+    names = [entrypoint.dependant.name for entrypoint in entrypoints]
+    if name is None:
+        if len(entrypoints) == 1:
+            return entrypoints[0]
+
+        raise BenchError(
+            f'The service has {len(entrypoints)} entrypoints, pick one of '
+            f'{", ".join(names)}'
+        )
+
+    for entrypoint in entrypoints:
+        if entrypoint.dependant.name == name:
+            return entrypoint
+
+    raise BenchError(f'No entrypoint "{name}", pick one of {", ".join(names)}')
+
+
+def make_event_payload(entrypoint: AmqpEventHandler, index: int, list_size: int) -> Any:
+    return generate_payload(entrypoint.payload_type, index, list_size=list_size)
+
+
+def make_rpc_kwargs(entrypoint: AmqpRpc, index: int, list_size: int) -> Dict[str, Any]:
+    # Arguments given by the service itself are not sent by callers.
+    return {
+        name: generate_value(param.annotation, index, name=name, list_size=list_size)
+        for name, param in entrypoint.dependant.required_params.items()
+        if name not in ('connection', 'context')
+    }
+
+
+def event_routing_key(binding_key: str) -> str:
+    """
+    A routing key that matches the topic binding of an event handler.
+    """
+    return '.'.join(
+        'bench' if word in ('*', '#') else word
+        for word in binding_key.split('.')
+    )
+
+
+@asynccontextmanager
+async def event_sender(
+        connection: Connection,
+        entrypoint: AmqpEventHandler,
+        *,
+        payload: Any = None,
+        list_size: int = 3,
+        codec: Optional[str] = None,
+) -> AsyncIterator[Callable[[int], Awaitable[Any]]]:
+    """
+    Publishes events to the exchange the handler consumes from, confirmed
+    by the broker. ``payload`` is sent every time if given, otherwise one
+    is generated from the payload type of the handler.
+    """
+    codec_ = get_codec(codec or entrypoint.context.settings.codec)
+    routing_key = event_routing_key(entrypoint.get_routing_key())
+    channel = await connection.channel()
+    try:
+        exchange = await channel.get_exchange(entrypoint.get_exchange_name())
+
+        async def send(index: int) -> None:
+            body = payload
+            if body is None:
+                body = make_event_payload(entrypoint, index, list_size)
+
+            await exchange.publish(
+                Message(codec_.encode(body), content_type=codec_.content_type),
+                routing_key,
+            )
+
+        yield send
+    finally:
+        await channel.close()
+
+
+@asynccontextmanager
+async def rpc_sender(
+        connection: Connection,
+        entrypoint: AmqpRpc,
+        *,
+        payload: Any = None,
+        list_size: int = 3,
+        codec: Optional[str] = None,
+) -> AsyncIterator[Callable[[int], Awaitable[Any]]]:
+    """
+    Calls the rpc and waits for the reply. ``payload`` holds the keyword
+    arguments of every call if given, otherwise they are generated from the
+    annotations of the rpc.
+    """
+    context = ServiceContext(
+        name=f'{entrypoint.context.name}-bench',
+        settings=entrypoint.context.settings,
+    )
+    proxy_dependency = AmqpRpcProxy(
+        target_service=entrypoint.context.name,
+        codec=codec,
+    )
+    async with asynccontextmanager(proxy_dependency)(connection, context) as proxy:
+        method = getattr(proxy, entrypoint.dependant.name)
+
+        async def send(index: int) -> Any:
+            kwargs = payload
+            if kwargs is None:
+                kwargs = make_rpc_kwargs(entrypoint, index, list_size)
+
+            return await method(**kwargs)
+
+        yield send
+
+
+async def start_service(service: Service) -> asyncio.Task:
+    """
+    Run ``service`` in the background and return once it consumes.
+    """
+    task = asyncio.create_task(service.run())
+    started = asyncio.create_task(service.started.wait())
+    await asyncio.wait((task, started), return_when=asyncio.FIRST_COMPLETED)
+    if task.done():
+        started.cancel()
+        task.result()
+
+    return task
+
+
+async def stop_service(service: Service, task: asyncio.Task) -> None:
+    service.handle_exit(None, None)
+    await task
+
+
+async def get_queue_depth(connection: Connection, queue_name: str) -> int:
+    channel = await connection.channel()
+    try:
+        queue = await channel.declare_queue(queue_name, passive=True)
+        return queue.declaration_result.message_count
+    finally:
+        await channel.close()
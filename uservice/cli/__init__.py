@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import click
 
+from .bench import bench
 from .run import run
 
 
@@ -11,4 +12,5 @@ def group():
 
 def cli():
     group.add_command(run)
+    group.add_command(bench)
     group()
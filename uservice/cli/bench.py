@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import time
+
+from typing import Any, Dict, Optional
+
+import click
+import uvloop
+
+from aio_pika.exceptions import ChannelNotFoundEntity
+from pydantic import ValidationError
+
+from uservice.amqp.events import AmqpEventHandler
+from uservice.bench import (
+    BenchError,
+    LoadGenerator,
+    event_sender,
+    find_entrypoint,
+    generate_payload,
+    get_queue_depth,
+    rpc_sender,
+    start_service,
+    stop_service,
+    validate_payload,
+)
+from uservice.importer import import_from_string
+from uservice.service import Service
+from uservice.transport import MEMORY_BACKEND, connect
+
+
+logger = logging.getLogger('uservice')
+
+# Seconds between checks of the queue while the service catches up.
+DRAIN_POLL_INTERVAL = 0.1
+
+
+@click.command()
+@click.argument("service")
+@click.option(
+    "--entrypoint",
+    default=None,
+    help="Name of the event handler or rpc to call. Needed if the service has more than one.",
+)
+@click.option(
+    "--rate",
+    default=None,
+    type=float,
+    help="Messages per second to send. As fast as --concurrency allows by default.",
+)
+@click.option(
+    "--concurrency",
+    default=100,
+    type=int,
+    show_default=True,
+    help="Most messages waiting for a confirm or reply at once.",
+)
+@click.option("--messages", default=None, type=int, help="Number of messages to send.")
+@click.option(
+    "--duration",
+    default=None,
+    type=float,
+    help="Seconds to send for. 10 seconds if --messages is not given either.",
+)
+@click.option(
+    "--payload",
+    "payload_path",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Json file with the payload, or the rpc arguments, sent every time. "
+         "Generated from the annotations of the entrypoint by default.",
+)
+@click.option(
+    "--list-size",
+    default=3,
+    type=int,
+    show_default=True,
+    help="Number of items in generated lists, sets and dicts.",
+)
+@click.option("--codec", default=None, help="Codec to send with, the codec setting by default.")
+@click.option(
+    "--timeout",
+    default=30.0,
+    type=float,
+    show_default=True,
+    help="Seconds before a message without confirm or reply counts as an error.",
+)
+@click.option(
+    "--drain-timeout",
+    default=60.0,
+    type=float,
+    show_default=True,
+    help="Seconds to wait for the service to empty the queue of an event handler.",
+)
+@click.option("--output", default=None, type=click.Path(dir_okay=False), help="Write the report as json.")
+def bench(
+        service: str,
+        *,
+        entrypoint: Optional[str],
+        rate: Optional[float],
+        concurrency: int,
+        messages: Optional[int],
+        duration: Optional[float],
+        payload_path: Optional[str],
+        list_size: int,
+        codec: Optional[str],
+        timeout: float,
+        drain_timeout: float,
+        output: Optional[str],
+):
+    """
+    Send events or rpc calls to a running SERVICE and report the throughput,
+    latency and errors. Events are generated from the payload type of the
+    handler, rpc calls from the annotations of the rpc.
+    """
+    loaded_service: Service = import_from_string(service)
+    payload = None
+    if payload_path:
+        with open(payload_path) as f:
+            payload = json.load(f)
+
+    if messages is None and duration is None:
+        duration = 10.0
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        report = asyncio.run(run_bench(
+            loaded_service,
+            entrypoint_name=entrypoint,
+            payload=payload,
+            list_size=list_size,
+            codec=codec,
+            drain_timeout=drain_timeout,
+            load_options={
+                'rate': rate,
+                'concurrency': concurrency,
+                'messages': messages,
+                'duration': duration,
+                'timeout': timeout,
+            },
+        ))
+    except BenchError as e:
+        raise click.ClickException(str(e))
+
+    print_report(report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+async def run_bench(
+        service: Service,
+        *,
+        entrypoint_name: Optional[str],
+        payload: Any,
+        list_size: int,
+        codec: Optional[str],
+        drain_timeout: float,
+        load_options: Dict[str, Any],
+) -> Dict[str, Any]:
+    entrypoint = find_entrypoint(service.entrypoints, entrypoint_name)
+    is_event = isinstance(entrypoint, AmqpEventHandler)
+    if is_event and payload is None:
+        try:
+            validate_payload(
+                entrypoint.payload_type,
+                generate_payload(entrypoint.payload_type, 0, list_size=list_size),
+            )
+        except ValidationError as e:
+            raise BenchError(
+                f'Could not generate a valid payload for {entrypoint.dependant.name}, '
+                f'give one with --payload:\n{e}'
+            )
+
+    settings = service.context.settings
+    task = None
+    if settings.communication_backend == MEMORY_BACKEND:
+        # Only services in this process are reachable on the memory broker.
+        logger.info(f'Starting {service.context.name} on the memory broker')
+        task = await start_service(service)
+
+    connection = await connect(settings)
+    try:
+        async with connection:
+            queue_name = entrypoint.get_queue_name()
+            try:
+                await get_queue_depth(connection, queue_name)
+            except ChannelNotFoundEntity:
+                raise BenchError(
+                    f'The queue {queue_name} does not exist, is the service running?'
+                ) from None
+
+            sender = event_sender if is_event else rpc_sender
+            async with sender(
+                    connection,
+                    entrypoint,
+                    payload=payload,
+                    list_size=list_size,
+                    codec=codec,
+            ) as send:
+                started_at = time.perf_counter()
+                report = await LoadGenerator(send, **load_options).run()
+
+            report = {
+                'service': service.context.name,
+                'entrypoint': entrypoint.dependant.name,
+                'kind': 'event' if is_event else 'rpc',
+                'rate': load_options['rate'],
+                'concurrency': load_options['concurrency'],
+                **report,
+            }
+            if is_event:
+                report['handled'] = await wait_for_queue(
+                    connection,
+                    queue_name,
+                    started_at,
+                    report['messages'],
+                    drain_timeout,
+                )
+    finally:
+        if task is not None:
+            await stop_service(service, task)
+
+    return report
+
+
+async def wait_for_queue(
+        connection,
+        queue_name: str,
+        started_at: float,
+        messages: int,
+        timeout: float,
+) -> Dict[str, Any]:
+    """
+    Wait for the service to empty the queue and return the rate it handled
+    the events at since the first was sent.
+    """
+    deadline = time.perf_counter() + timeout
+    while True:
+        depth = await get_queue_depth(connection, queue_name)
+        now = time.perf_counter()
+        if not depth or now >= deadline:
+            break
+
+        await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+    elapsed = now - started_at
+    handled = messages - depth
+    return {
+        'messages': handled,
+        'waiting': depth,
+        'seconds': round(elapsed, 6),
+        'messages_per_second': round(handled / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    verb = 'published' if report['kind'] == 'event' else 'called'
+    click.echo(
+        f"{report['service']}.{report['entrypoint']}: {verb} {report['messages']} "
+        f"of {report['sent']} in {report['seconds']:.2f}s, "
+        f"{report['messages_per_second']:.1f} msg/s"
+    )
+    click.echo(
+        f"  latency p50 {report['p50_ms']:.3f} ms, p90 {report['p90_ms']:.3f} ms, "
+        f"p99 {report['p99_ms']:.3f} ms, max {report['max_ms']:.3f} ms"
+    )
+    errors = ', '.join(
+        f'{count} {name}' for name, count in report['error_types'].items()
+    )
+    click.echo(f"  errors {report['errors']}" + (f" ({errors})" if errors else ""))
+    if report['late']:
+        click.echo(f"  {report['late']} messages were sent late, raise --concurrency")
+
+    handled = report.get('handled')
+    if handled is not None:
+        click.echo(
+            f"  handled {handled['messages']} in {handled['seconds']:.2f}s, "
+            f"{handled['messages_per_second']:.1f} msg/s, "
+            f"{handled['waiting']} still waiting"
+        )
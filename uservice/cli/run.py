@@ -1,5 +1,7 @@
 import logging
 
+from typing import Optional
+
 import click
 
 from uservice.runner import ServiceRunner
@@ -19,11 +21,77 @@ logger = logging.getLogger('uservice')
     show_default=True,
     help="Number of worker processes. Not valid with --reload"
 )
+@click.option(
+    "--preload",
+    is_flag=True,
+    default=False,
+    help="Import the service once and fork the workers from it. Not valid with --reload",
+)
+@click.option(
+    "--heartbeat-timeout",
+    default=30.0,
+    type=float,
+    show_default=True,
+    help="Seconds a worker may go without a heartbeat before it is killed and restarted.",
+)
+@click.option(
+    "--min-workers",
+    default=None,
+    type=int,
+    help="Least number of worker processes when autoscaling. Defaults to --workers.",
+)
+@click.option(
+    "--max-workers",
+    default=None,
+    type=int,
+    help="Most number of worker processes when autoscaling. Defaults to --workers.",
+)
+@click.option(
+    "--backlog-per-worker",
+    default=100,
+    type=int,
+    show_default=True,
+    help="Messages waiting per worker above which a worker is added.",
+)
+@click.option(
+    "--scale-cooldown",
+    default=30.0,
+    type=float,
+    show_default=True,
+    help="Seconds between adding or removing workers.",
+)
+@click.option(
+    "--max-messages-per-worker",
+    default=None,
+    type=int,
+    help="Replace a worker after it handled this many messages, give or take 10%.",
+)
+@click.option(
+    "--max-worker-rss",
+    default=None,
+    type=int,
+    help="Replace a worker once it uses more than this many megabytes, give or take 10%.",
+)
+@click.option(
+    "--metrics-port",
+    default=None,
+    type=int,
+    help="Serve the Prometheus metrics of all workers added up on this port.",
+)
 def run(
         service: str,
         *,
         reload: bool,
         workers: int,
+        preload: bool,
+        heartbeat_timeout: float,
+        min_workers: Optional[int],
+        max_workers: Optional[int],
+        backlog_per_worker: int,
+        scale_cooldown: float,
+        max_messages_per_worker: Optional[int],
+        max_worker_rss: Optional[int],
+        metrics_port: Optional[int],
 ):
 
     if workers > 1 and reload:
@@ -31,10 +99,42 @@ def run(
             "Can not have --reload and more than 1 workers at the same time."
         )
 
-    runner = ServiceRunner(service_str=service)
+    if preload and reload:
+        logger.warning(
+            "Can not have --reload and --preload at the same time."
+        )
+
+    runner = ServiceRunner(
+        service_str=service,
+        max_messages=max_messages_per_worker,
+        max_rss=max_worker_rss,
+        metrics_port=metrics_port,
+    )
+    scaling = {
+        "min_workers": min_workers,
+        "max_workers": max_workers,
+        "backlog_per_worker": backlog_per_worker,
+        "scale_cooldown": scale_cooldown,
+        "metrics_port": metrics_port,
+    }
 
     if reload:
         ChangeReloader(runner.run).run()
 
+    elif preload:
+        runner.preload()
+        Multiprocess(
+            runner.run,
+            workers,
+            start_method="fork",
+            heartbeat_timeout=heartbeat_timeout,
+            **scaling,
+        ).run()
+
     else:
-        Multiprocess(runner.run, workers).run()
+        Multiprocess(
+            runner.run,
+            workers,
+            heartbeat_timeout=heartbeat_timeout,
+            **scaling,
+        ).run()
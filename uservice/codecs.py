@@ -0,0 +1,129 @@
+import json
+
+from functools import lru_cache
+from typing import Any, Dict, Optional, Type
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec:
+    content_type: str
+
+    def encode(self, data: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, body: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    content_type = 'application/json'
+
+    def encode(self, data: Any) -> bytes:
+        return json.dumps(data).encode()
+
+    def decode(self, body: bytes) -> Any:
+        return json.loads(body)
+
+
+class OrjsonCodec(Codec):
+    content_type = 'application/json'
+
+    def __init__(self):
+        if orjson is None:
+            raise CodecError(
+                'The "orjson" codec requires orjson, install it with '
+                '"pip install uservice[orjson]"'
+            )
+
+    def encode(self, data: Any) -> bytes:
+        return orjson.dumps(data)
+
+    def decode(self, body: bytes) -> Any:
+        return orjson.loads(body)
+
+
+class MsgpackCodec(Codec):
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise CodecError(
+                'The "msgpack" codec requires msgpack, install it with '
+                '"pip install uservice[msgpack]"'
+            )
+
+    def encode(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, body: bytes) -> Any:
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS: Dict[str, Type[Codec]] = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+# Codec used to decode a message with the given content type, when it does
+# not match the content type of the codec preferred by the receiver.
+CONTENT_TYPES: Dict[str, str] = {
+    'application/json': 'json',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+}
+
+# Messages without a content type are from publishers that predate codecs,
+# which always sent json.
+DEFAULT_CONTENT_TYPE = 'application/json'
+
+
+def register_codec(
+        name: str,
+        codec: Type[Codec],
+        *,
+        content_types: tuple = (),
+) -> None:
+    CODECS[name] = codec
+    for content_type in content_types or (codec.content_type,):
+        CONTENT_TYPES.setdefault(content_type, name)
+
+    get_codec.cache_clear()
+
+
+@lru_cache()
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise CodecError(f'Unknown codec "{name}"') from None
+
+
+def resolve_codec(content_type: Optional[str], preferred: Codec) -> Codec:
+    """
+    Return the codec to decode a message with the given content type,
+    preferring the receivers own codec when it handles that content type.
+    """
+    content_type = content_type or DEFAULT_CONTENT_TYPE
+    if content_type == preferred.content_type:
+        return preferred
+
+    try:
+        return get_codec(CONTENT_TYPES[content_type])
+    except KeyError:
+        raise CodecError(
+            f'No codec registered for content type "{content_type}"'
+        ) from None
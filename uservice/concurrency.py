@@ -0,0 +1,55 @@
+import asyncio
+import contextvars
+import functools
+import importlib
+import inspect
+import os
+
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, Optional
+
+
+async def run_in_threadpool(func: Callable, **kwargs) -> Any:
+    """
+    Run a blocking callable in the default executor of the event loop,
+    which the service sets up as its thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, **kwargs)
+    return await loop.run_in_executor(None, call)
+
+
+async def run_in_process(
+        executor: Optional[Executor],
+        func: Callable,
+        kwargs: Dict[str, Any],
+) -> Any:
+    """
+    Run a callable in a process pool. The callable and its arguments are
+    pickled, so both have to be importable or plain data.
+    """
+    if executor is None:
+        # The default executor of the loop is the thread pool, which would
+        # quietly run the callable in this process.
+        raise RuntimeError(
+            f'No process pool to run "{func.__qualname__}" in, '
+            'it is set up when the service starts'
+        )
+
+    loop = asyncio.get_running_loop()
+    call = functools.partial(_call_in_process, func, kwargs)
+    return await loop.run_in_executor(executor, call)
+
+
+def _call_in_process(func: Callable, kwargs: Dict[str, Any]) -> Any:
+    result = func(**kwargs)
+    if inspect.iscoroutine(result):
+        return asyncio.run(result)
+
+    return result
+
+
+def warm_up_process(module_name: str) -> int:
+    importlib.import_module(module_name)
+    return os.getpid()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
+from concurrent.futures import Executor
+from typing import Any, Dict, Hashable, Optional
 from pydantic import BaseSettings
 
+from .tracing import Tracer
+
 
 class ServiceContext:
     def __init__(
@@ -10,3 +14,9 @@ class ServiceContext:
     ):
         self.name = name
         self.settings = settings
+        # Values of the service scoped dependencies, set up by the service.
+        self.dependencies: Dict[Hashable, Any] = {}
+        # Pool for entrypoints with executor="process", set up by the service.
+        self.process_pool: Optional[Executor] = None
+        # Set up by the service when the tracing.exporter setting is given.
+        self.tracer: Optional[Tracer] = None
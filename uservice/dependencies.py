@@ -1,26 +1,61 @@
 import asyncio
 import functools
 import inspect
-from typing import Callable, Dict, List, Any, Annotated
+from typing import Callable, Dict, List, Any, Annotated, Optional, Tuple, Hashable
 from contextlib import asynccontextmanager, AsyncExitStack
 from pydantic.typing import get_origin, get_args
 
+from .concurrency import run_in_threadpool
+
+
+MESSAGE_SCOPE = 'message'
+SERVICE_SCOPE = 'service'
+SCOPES = (MESSAGE_SCOPE, SERVICE_SCOPE)
+
+
+class DependencyError(Exception):
+    pass
+
 
 class Depends:
-    def __init__(self, dependency: Callable):
+    def __init__(
+            self,
+            dependency: Callable,
+            *,
+            use_cache: bool = True,
+            scope: str = MESSAGE_SCOPE,
+    ):
+        if scope not in SCOPES:
+            raise ValueError(
+                f'Dependency scope must be one of {", ".join(SCOPES)}, not "{scope}"'
+            )
+
         self.dependency = dependency
+        self.use_cache = use_cache
+        self.scope = scope
 
 
 class Dependant:
-    def __init__(self, *, call: Callable):
+    def __init__(
+            self,
+            *,
+            call: Callable,
+            use_cache: bool = True,
+            scope: str = MESSAGE_SCOPE,
+    ):
         self.call = call
+        self.use_cache = use_cache
+        self.scope = scope
         self.params = inspect.signature(call).parameters
         self.required_params = {}
-        self.dependencies = {}
+        self.dependencies: Dict[str, Dependant] = {}
         for param_name, param in self.params.items():
             if isinstance(param.default, Depends):
-                call = param.default.dependency
-                self.dependencies[param_name] = Dependant(call=call)
+                self.dependencies[param_name] = Dependant(
+                    call=param.default.dependency,
+                    use_cache=param.default.use_cache,
+                    scope=param.default.scope,
+                )
 
             elif (
                     param.annotation is not inspect.Signature.empty
@@ -28,48 +63,200 @@ class Dependant:
             ):
                 annotation = get_args(param.annotation)[1]
                 if isinstance(annotation, Depends):
-                    call = annotation.dependency
-                    self.dependencies[param_name] = Dependant(call=call)
+                    self.dependencies[param_name] = Dependant(
+                        call=annotation.dependency,
+                        use_cache=annotation.use_cache,
+                        scope=annotation.scope,
+                    )
             elif param.default is inspect.Signature.empty:
                 self.required_params[param_name] = param
 
+        self.param_names: Tuple[str, ...] = tuple(self.required_params)
+        self.dependency_keys: Tuple[Tuple[str, Hashable], ...] = tuple(
+            (param_name, dependency.cache_key)
+            for param_name, dependency in self.dependencies.items()
+        )
+        self.plan = compile_plan(self)
+        self.needs_stack = any(
+            dependency.is_async_gen and not dependency.is_service_scoped
+            for dependency in self.plan
+        )
+
+    @property
+    def call(self) -> Callable:
+        return self._call
+
+    @call.setter
+    def call(self, call: Callable) -> None:
+        self._call = call
+        self.is_async_gen = is_async_gen_callable(call)
+        self.is_async = not self.is_async_gen and is_async_callable(call)
+        if self.is_async_gen:
+            self.context_manager = asynccontextmanager(call)
+
     @property
     def name(self):
-        return self.call.__name__
-
-    async def prepare_params(self, stack: AsyncExitStack, params: Dict[str, Any]):
-        _params = {}
-        for param in self.required_params:
-            _params[param] = params[param]
-
-        _params.update(
-            await solve_dependencies(
-                stack=stack,
-                params=params,
-                dependencies=self.dependencies,
-            )
+        return getattr(self.call, '__name__', type(self.call).__name__)
+
+    @property
+    def is_service_scoped(self) -> bool:
+        return self.scope == SERVICE_SCOPE
+
+    @property
+    def cache_key(self) -> Hashable:
+        # By scope as well, the same callable can be a dependency per
+        # message in one place and per service in another.
+        if self.use_cache or self.is_service_scoped:
+            return (self.call, self.scope)
+
+        return self
+
+    def get_kwargs(self, params: Dict[str, Any], values: Dict[Hashable, Any]):
+        kwargs = {name: params[name] for name in self.param_names}
+        for param_name, key in self.dependency_keys:
+            kwargs[param_name] = values[key]
+
+        return kwargs
+
+    async def prepare_params(
+            self,
+            stack: Optional[AsyncExitStack],
+            params: Dict[str, Any],
+            scoped: Optional[Dict[Hashable, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Resolve the dependencies and return the arguments to call with.
+
+        ``stack`` may only be ``None`` when ``needs_stack`` is false.
+        ``scoped`` holds the values of service scoped dependencies, see
+        ``solve_service_dependencies``.
+        """
+        values = await solve_dependencies(
+            stack=stack,
+            params=params,
+            plan=self.plan,
+            scoped=scoped,
         )
-        return _params
+        return self.get_kwargs(params, values)
+
+
+def compile_plan(dependant: Dependant) -> List[Dependant]:
+    """
+    Flatten the dependency tree into the order it has to be resolved in,
+    every dependency after its own dependencies. Cached dependencies that
+    are used more than once are only resolved once. The dependencies of
+    service scoped dependencies are left out, they are resolved on setup.
+    """
+    plan: List[Dependant] = []
+    planned = set()
+
+    def visit(dependant: Dependant) -> None:
+        for dependency in dependant.dependencies.values():
+            if dependency.cache_key in planned:
+                continue
+
+            if not dependency.is_service_scoped:
+                visit(dependency)
+
+            planned.add(dependency.cache_key)
+            plan.append(dependency)
+
+    visit(dependant)
+    return plan
 
 
 async def solve_dependencies(
+        *,
+        stack: Optional[AsyncExitStack],
+        params: Dict[str, Any],
+        plan: List[Dependant],
+        scoped: Optional[Dict[Hashable, Any]] = None,
+) -> Dict[Hashable, Any]:
+    values: Dict[Hashable, Any] = {}
+    for dependency in plan:
+        if dependency.is_service_scoped:
+            try:
+                values[dependency.cache_key] = scoped[dependency.cache_key]
+            except (KeyError, TypeError):
+                raise DependencyError(
+                    f'Service scoped dependency "{dependency.name}" is not set up'
+                ) from None
+            continue
+
+        kwargs = dependency.get_kwargs(params, values)
+        values[dependency.cache_key] = await resolve_dependency(
+            stack=stack,
+            dependency=dependency,
+            kwargs=kwargs,
+        )
+
+    return values
+
+
+async def solve_service_dependencies(
         *,
         stack: AsyncExitStack,
         params: Dict[str, Any],
-        dependencies: Dict[str, Dependant],
-):
-    deps = {}
-    for kw, dependency in dependencies.items():
-        dependency_params = await dependency.prepare_params(stack, params)
-        if is_async_gen_callable(dependency.call):
-            cm = asynccontextmanager(dependency.call)(**dependency_params)
-            deps[kw] = await stack.enter_async_context(cm)
-        elif is_async_callable(dependency.call):
-            deps[kw] = await dependency.call(**dependency_params)
-        else:
-            deps[kw] = dependency.call(**dependency_params)
-
-    return deps
+        dependant: Dependant,
+        scoped: Dict[Hashable, Any],
+) -> None:
+    """
+    Resolve the service scoped dependencies used by ``dependant`` into
+    ``scoped``. Their async generators are closed with ``stack``.
+    """
+    for dependency in dependant.plan:
+        if not dependency.is_service_scoped or dependency.cache_key in scoped:
+            continue
+
+        for needed in (dependency, *dependency.plan):
+            missing = set(needed.param_names) - params.keys()
+            if missing:
+                raise DependencyError(
+                    f'Service scoped dependency "{dependency.name}" can not '
+                    f'depend on {", ".join(sorted(missing))}'
+                )
+
+        await solve_service_dependencies(
+            stack=stack,
+            params=params,
+            dependant=dependency,
+            scoped=scoped,
+        )
+        values = await solve_dependencies(
+            stack=stack,
+            params=params,
+            plan=dependency.plan,
+            scoped=scoped,
+        )
+        scoped[dependency.cache_key] = await resolve_dependency(
+            stack=stack,
+            dependency=dependency,
+            kwargs=dependency.get_kwargs(params, values),
+        )
+
+
+async def resolve_dependency(
+        *,
+        stack: Optional[AsyncExitStack],
+        dependency: Dependant,
+        kwargs: Dict[str, Any],
+) -> Any:
+    if dependency.is_async_gen:
+        cm = dependency.context_manager(**kwargs)
+        return await stack.enter_async_context(cm)
+    else:
+        return await call_dependant(dependency, kwargs)
+
+
+async def call_dependant(dependant: Dependant, kwargs: Dict[str, Any]) -> Any:
+    """
+    Call a dependant that is not an async generator. Plain functions are
+    run in the thread pool so they can not block the event loop.
+    """
+    if dependant.is_async:
+        return await dependant.call(**kwargs)
+
+    return await run_in_threadpool(dependant.call, **kwargs)
 
 
 def is_async_gen_callable(obj: Any) -> bool:
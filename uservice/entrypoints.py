@@ -1,17 +1,91 @@
-from typing import Callable
-from .dependencies import Dependant
+import time
+
+from contextlib import AsyncExitStack
+from typing import Callable, Dict, Any, Optional
+from .concurrency import run_in_process
+from .dependencies import Dependant, call_dependant
 from .contexts import ServiceContext
+from .metrics import observe_stage
+
+
+PROCESS_EXECUTOR = 'process'
+# Arguments that entrypoints are called with which only exist in the
+# service process.
+PROCESS_UNSAFE_PARAMS = ('connection', 'context')
 
 
 class Entrypoint:
+    # Number of messages handled since the entrypoint was set up.
+    handled: int = 0
+
     def __init__(
             self,
             *,
             context: ServiceContext,
             call: Callable,
+            executor: Optional[str] = None,
     ):
+        if executor not in (None, PROCESS_EXECUTOR):
+            raise ValueError(
+                f'Entrypoint executor must be "{PROCESS_EXECUTOR}" or None, not "{executor}"'
+            )
+
+        if executor == PROCESS_EXECUTOR and '<locals>' in call.__qualname__:
+            raise ValueError(
+                f'"{call.__qualname__}" can not run in a process, '
+                'it must be defined at the top level of a module'
+            )
+
         self.context = context
         self.dependant = Dependant(call=call)
+        self.executor = executor
+        if executor == PROCESS_EXECUTOR:
+            # Only plain arguments can be pickled and sent to the pool.
+            required = self.dependant.required_params
+            unpicklable = [
+                *(name for name in PROCESS_UNSAFE_PARAMS if name in required),
+                *self.dependant.dependencies,
+            ]
+            if unpicklable:
+                raise ValueError(
+                    f'"{call.__qualname__}" can not run in a process, it takes '
+                    f'{", ".join(unpicklable)}, which can not be sent to it'
+                )
+
+    async def handle(self, params: Dict[str, Any]) -> Any:
+        """
+        Resolve the dependencies and call the entrypoint. Dependencies are
+        closed before returning.
+        """
+        scoped = self.context.dependencies
+        name = self.dependant.name
+        started_at = time.perf_counter()
+        if not self.dependant.needs_stack:
+            kwargs = await self.dependant.prepare_params(None, params, scoped)
+            started_at = observe_stage(name, 'dependencies', started_at)
+            result = await self.call(kwargs)
+            observe_stage(name, 'handler', started_at)
+            return result
+
+        async with AsyncExitStack() as stack:
+            kwargs = await self.dependant.prepare_params(stack, params, scoped)
+            started_at = observe_stage(name, 'dependencies', started_at)
+            result = await self.call(kwargs)
+            observe_stage(name, 'handler', started_at)
+            return result
+
+    async def call(self, kwargs: Dict[str, Any]) -> Any:
+        if self.executor == PROCESS_EXECUTOR:
+            return await run_in_process(
+                self.context.process_pool,
+                self.dependant.call,
+                kwargs,
+            )
+
+        return await call_dependant(self.dependant, kwargs)
+
+    def get_queue_name(self) -> str:
+        raise NotImplementedError
 
     async def setup(self, *args, **kwargs) -> None:
         raise NotImplementedError
@@ -19,5 +93,33 @@ class Entrypoint:
     async def start(self) -> None:
         raise NotImplementedError
 
-    async def stop(self) -> None:
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        await self.cancel()
+        await self.drain(timeout)
+        await self.close()
+
+    async def cancel(self) -> None:
+        """
+        Stop receiving new messages.
+        """
+        raise NotImplementedError
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the messages in flight to be handled. Returns False if
+        they were not done within the timeout.
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        raise NotImplementedError
+
+    @property
+    def busy_time(self) -> float:
+        raise NotImplementedError
+
+    async def get_queue_depth(self) -> int:
+        """
+        Number of messages waiting to be delivered to the entrypoint.
+        """
         raise NotImplementedError
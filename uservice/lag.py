@@ -0,0 +1,119 @@
+"""
+Measures how late the event loop runs callbacks, and finds what blocks it.
+
+A task sleeps for a fixed interval and records how much later than asked it
+woke up. With a threshold, a thread watches that task as well. Once it has
+not woken for longer than the threshold the thread takes the stack of the
+main thread, which is still inside the code blocking the loop, and logs it
+with the entrypoint it belongs to.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from types import FrameType
+from typing import Optional
+
+from .amqp.consumer import AmqpConsumer
+from .amqp.events import AmqpEventHandler
+from .metrics import LOOP_BLOCKED, LOOP_LAG_SECONDS
+
+
+logger = logging.getLogger('uservice')
+
+# Blocking outside of any message, for example in a dependency set up with
+# the service.
+NO_ENTRYPOINT = 'no-entrypoint'
+
+# Frames of a message, or of a batch of them, that have the name of their
+# entrypoint in ``name``.
+_entrypoint_codes = (
+    AmqpConsumer.handle_message.__code__,
+    AmqpEventHandler._handle_batch.__code__,
+)
+
+
+def find_entrypoint(frame: Optional[FrameType]) -> str:
+    """
+    The name of the entrypoint handling the message that ``frame`` belongs
+    to. Context variables of the main thread can not be read from another
+    thread, so the frame of ``AmqpConsumer.handle_message``, or of
+    ``AmqpEventHandler._handle_batch`` for a batch, is looked up.
+    """
+    while frame is not None:
+        if frame.f_code in _entrypoint_codes:
+            return frame.f_locals.get('name') or NO_ENTRYPOINT
+
+        frame = frame.f_back
+
+    return NO_ENTRYPOINT
+
+
+class LoopLagMonitor:
+    def __init__(self, *, interval: float, threshold: Optional[float] = None):
+        self.interval = interval
+        self.threshold = threshold
+        self.beat = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.main_thread_id = threading.main_thread().ident
+
+    def start(self) -> None:
+        self.beat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self.measure())
+        if self.threshold is not None:
+            self.main_thread_id = threading.get_ident()
+            self.thread = threading.Thread(
+                target=self.watch,
+                name='uservice-loop-lag',
+                daemon=True,
+            )
+            self.thread.start()
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    async def measure(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - started_at - self.interval
+            LOOP_LAG_SECONDS.observe((), max(lag, 0.0))
+            self.beat = time.monotonic()
+
+    def watch(self) -> None:
+        reported = None
+        while not self.stopped.wait(self.interval):
+            beat = self.beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or reported == beat:
+                continue
+
+            # Report every time the loop is blocked once.
+            reported = beat
+            self.report(blocked)
+
+    def report(self, blocked: float) -> None:
+        frame = sys._current_frames().get(self.main_thread_id)
+        entrypoint = find_entrypoint(frame)
+        LOOP_BLOCKED.inc((entrypoint,))
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+        logger.warning(
+            'Event loop blocked for more than %.0f ms in %s at:\n%s',
+            blocked * 1000,
+            entrypoint,
+            stack,
+        )
@@ -0,0 +1,614 @@
+"""
+An in-process broker with the parts of the aio_pika interface the
+entrypoints and dependencies use, selected with
+``communication_backend="memory"``.
+
+Every process has its own broker, services in the same process reach each
+other through it but workers started by ``uservice run`` do not. It is meant
+for tests and for measuring handlers without broker I/O.
+"""
+import asyncio
+import itertools
+import logging
+import uuid
+
+from collections import deque
+from functools import lru_cache
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Union,
+)
+
+from aio_pika import ExchangeType, Message
+from aio_pika.exceptions import (
+    ChannelInvalidStateError,
+    ChannelNotFoundEntity,
+    ChannelPreconditionFailed,
+    MessageProcessError,
+)
+
+
+logger = logging.getLogger('uservice')
+
+EXCHANGE_TYPES = (ExchangeType.DIRECT, ExchangeType.FANOUT, ExchangeType.TOPIC)
+
+
+class Delivery(NamedTuple):
+    message: Message
+    exchange: str
+    routing_key: str
+    redelivered: bool
+
+
+class DeclarationResult(NamedTuple):
+    message_count: int
+    consumer_count: int
+
+
+@lru_cache(maxsize=4096)
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """
+    Match a routing key against a binding, where ``*`` is exactly one word
+    and ``#`` is zero or more words.
+    """
+    return _words_match(tuple(pattern.split('.')), tuple(routing_key.split('.')))
+
+
+def _words_match(pattern: tuple, words: tuple) -> bool:
+    if not pattern:
+        return not words
+
+    head, rest = pattern[0], pattern[1:]
+    if head == '#':
+        return any(_words_match(rest, words[idx:]) for idx in range(len(words) + 1))
+
+    if not words:
+        return False
+
+    return (head == '*' or head == words[0]) and _words_match(rest, words[1:])
+
+
+class QueueState:
+    def __init__(
+            self,
+            name: str,
+            *,
+            durable: bool,
+            exclusive: bool,
+            auto_delete: bool,
+    ):
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.deliveries: Deque[Delivery] = deque()
+        self.consumers: List[Consumer] = []
+        self.next_consumer = 0
+
+    def put(self, delivery: Delivery) -> None:
+        self.deliveries.append(delivery)
+        self.dispatch()
+
+    def requeue(self, delivery: Delivery) -> None:
+        self.deliveries.appendleft(delivery._replace(redelivered=True))
+
+    def dispatch(self) -> None:
+        while self.deliveries:
+            consumer = self.pick_consumer()
+            if consumer is None:
+                return
+
+            consumer.deliver(self.deliveries.popleft())
+
+    def pick_consumer(self) -> Optional['Consumer']:
+        # Round robin over the consumers that have room under their prefetch.
+        count = len(self.consumers)
+        for offset in range(count):
+            idx = (self.next_consumer + offset) % count
+            consumer = self.consumers[idx]
+            if consumer.can_deliver():
+                self.next_consumer = (idx + 1) % count
+                return consumer
+
+        return None
+
+
+class ExchangeState:
+    def __init__(
+            self,
+            name: str,
+            *,
+            type: ExchangeType,
+            durable: bool,
+            auto_delete: bool,
+    ):
+        self.name = name
+        self.type = type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.bindings: List[tuple] = []
+
+    def route(self, routing_key: str) -> List[QueueState]:
+        queues = []
+        for binding_key, queue in self.bindings:
+            if self.type == ExchangeType.FANOUT:
+                matches = True
+            elif self.type == ExchangeType.TOPIC:
+                matches = topic_matches(binding_key, routing_key)
+            else:
+                matches = binding_key == routing_key
+
+            if matches and queue not in queues:
+                queues.append(queue)
+
+        return queues
+
+
+class MemoryBroker:
+    def __init__(self):
+        self.exchanges: Dict[str, ExchangeState] = {}
+        self.queues: Dict[str, QueueState] = {}
+
+    def publish(self, exchange: str, message: Message, routing_key: str) -> None:
+        if exchange == '':
+            # The default exchange routes to the queue named by the key.
+            queue = self.queues.get(routing_key)
+            queues = [queue] if queue is not None else []
+        else:
+            queues = self.exchanges[exchange].route(routing_key)
+
+        delivery = Delivery(message, exchange, routing_key, False)
+        for queue in queues:
+            queue.put(delivery)
+
+    def delete_queue(self, queue: QueueState) -> None:
+        if self.queues.get(queue.name) is queue:
+            del self.queues[queue.name]
+
+        for exchange in self.exchanges.values():
+            exchange.bindings = [
+                binding for binding in exchange.bindings if binding[1] is not queue
+            ]
+
+        for consumer in queue.consumers:
+            consumer.channel.consumers.pop(consumer.consumer_tag, None)
+
+        queue.consumers.clear()
+
+
+_broker = MemoryBroker()
+
+
+def get_broker() -> MemoryBroker:
+    return _broker
+
+
+def reset_broker() -> None:
+    """
+    Forget all exchanges, queues and messages.
+    """
+    global _broker
+    _broker = MemoryBroker()
+
+
+class IncomingMessage:
+    """
+    A delivered message. The properties of the published message, such as
+    ``body``, ``content_type`` and ``correlation_id``, are read from it.
+    """
+
+    def __init__(
+            self,
+            delivery: Delivery,
+            *,
+            consumer: 'Consumer',
+            delivery_tag: int,
+    ):
+        self.delivery = delivery
+        self.consumer = consumer
+        self.channel = consumer.channel
+        self.delivery_tag = delivery_tag
+        self.consumer_tag = consumer.consumer_tag
+        self.exchange = delivery.exchange
+        self.routing_key = delivery.routing_key
+        self.redelivered = delivery.redelivered
+        self.processed = consumer.no_ack
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.delivery.message, name)
+
+    async def ack(self, multiple: bool = False) -> None:
+        self.channel.settle(self, multiple)
+
+    async def nack(self, multiple: bool = False, requeue: bool = True) -> None:
+        for message in self.channel.settle(self, multiple):
+            if requeue:
+                message.consumer.queue.requeue(message.delivery)
+
+        self.channel.dispatch()
+
+    async def reject(self, requeue: bool = False) -> None:
+        await self.nack(requeue=requeue)
+
+
+class Consumer:
+    def __init__(
+            self,
+            channel: 'Channel',
+            queue: QueueState,
+            callback: Callable[[IncomingMessage], Awaitable[Any]],
+            *,
+            no_ack: bool,
+            consumer_tag: str,
+    ):
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+        self.consumer_tag = consumer_tag
+        self.unacked = 0
+        self.tasks: Set[asyncio.Task] = set()
+
+    def can_deliver(self) -> bool:
+        prefetch_count = self.channel.prefetch_count
+        return self.no_ack or not prefetch_count or self.unacked < prefetch_count
+
+    def deliver(self, delivery: Delivery) -> None:
+        message = IncomingMessage(
+            delivery,
+            consumer=self,
+            delivery_tag=next(self.channel.delivery_tags),
+        )
+        if not self.no_ack:
+            self.unacked += 1
+            self.channel.unacked[message.delivery_tag] = message
+
+        # Like aio_pika every message is handled in its own task.
+        task = asyncio.get_running_loop().create_task(self.callback(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.callback_done)
+
+    def callback_done(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                'Unhandled exception in consumer %s',
+                self.consumer_tag,
+                exc_info=task.exception(),
+            )
+
+
+class Exchange:
+    def __init__(self, channel: 'Channel', state: ExchangeState):
+        self.channel = channel
+        self.name = state.name
+        self._type = state.type
+        self.durable = state.durable
+        self.auto_delete = state.auto_delete
+
+    async def publish(
+            self,
+            message: Message,
+            routing_key: str,
+            **kwargs: Any,
+    ) -> None:
+        self.channel.ensure_open()
+        self.channel.broker.publish(self.name, message, routing_key)
+
+
+class Queue:
+    def __init__(self, channel: 'Channel', state: QueueState):
+        self.channel = channel
+        self.state = state
+        self.name = state.name
+        self.durable = state.durable
+        self.exclusive = state.exclusive
+        self.auto_delete = state.auto_delete
+
+    @property
+    def declaration_result(self) -> DeclarationResult:
+        return DeclarationResult(
+            message_count=len(self.state.deliveries),
+            consumer_count=len(self.state.consumers),
+        )
+
+    async def declare(self, **kwargs: Any) -> DeclarationResult:
+        self.channel.ensure_open()
+        return self.declaration_result
+
+    async def bind(
+            self,
+            exchange: Union[Exchange, str],
+            routing_key: Optional[str] = None,
+            **kwargs: Any,
+    ) -> None:
+        state = self.channel.get_exchange_state(_exchange_name(exchange))
+        binding = (routing_key or self.name, self.state)
+        if binding not in state.bindings:
+            state.bindings.append(binding)
+
+    async def unbind(
+            self,
+            exchange: Union[Exchange, str],
+            routing_key: Optional[str] = None,
+            **kwargs: Any,
+    ) -> None:
+        state = self.channel.get_exchange_state(_exchange_name(exchange))
+        binding = (routing_key or self.name, self.state)
+        if binding in state.bindings:
+            state.bindings.remove(binding)
+
+    async def consume(
+            self,
+            callback: Callable[[IncomingMessage], Awaitable[Any]],
+            no_ack: bool = False,
+            consumer_tag: Optional[str] = None,
+            **kwargs: Any,
+    ) -> str:
+        self.channel.ensure_open()
+        consumer_tag = consumer_tag or f'ctag{self.channel.number}.{uuid.uuid4().hex}'
+        consumer = Consumer(
+            self.channel,
+            self.state,
+            callback,
+            no_ack=no_ack,
+            consumer_tag=consumer_tag,
+        )
+        self.state.consumers.append(consumer)
+        self.channel.consumers[consumer_tag] = consumer
+        self.state.dispatch()
+        return consumer_tag
+
+    async def cancel(self, consumer_tag: str, **kwargs: Any) -> None:
+        self.channel.cancel(consumer_tag)
+
+    async def purge(self, **kwargs: Any) -> None:
+        self.state.deliveries.clear()
+
+    async def delete(self, **kwargs: Any) -> None:
+        self.channel.broker.delete_queue(self.state)
+
+
+def _exchange_name(exchange: Union[Exchange, str]) -> str:
+    return exchange if isinstance(exchange, str) else exchange.name
+
+
+class Channel:
+    _numbers = itertools.count(1)
+
+    def __init__(self, connection: 'Connection'):
+        self.connection = connection
+        self.number = next(self._numbers)
+        self.prefetch_count = 0
+        self.delivery_tags = itertools.count(1)
+        self.unacked: Dict[int, IncomingMessage] = {}
+        self.consumers: Dict[str, Consumer] = {}
+        self.is_closed = False
+
+    def __await__(self):
+        return self._open().__await__()
+
+    async def _open(self) -> 'Channel':
+        return self
+
+    async def __aenter__(self) -> 'Channel':
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    @property
+    def broker(self) -> MemoryBroker:
+        return self.connection.broker
+
+    @property
+    def default_exchange(self) -> Exchange:
+        return Exchange(self, ExchangeState(
+            '',
+            type=ExchangeType.DIRECT,
+            durable=True,
+            auto_delete=False,
+        ))
+
+    def ensure_open(self) -> None:
+        if self.is_closed:
+            raise ChannelInvalidStateError(f'Channel {self.number} is closed')
+
+    async def set_qos(self, prefetch_count: int = 0, **kwargs: Any) -> None:
+        self.prefetch_count = prefetch_count
+        self.dispatch()
+
+    async def declare_exchange(
+            self,
+            name: str,
+            type: Union[ExchangeType, str] = ExchangeType.DIRECT,
+            *,
+            durable: bool = False,
+            auto_delete: bool = False,
+            passive: bool = False,
+            **kwargs: Any,
+    ) -> Exchange:
+        self.ensure_open()
+        state = self.broker.exchanges.get(name)
+        if state is None:
+            if passive:
+                return Exchange(self, self.get_exchange_state(name))
+
+            type = ExchangeType(type)
+            if type not in EXCHANGE_TYPES:
+                raise NotImplementedError(
+                    f'The memory broker does not support {type.value} exchanges'
+                )
+
+            state = self.broker.exchanges[name] = ExchangeState(
+                name,
+                type=type,
+                durable=durable,
+                auto_delete=auto_delete,
+            )
+
+        return Exchange(self, state)
+
+    async def get_exchange(self, name: str, *, ensure: bool = True) -> Exchange:
+        self.ensure_open()
+        return Exchange(self, self.get_exchange_state(name))
+
+    def get_exchange_state(self, name: str) -> ExchangeState:
+        try:
+            return self.broker.exchanges[name]
+        except KeyError:
+            raise ChannelNotFoundEntity(f"NOT_FOUND - no exchange '{name}'") from None
+
+    async def declare_queue(
+            self,
+            name: Optional[str] = None,
+            *,
+            durable: bool = False,
+            exclusive: bool = False,
+            auto_delete: bool = False,
+            passive: bool = False,
+            **kwargs: Any,
+    ) -> Queue:
+        self.ensure_open()
+        name = name or f'amq.gen-{uuid.uuid4().hex}'
+        state = self.broker.queues.get(name)
+        if state is None:
+            if passive:
+                raise ChannelNotFoundEntity(f"NOT_FOUND - no queue '{name}'")
+
+            state = self.broker.queues[name] = QueueState(
+                name,
+                durable=durable,
+                exclusive=exclusive,
+                auto_delete=auto_delete,
+            )
+            if exclusive:
+                self.connection.exclusive_queues.append(state)
+
+        return Queue(self, state)
+
+    def settle(
+            self,
+            message: IncomingMessage,
+            multiple: bool,
+    ) -> List[IncomingMessage]:
+        """
+        Settle a message, and with ``multiple`` every earlier one on the
+        channel. Like aio_pika only ``message`` is marked processed, the
+        earlier ones are only settled on the broker.
+        """
+        if message.processed:
+            raise MessageProcessError('Message already processed', message)
+
+        self.ensure_open()
+        message.processed = True
+        if message.delivery_tag not in self.unacked:
+            # Settled before by a multiple ack or nack of a later message,
+            # the broker closes the channel.
+            self.fail(ChannelPreconditionFailed(
+                f'PRECONDITION_FAILED - unknown delivery tag {message.delivery_tag}'
+            ))
+            return []
+
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= message.delivery_tag]
+        else:
+            tags = [message.delivery_tag]
+
+        settled = []
+        for tag in tags:
+            settled_message = self.unacked.pop(tag)
+            settled_message.consumer.unacked -= 1
+            settled.append(settled_message)
+
+        self.dispatch()
+        return settled
+
+    def dispatch(self) -> None:
+        for consumer in list(self.consumers.values()):
+            consumer.queue.dispatch()
+
+    def cancel(self, consumer_tag: str) -> None:
+        consumer = self.consumers.pop(consumer_tag, None)
+        if consumer is None:
+            return
+
+        queue = consumer.queue
+        queue.consumers.remove(consumer)
+        if queue.auto_delete and not queue.consumers:
+            self.broker.delete_queue(queue)
+
+    async def close(self, exc: Optional[BaseException] = None) -> None:
+        self.fail(exc)
+
+    def fail(self, exc: Optional[BaseException] = None) -> None:
+        """
+        Close the channel, by the client or by the broker on an error.
+        """
+        if self.is_closed:
+            return
+
+        if exc is not None:
+            logger.warning('Closing channel %s: %s', self.number, exc)
+
+        for consumer_tag in list(self.consumers):
+            self.cancel(consumer_tag)
+
+        self.is_closed = True
+        self.connection.channels.remove(self)
+        # Like on the broker, messages that were not acked are redelivered.
+        # Settling them afterwards fails as the channel is closed.
+        queues = []
+        for tag in sorted(self.unacked, reverse=True):
+            message = self.unacked.pop(tag)
+            message.consumer.queue.requeue(message.delivery)
+            queues.append(message.consumer.queue)
+
+        for queue in queues:
+            queue.dispatch()
+
+
+class Connection:
+    def __init__(self, broker: MemoryBroker):
+        self.broker = broker
+        self.channels: List[Channel] = []
+        self.exclusive_queues: List[QueueState] = []
+        self.is_closed = False
+
+    def channel(self, **kwargs: Any) -> Channel:
+        channel = Channel(self)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self, exc: Optional[BaseException] = None) -> None:
+        if self.is_closed:
+            return
+
+        self.is_closed = True
+        for channel in list(self.channels):
+            await channel.close()
+
+        for queue in self.exclusive_queues:
+            self.broker.delete_queue(queue)
+
+    async def __aenter__(self) -> 'Connection':
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+
+async def connect(*args: Any, **kwargs: Any) -> Connection:
+    """
+    Connect to the broker of the current process. Arguments are accepted
+    and ignored, so it can stand in for ``aio_pika.connect``.
+    """
+    return Connection(get_broker())
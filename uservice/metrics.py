@@ -0,0 +1,295 @@
+"""
+Counters and histograms of what the entrypoints and rpc proxies do, in the
+Prometheus text format.
+
+Metrics are kept per process. A worker started by ``uservice run`` sends a
+snapshot to the supervisor, which adds up the snapshots of all its workers
+and serves them on ``--metrics-port``. A worker without a supervisor, run
+with ``--reload``, serves its own on that port, the ``metrics_port`` of
+its ``ServiceRunner``.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from bisect import bisect_left
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+logger = logging.getLogger('uservice')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+Snapshot = Dict[str, Dict[Tuple[str, ...], Any]]
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, labels: Tuple[str, ...], amount: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        return dict(self.values)
+
+    @staticmethod
+    def merge(into: Dict[Tuple[str, ...], Any], values: Dict[Tuple[str, ...], Any]) -> None:
+        for labels, value in values.items():
+            into[labels] = into.get(labels, 0.0) + value
+
+    def render(self, values: Dict[Tuple[str, ...], float]) -> List[str]:
+        return [
+            f'{self.name}{_labels(self.labelnames, labels)} {value}'
+            for labels, value in values.items()
+        ]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...],
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per labels the count of every bucket, not cumulative, with the
+        # count above the last bucket at the end, then the sum.
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self) -> Dict[Tuple[str, ...], List[float]]:
+        return {labels: list(counts) for labels, counts in self.values.items()}
+
+    @staticmethod
+    def merge(into: Dict[Tuple[str, ...], Any], values: Dict[Tuple[str, ...], Any]) -> None:
+        for labels, counts in values.items():
+            total = into.get(labels)
+            if total is None:
+                into[labels] = list(counts)
+            else:
+                for idx, count in enumerate(counts):
+                    total[idx] += count
+
+    def render(self, values: Dict[Tuple[str, ...], List[float]]) -> List[str]:
+        lines = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                bucket_labels = _labels(
+                    (*self.labelnames, 'le'),
+                    (*labels, str(bound)),
+                )
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+
+            label_str = _labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_str} {counts[-1]}')
+            lines.append(f'{self.name}_count{label_str} {cumulative}')
+
+        return lines
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+
+    pairs = ','.join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...]) -> Counter:
+        metric = self.metrics[name] = Counter(name, documentation, labelnames)
+        return metric
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...],
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = self.metrics[name] = Histogram(name, documentation, labelnames, buckets)
+        return metric
+
+    def snapshot(self) -> Snapshot:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def merge(self, snapshots: Iterable[Snapshot]) -> Snapshot:
+        """
+        Add up the snapshots of several processes.
+        """
+        total: Snapshot = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is not None:
+                    metric.merge(total[name], values)
+
+        return total
+
+    def render(self, snapshot: Optional[Snapshot] = None) -> str:
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.render(snapshot.get(name, {})))
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+MESSAGES = REGISTRY.counter(
+    'uservice_messages_total',
+    'Messages handled by an entrypoint, by outcome.',
+    ('entrypoint', 'outcome'),
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    'uservice_stage_seconds',
+    'Seconds spent in each stage of handling a message.',
+    ('entrypoint', 'stage'),
+)
+RPC_CALLS = REGISTRY.counter(
+    'uservice_rpc_calls_total',
+    'Rpc calls made through rpc proxies, by outcome.',
+    ('service', 'method', 'outcome'),
+)
+RPC_CALL_SECONDS = REGISTRY.histogram(
+    'uservice_rpc_call_seconds',
+    'Seconds from making an rpc call until its reply.',
+    ('service', 'method'),
+)
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    'uservice_event_loop_lag_seconds',
+    'Seconds the event loop woke up a sleeping task later than asked.',
+    (),
+)
+LOOP_BLOCKED = REGISTRY.counter(
+    'uservice_event_loop_blocked_total',
+    'Times the event loop was blocked longer than the threshold, by entrypoint.',
+    ('entrypoint',),
+)
+
+# The entrypoint handling the current message, publishes are counted for it.
+current_entrypoint: ContextVar[str] = ContextVar('current_entrypoint', default='')
+# Seconds spent in each stage of the current message so far.
+current_stages: ContextVar[Optional[Dict[str, float]]] = ContextVar('current_stages', default=None)
+
+
+def observe_stage(entrypoint: str, stage: str, started_at: float) -> float:
+    """
+    Record the time since ``started_at`` and return the current time, to
+    start the next stage from.
+    """
+    now = time.perf_counter()
+    elapsed = now - started_at
+    STAGE_SECONDS.observe((entrypoint, stage), elapsed)
+    stages = current_stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + elapsed
+
+    return now
+
+
+async def serve_metrics(port: int, host: str = '0.0.0.0') -> asyncio.AbstractServer:
+    """
+    Serve the metrics of this process over HTTP on the event loop.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # Any path is answered, read up to the end of the headers.
+            while (await reader.readline()).strip():
+                pass
+
+            body = REGISTRY.render().encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                + f'Content-Type: {CONTENT_TYPE}\r\n'.encode()
+                + f'Content-Length: {len(body)}\r\n'.encode()
+                + b'Connection: close\r\n\r\n'
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f'Serving metrics on port {port}')
+    return server
+
+
+class MetricsHTTPServer:
+    """
+    Serve metrics over HTTP from a thread, for the supervisor which has no
+    event loop. ``render`` is called for every request.
+    """
+
+    def __init__(self, render: Callable[[], str], port: int, host: str = '0.0.0.0'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            name='uservice-metrics',
+            daemon=True,
+        )
+
+    def start(self) -> None:
+        self.thread.start()
+        logger.info(f'Serving metrics on port {self.server.server_address[1]}')
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
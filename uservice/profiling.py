@@ -0,0 +1,116 @@
+"""
+A sampling profiler that is switched on and off in a running worker.
+
+Samples are taken on the CPU time of the process by ``SIGPROF``. The
+handler of the signal runs in the main thread between two bytecodes, in
+the context of the task that was interrupted, so every sample is counted
+towards the entrypoint handling the current message. The stacks are
+written in the collapsed format of ``flamegraph.pl`` and speedscope, one
+file per entrypoint.
+"""
+import logging
+import os
+import re
+import signal
+import time
+
+from collections import Counter
+from types import FrameType
+from typing import Dict, List, Optional
+
+from .metrics import current_entrypoint
+
+
+logger = logging.getLogger('uservice')
+
+# Samples taken outside of any entrypoint, for example in the event loop.
+NO_ENTRYPOINT = 'no-entrypoint'
+MAX_DEPTH = 128
+
+
+class SamplingProfiler:
+    def __init__(self, *, directory: str, interval: float = 0.005, prefix: str = 'uservice'):
+        self.directory = directory
+        self.interval = interval
+        self.prefix = prefix
+        self.samples: Counter = Counter()
+        self.running = False
+        self.started_at = 0.0
+        self._labels: Dict[object, str] = {}
+
+    def toggle(self) -> None:
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self) -> None:
+        if self.running:
+            return
+
+        self.samples.clear()
+        self.running = True
+        self.started_at = time.time()
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        logger.info(f'Started profiling worker process [{os.getpid()}]')
+
+    def stop(self) -> List[str]:
+        """
+        Stop sampling and write the stacks, returns the paths written.
+        """
+        if not self.running:
+            return []
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+        paths = self.write()
+        logger.info(
+            f'Stopped profiling worker process [{os.getpid()}], '
+            f'wrote {", ".join(paths) or "no samples"}'
+        )
+        return paths
+
+    def sample(self, sig: int, frame: Optional[FrameType]) -> None:
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(self.label(frame))
+            frame = frame.f_back
+
+        stack.reverse()
+        entrypoint = current_entrypoint.get() or NO_ENTRYPOINT
+        self.samples[(entrypoint, ';'.join(stack))] += 1
+
+    def label(self, frame: FrameType) -> str:
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            # Semicolons separate the frames of a collapsed stack.
+            label = self._labels[code] = (
+                f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+            ).replace(';', ':')
+
+        return label
+
+    def write(self) -> List[str]:
+        stacks: Dict[str, List[str]] = {}
+        for (entrypoint, stack), count in self.samples.items():
+            stacks.setdefault(entrypoint, []).append(f'{stack} {count}\n')
+
+        os.makedirs(self.directory, exist_ok=True)
+        timestamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        paths = []
+        for entrypoint, lines in stacks.items():
+            name = re.sub(r'[^\w.-]', '_', entrypoint)
+            path = os.path.join(
+                self.directory,
+                f'{self.prefix}-{os.getpid()}-{timestamp}-{name}.collapsed',
+            )
+            with open(path, 'w') as f:
+                f.writelines(lines)
+
+            paths.append(path)
+
+        self.samples.clear()
+        return paths
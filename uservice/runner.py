@@ -1,10 +1,33 @@
 import asyncio
+import gc
+import logging
+import os
+import random
 import uvloop
 import signal
 
+from typing import Optional
+
 
 from .importer import import_from_string
+from .metrics import REGISTRY, serve_metrics
 from .service import Service
+from .supervisors.worker import (
+    WorkerReporter,
+    get_rss,
+    METRICS,
+    RECYCLE,
+    STARTED,
+    STATS,
+)
+
+logger = logging.getLogger('uservice')
+
+# Seconds between checks of the recycle limits.
+RECYCLE_INTERVAL = 0.1
+# Every worker raises its recycle limits by up to this fraction, so workers
+# started together are not recycled together.
+RECYCLE_JITTER = 0.1
 
 HANDLED_SIGNALS = (
     signal.SIGINT,  # Unix signal 2. Sent by Ctrl+C.
@@ -16,16 +39,125 @@ class ServiceRunner:
             self,
             *,
             service_str,
+            max_messages: Optional[int] = None,
+            max_rss: Optional[int] = None,
+            metrics_port: Optional[int] = None,
     ):
         self.service_str = service_str
+        self.max_messages = max_messages
+        self.max_rss = max_rss
+        # Only used without a supervisor, which otherwise serves the metrics
+        # of all its workers.
+        self.metrics_port = metrics_port
+        self.loaded_service: Optional[Service] = None
 
     def setup_event_loop(self):
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
     def load(self):
-        self.loaded_service: Service = import_from_string(self.service_str)
+        self.loaded_service = import_from_string(self.service_str)
 
-    def run(self):
+    def preload(self):
+        """
+        Import the service in the supervisor, before the workers are forked,
+        so they share its memory. Importing a service must not create an
+        event loop or a connection, both are set up by each worker in run.
+        """
         self.load()
+        # Keep the garbage collector from touching, and so copying, the
+        # preloaded objects in every worker.
+        gc.freeze()
+
+    def run(self, reporter: Optional[WorkerReporter] = None):
+        if self.loaded_service is None:
+            self.load()
+
         self.setup_event_loop()
-        return asyncio.run(self.loaded_service.run())
+        return asyncio.run(self.serve(reporter))
+
+    async def serve(self, reporter: Optional[WorkerReporter] = None):
+        if reporter is None:
+            if not self.metrics_port:
+                return await self.loaded_service.run()
+
+            server = await serve_metrics(self.metrics_port)
+            try:
+                return await self.loaded_service.run()
+            finally:
+                server.close()
+
+        tasks = [
+            asyncio.create_task(reporter.heartbeat()),
+            asyncio.create_task(
+                reporter.notify(STARTED, self.loaded_service.started)
+            ),
+        ]
+        if reporter.stats_interval:
+            tasks.append(asyncio.create_task(reporter.report(
+                STATS,
+                self.loaded_service.get_stats,
+                reporter.stats_interval,
+            )))
+        if reporter.metrics_interval:
+            tasks.append(asyncio.create_task(reporter.report(
+                METRICS,
+                collect_metrics,
+                reporter.metrics_interval,
+            )))
+        if self.max_messages or self.max_rss:
+            tasks.append(asyncio.create_task(self.recycle(reporter)))
+
+        try:
+            return await self.loaded_service.run()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            if reporter.metrics_interval:
+                # Include the messages handled while draining.
+                reporter.send(METRICS, REGISTRY.snapshot())
+
+    async def recycle(self, reporter: WorkerReporter) -> None:
+        """
+        Stop the worker once it handled ``max_messages`` messages or grew
+        past ``max_rss`` megabytes, the supervisor starts a new one.
+        """
+        max_messages = jitter(self.max_messages)
+        max_rss = jitter(self.max_rss)
+        service = self.loaded_service
+        await service.started.wait()
+        if max_rss and get_rss() >= max_rss * 1024 * 1024:
+            # A new worker would be over the limit as well and be replaced
+            # as soon as it started, over and over.
+            logger.error(
+                f"Worker process [{os.getpid()}] uses more than {max_rss} MB "
+                f"once started, it is not recycled by memory"
+            )
+            max_rss = None
+            if not max_messages:
+                return
+
+        while True:
+            await asyncio.sleep(RECYCLE_INTERVAL)
+            if max_messages and service.messages_handled >= max_messages:
+                reason = f"handled {service.messages_handled} messages"
+            elif max_rss and get_rss() >= max_rss * 1024 * 1024:
+                reason = f"uses more than {max_rss} MB"
+            else:
+                continue
+
+            logger.info(f"Recycling worker process [{os.getpid()}], {reason}")
+            reporter.send(RECYCLE)
+            service.handle_exit(None, None)
+            return
+
+
+async def collect_metrics():
+    return REGISTRY.snapshot()
+
+
+def jitter(limit: Optional[int]) -> Optional[int]:
+    if not limit:
+        return limit
+
+    return limit + random.randint(0, int(limit * RECYCLE_JITTER))
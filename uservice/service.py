@@ -2,13 +2,25 @@ import logging
 import asyncio
 import signal
 import threading
-from typing import Optional, NoReturn, Callable, Any, List
-from aio_pika import Connection, connect
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import AsyncExitStack
+from typing import Optional, NoReturn, Callable, Any, List, Dict
+from aio_pika import Connection
 from .amqp.events import AmqpEventHandler
-from .amqp.rpc import AmqpRpc
+from .amqp.pool import close_channel_pool
+from .amqp.rpc import AmqpRpc, close_reply_listener
 from .settings import get_settings, Settings
+from .transport import connect
 from .contexts import ServiceContext
-from .entrypoints import Entrypoint
+from .dependencies import solve_service_dependencies
+from .concurrency import warm_up_process
+from .profiling import SamplingProfiler
+from .tracing import create_tracer
+from .entrypoints import Entrypoint, PROCESS_EXECUTOR
+from .lag import LoopLagMonitor
 
 
 HANDLED_SIGNALS = (
@@ -16,6 +28,9 @@ HANDLED_SIGNALS = (
     signal.SIGTERM,  # Unix signal 15. Sent by `kill <pid>`.
 )
 
+# Switches the profiler of a worker on and off.
+PROFILE_SIGNAL = signal.SIGUSR1
+
 logger = logging.getLogger('uservice')
 
 
@@ -30,6 +45,12 @@ class Service:
             _settings = get_settings()
 
         self.entrypoints: List[Entrypoint] = []
+        self.started = asyncio.Event()
+        # Set up front, so a signal before the service is set up stops it.
+        self.should_exit = asyncio.Event()
+        self.is_running = False
+        self.profiler: Optional[SamplingProfiler] = None
+        self.lag_monitor: Optional[LoopLagMonitor] = None
         self.init_context(name, settings or _settings)
 
     def init_context(self, name: str, settings: Settings) -> None:
@@ -40,9 +61,10 @@ class Service:
 
     def handle_exit(self, sig, frame) -> None:
         self.is_running = False
+        self.should_exit.set()
 
     async def run(self) -> None:
-        connection = await connect(self.context.settings.amqp.get_url())
+        connection = await connect(self.context.settings)
         async with connection:
             await self.setup(connection)
             await self.start()
@@ -50,28 +72,175 @@ class Service:
             await self.stop()
 
     async def loop(self) -> None:
-        while self.is_running:
-            await asyncio.sleep(0.1)
+        await self.should_exit.wait()
 
     async def setup(self, connection: Connection) -> None:
+        self.connection = connection
+        self.is_running = False
+        settings = self.context.settings
+        if settings.profile_dir:
+            self.profiler = SamplingProfiler(
+                directory=settings.profile_dir,
+                interval=settings.profile_interval,
+                prefix=self.context.name,
+            )
         self.install_signal_handlers()
+        self.context.tracer = create_tracer(self.context.name, self.context.settings.tracing)
+        self.setup_thread_pool()
+        await self.setup_process_pool()
+        await self.setup_dependencies(connection)
         for entrypoint in self.entrypoints:
             await entrypoint.setup(connection)
 
+    def setup_thread_pool(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(
+            ThreadPoolExecutor(
+                max_workers=self.context.settings.thread_pool_size,
+                thread_name_prefix='uservice',
+            )
+        )
+
+    async def setup_process_pool(self) -> None:
+        modules = {
+            entrypoint.dependant.call.__module__
+            for entrypoint in self.entrypoints
+            if entrypoint.executor == PROCESS_EXECUTOR
+        }
+        if not modules:
+            return
+
+        size = self.context.settings.process_pool_size or os.cpu_count() or 1
+        pool = ProcessPoolExecutor(
+            max_workers=size,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        # Start every process and import the handlers up front, so the first
+        # messages do not pay for it.
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(pool, warm_up_process, module)
+            for module in modules
+            for _idx in range(size)
+        ))
+        self.context.process_pool = pool
+
+    async def setup_dependencies(self, connection: Connection) -> None:
+        self.dependency_stack = AsyncExitStack()
+        params = {
+            'connection': connection,
+            'context': self.context,
+        }
+        for entrypoint in self.entrypoints:
+            await solve_service_dependencies(
+                stack=self.dependency_stack,
+                params=params,
+                dependant=entrypoint.dependant,
+                scoped=self.context.dependencies,
+            )
+
     async def start(self) -> None:
         for entrypoint in self.entrypoints:
             await entrypoint.start()
 
+        settings = self.context.settings
+        self.lag_monitor = LoopLagMonitor(
+            interval=settings.loop_lag_interval,
+            threshold=settings.loop_lag_threshold,
+        )
+        self.lag_monitor.start()
         self.is_running = True
+        self.started.set()
+        self._stats_at = time.monotonic()
+        self._busy_times = [entrypoint.busy_time for entrypoint in self.entrypoints]
+
+    @property
+    def messages_handled(self) -> int:
+        return sum(entrypoint.handled for entrypoint in self.entrypoints)
+
+    async def get_stats(self) -> Optional[Dict[str, Any]]:
+        """
+        The number of messages waiting in the queues of the entrypoints and
+        the largest fraction of time since the last call that an entrypoint
+        had messages in flight.
+        """
+        if not self.is_running:
+            return None
+
+        queues = {}
+        for entrypoint in self.entrypoints:
+            queue_name = entrypoint.get_queue_name()
+            if queue_name not in queues:
+                queues[queue_name] = await entrypoint.get_queue_depth()
+
+        now = time.monotonic()
+        busy_times = [entrypoint.busy_time for entrypoint in self.entrypoints]
+        elapsed = now - self._stats_at
+        utilisation = 0.0
+        for busy_time, last_busy_time in zip(busy_times, self._busy_times):
+            if elapsed > 0:
+                utilisation = max(utilisation, (busy_time - last_busy_time) / elapsed)
+
+        self._stats_at = now
+        self._busy_times = busy_times
+        return {
+            'queues': queues,
+            'utilisation': min(utilisation, 1.0),
+        }
 
     async def stop(self) -> None:
+        """
+        Stop consuming, wait up to the drain timeout for the messages in
+        flight and their publishes, then close everything but the connection.
+        """
+        self.is_running = False
+        self.started.clear()
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+            self.lag_monitor = None
+
+        for entrypoint in self.entrypoints:
+            await entrypoint.cancel()
+
+        await asyncio.gather(*(
+            entrypoint.drain(self.context.settings.drain_timeout)
+            for entrypoint in self.entrypoints
+        ))
         for entrypoint in self.entrypoints:
-            await entrypoint.stop()
+            await entrypoint.close()
+
+        await close_reply_listener(self.connection)
+        await close_channel_pool(self.connection)
+        await self.dependency_stack.aclose()
+        self.context.dependencies.clear()
+
+        if self.context.process_pool is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.context.process_pool.shutdown)
+            self.context.process_pool = None
+
+        if self.context.tracer is not None:
+            self.context.tracer.close()
+            self.context.tracer = None
+
+        if self.profiler is not None:
+            self.profiler.stop()
+
+        # So the service can be run again.
+        self.should_exit.clear()
 
     def event_handler(
             self,
             exchange: str,
             queue: str,
+            *,
+            prefetch_count: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            codec: Optional[str] = None,
+            executor: Optional[str] = None,
+            slow_threshold: Optional[float] = None,
+            batch_size: Optional[int] = None,
+            max_wait: float = 0.1,
     ) -> Callable:
         def decorator(func: Callable) -> None:
             self.entrypoints.append(
@@ -80,6 +249,13 @@ class Service:
                     call=func,
                     exchange_name=exchange,
                     routing_key=queue,
+                    prefetch_count=prefetch_count,
+                    max_concurrency=max_concurrency,
+                    codec=codec,
+                    executor=executor,
+                    slow_threshold=slow_threshold,
+                    batch_size=batch_size,
+                    max_wait=max_wait,
                 )
             )
             return func
@@ -90,6 +266,11 @@ class Service:
             self,
             *,
             response_model: Optional[Any] = None,
+            prefetch_count: Optional[int] = None,
+            max_concurrency: Optional[int] = None,
+            codec: Optional[str] = None,
+            executor: Optional[str] = None,
+            slow_threshold: Optional[float] = None,
     ) -> Callable:
         def decorator(func: Callable, *args, **kwargs) -> None:
             self.entrypoints.append(
@@ -97,8 +278,14 @@ class Service:
                     context=self.context,
                     call=func,
                     response_model=response_model,
+                    prefetch_count=prefetch_count,
+                    max_concurrency=max_concurrency,
+                    codec=codec,
+                    executor=executor,
+                    slow_threshold=slow_threshold,
                 )
             )
+            return func
 
         return decorator
 
@@ -116,3 +303,7 @@ class Service:
             # Windows
             for sig in HANDLED_SIGNALS:
                 signal.signal(sig, self.handle_exit)
+            return
+
+        if self.profiler is not None:
+            loop.add_signal_handler(PROFILE_SIGNAL, self.profiler.toggle)
@@ -1,5 +1,5 @@
 from functools import lru_cache
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseSettings, AmqpDsn, Field, BaseModel
 
 
@@ -11,6 +11,7 @@ class AmqpSettings(BaseModel):
     password: Optional[str]
     tls: bool = False
     rpc_exchange: str = 'uservice-rpc'
+    channel_pool_size: int = 10
 
     def get_url(self):
         if (
@@ -31,10 +32,42 @@ class AsyncAPISettings(BaseModel):
     description: str = 'My Service'
 
 
+class TracingSettings(BaseModel):
+    # Name of a registered span exporter, tracing is off without one.
+    exporter: Optional[str]
+    # Fraction of traces that are exported, decided where a trace starts.
+    sample_rate: float = 1.0
+    file_path: str = 'traces.jsonl'
+
+
 class Settings(BaseSettings):
-    communication_backend: str = 'amqp'
+    # "memory" runs on a broker in the process, for tests and benchmarks.
+    communication_backend: Literal['amqp', 'memory'] = 'amqp'
+    codec: str = 'json'
+    # Threads running synchronous handlers and dependencies, defaults to
+    # the size picked by ThreadPoolExecutor.
+    thread_pool_size: Optional[int] = None
+    # Processes running entrypoints with executor="process", defaults to
+    # the number of CPUs.
+    process_pool_size: Optional[int] = None
+    # Seconds to wait for messages in flight when the service stops.
+    drain_timeout: float = 30
+    # Seconds after which a message is logged as slow, for entrypoints that
+    # do not set slow_threshold themselves.
+    slow_handler_threshold: Optional[float] = None
+    # Directory SIGUSR1 toggles writing profiles of the worker to, the
+    # signal is left alone without it.
+    profile_dir: Optional[str] = None
+    # Seconds of CPU time between the samples of the profiler.
+    profile_interval: float = 0.005
+    # Seconds between measurements of the event loop lag.
+    loop_lag_interval: float = 0.1
+    # Seconds the event loop may be blocked before the stack blocking it is
+    # logged, not watched without it.
+    loop_lag_threshold: Optional[float] = None
     amqp: AmqpSettings = AmqpSettings()
     asyncapi: AsyncAPISettings = AsyncAPISettings()
+    tracing: TracingSettings = TracingSettings()
 
     class Config:
         env_nested_delimiter = '__'
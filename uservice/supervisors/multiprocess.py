@@ -1,16 +1,78 @@
 import logging
+import signal
+import threading
+import time
 import click
 
-from .subprocess import Supervisor, get_subprocess
+from typing import Dict, List, Optional
+
+from uservice.metrics import REGISTRY, MetricsHTTPServer, Snapshot
+
+from .subprocess import Supervisor
+from .worker import WorkerProcess
 
 logger = logging.getLogger('uservice')
 
+# Seconds between checks of the workers.
+MONITOR_INTERVAL = 0.5
+# A worker that ran this long before dying is restarted without backoff.
+STABLE_AFTER = 60.0
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Seconds between the queue depth and utilisation reports of the workers.
+STATS_INTERVAL = 5.0
+# Utilisation of the workers above which one is added while messages wait.
+SCALE_UP_UTILISATION = 0.9
+# Utilisation of the workers below which one is removed once the queues are
+# empty.
+SCALE_DOWN_UTILISATION = 0.3
+# Seconds between the metrics reports of the workers.
+METRICS_INTERVAL = 2.0
+
 
 class Multiprocess(Supervisor):
-    def __init__(self, target, workers):
+    def __init__(
+            self,
+            target,
+            workers,
+            start_method="spawn",
+            heartbeat_timeout=30.0,
+            min_workers=None,
+            max_workers=None,
+            backlog_per_worker=100,
+            scale_cooldown=30.0,
+            metrics_port=None,
+    ):
         super().__init__(target)
-        self.workers = workers
-        self.processes = []
+        self.min_workers = min_workers or workers
+        self.max_workers = max(max_workers or workers, self.min_workers)
+        self.workers = min(max(workers, self.min_workers), self.max_workers)
+        self.start_method = start_method
+        self.heartbeat_timeout = heartbeat_timeout
+        self.heartbeat_interval = min(1.0, heartbeat_timeout / 5)
+        self.backlog_per_worker = backlog_per_worker
+        self.scale_cooldown = scale_cooldown
+        self.autoscale = self.max_workers > self.min_workers
+        self.stats_interval = STATS_INTERVAL if self.autoscale else None
+        self.processes: List[WorkerProcess] = []
+        self.retiring: List[WorkerProcess] = []
+        self.scaled_at = 0.0
+        self.idle_since: Optional[float] = None
+        self.should_reload = False
+        self.reload_at: Optional[float] = None
+        self.replacement: Optional[WorkerProcess] = None
+        self.metrics_port = metrics_port
+        self.metrics_interval = METRICS_INTERVAL if metrics_port else None
+        # The last metrics of every running worker, and of all workers that
+        # exited added up, so the counters never go down.
+        self.worker_metrics: Dict[WorkerProcess, Snapshot] = {}
+        self.retired_metrics: Optional[Snapshot] = None
+        # Held while the metrics change, they are read by the server thread.
+        self.metrics_lock = threading.Lock()
+        self.metrics_server: Optional[MetricsHTTPServer] = None
+
+    def reload_handler(self, sig, frame) -> None:
+        self.should_reload = True
 
     def startup(self) -> None:
         super().startup()
@@ -19,23 +81,261 @@ class Multiprocess(Supervisor):
             click.style(str(self.pid), fg="cyan", bold=True)
         )
         logger.info(message, extra={"color_message": color_message})
-
+        signal.signal(signal.SIGHUP, self.reload_handler)
         for _idx in range(self.workers):
-            process = get_subprocess(
-                target=self.target,
-            )
-            process.start()
-            logger.info(f"Started worker process [{process.pid}]")
-            self.processes.append(process)
+            self.processes.append(self.start_worker())
+
+        # Started after the workers, so with --preload they are not forked
+        # from a process with a running thread.
+        if self.metrics_port:
+            self.metrics_server = MetricsHTTPServer(self.render_metrics, self.metrics_port)
+            self.metrics_server.start()
+
+    def start_worker(self, failures: int = 0) -> WorkerProcess:
+        process = WorkerProcess(
+            self.target,
+            start_method=self.start_method,
+            heartbeat_interval=self.heartbeat_interval,
+            stats_interval=self.stats_interval,
+            metrics_interval=self.metrics_interval,
+            failures=failures,
+        )
+        process.start()
+        logger.info(f"Started worker process [{process.pid}]")
+        return process
 
     def loop(self):
-        self.should_exit.wait()
+        while not self.should_exit.wait(MONITOR_INTERVAL):
+            self.monitor(time.monotonic())
+
+    def poll(self, process: WorkerProcess) -> None:
+        process.poll()
+        if process.metrics is not None:
+            with self.metrics_lock:
+                self.worker_metrics[process] = process.metrics
+
+    def join(self, process: WorkerProcess) -> None:
+        """
+        Join a worker that exited, and add its last metrics to those of the
+        workers that exited before it.
+        """
+        self.poll(process)
+        process.join()
+        with self.metrics_lock:
+            metrics = self.worker_metrics.pop(process, None)
+            if metrics is not None:
+                snapshots = [metrics]
+                if self.retired_metrics is not None:
+                    snapshots.append(self.retired_metrics)
+
+                self.retired_metrics = REGISTRY.merge(snapshots)
+
+    def render_metrics(self) -> str:
+        """
+        The metrics of all workers added up, called from the thread of the
+        metrics server.
+        """
+        with self.metrics_lock:
+            snapshots = list(self.worker_metrics.values())
+            if self.retired_metrics is not None:
+                snapshots.append(self.retired_metrics)
+
+        return REGISTRY.render(REGISTRY.merge(snapshots))
+
+    def monitor(self, now: float) -> None:
+        for idx, process in enumerate(self.processes):
+            self.poll(process)
+            if process.recycling:
+                # The worker drains and exits by itself, replace it right away.
+                logger.info(f"Replacing recycled worker process [{process.pid}]")
+                self.processes[idx] = self.start_worker()
+                self.retiring.append(process)
+                continue
+
+            if process.restart_at is None:
+                if not process.is_alive():
+                    logger.warning(
+                        f"Worker process [{process.pid}] died "
+                        f"with exit code {process.exitcode}"
+                    )
+                    # Also closes the reading end of its pipe.
+                    self.join(process)
+                    self.schedule_restart(process, now)
+
+                elif now - process.last_heartbeat > self.heartbeat_timeout:
+                    logger.warning(
+                        f"Worker process [{process.pid}] sent no heartbeat "
+                        f"for {self.heartbeat_timeout} seconds, killing it"
+                    )
+                    process.kill()
+                    self.join(process)
+                    self.schedule_restart(process, now)
+
+            if process.restart_at is not None and now >= process.restart_at:
+                self.processes[idx] = self.start_worker(process.failures)
+
+        for process in self.retiring[:]:
+            self.poll(process)
+            if not process.is_alive():
+                self.join(process)
+                self.retiring.remove(process)
+
+        if self.should_reload:
+            self.should_reload = False
+            logger.info("Replacing the worker processes")
+            self.reload_at = now
+
+        if self.reload_at is not None:
+            self.roll(now)
+        elif self.autoscale:
+            self.scale(now)
+
+    def roll(self, now: float) -> None:
+        """
+        Replace the workers started before the reload one at a time. A new
+        worker is started and only once it reports that it consumes is an
+        old worker stopped, which drains its messages in flight before the
+        next one is replaced.
+        """
+        old = [
+            process for process in self.processes
+            if process.restart_at is None and process.started_at < self.reload_at
+        ]
+        replacement = self.replacement
+        if replacement is None:
+            if self.retiring:
+                return
+
+            if not old:
+                logger.info("Replaced all worker processes")
+                self.reload_at = None
+                return
+
+            self.replacement = self.start_worker()
+            return
+
+        self.poll(replacement)
+        if (
+                not replacement.is_alive()
+                or now - replacement.last_heartbeat > self.heartbeat_timeout
+        ):
+            logger.error(
+                f"Worker process [{replacement.pid}] failed to start, "
+                f"keeping the remaining {len(old)} old worker processes"
+            )
+            replacement.kill()
+            self.join(replacement)
+            self.replacement = None
+            self.reload_at = None
+            return
+
+        if not replacement.ready:
+            return
+
+        self.replacement = None
+        if not old:
+            # The old workers died and were restarted while this one started.
+            replacement.terminate()
+            self.retiring.append(replacement)
+            return
+
+        process = old[0]
+        self.processes[self.processes.index(process)] = replacement
+        logger.info(
+            f"Stopping worker process [{process.pid}], "
+            f"replaced by [{replacement.pid}]"
+        )
+        process.terminate()
+        self.retiring.append(process)
+
+    def scale(self, now: float) -> None:
+        """
+        Add a worker while messages wait in the queues faster than the
+        workers take them, and remove one once the queues have been empty
+        and the workers mostly idle for the cooldown.
+        """
+        reports = [
+            process.stats for process in self.processes
+            if process.restart_at is None and process.stats is not None
+        ]
+        if not reports:
+            return
+
+        # Every worker consumes from the same queues, so each reports the same
+        # depth at slightly different times.
+        depths: Dict[str, int] = {}
+        for stats in reports:
+            for queue_name, depth in stats['queues'].items():
+                depths[queue_name] = max(depths.get(queue_name, 0), depth)
+
+        backlog = sum(depths.values())
+        utilisation = sum(stats['utilisation'] for stats in reports) / len(reports)
+        workers = len(self.processes)
+
+        if backlog == 0 and utilisation < SCALE_DOWN_UTILISATION:
+            if self.idle_since is None:
+                self.idle_since = now
+        else:
+            self.idle_since = None
+
+        if now - self.scaled_at < self.scale_cooldown:
+            return
+
+        if workers < self.max_workers and (
+                backlog > self.backlog_per_worker * workers
+                or (backlog and utilisation > SCALE_UP_UTILISATION)
+        ):
+            logger.info(
+                f"Adding a worker process, {backlog} messages waiting "
+                f"at {utilisation:.0%} utilisation"
+            )
+            self.processes.append(self.start_worker())
+            self.scaled_at = now
+
+        elif (
+                workers > self.min_workers
+                and self.idle_since is not None
+                and now - self.idle_since >= self.scale_cooldown
+        ):
+            process = self.processes.pop()
+            logger.info(
+                f"Removing worker process [{process.pid}], "
+                f"queues empty at {utilisation:.0%} utilisation"
+            )
+            process.terminate()
+            self.retiring.append(process)
+            self.scaled_at = now
+            self.idle_since = None
+
+    def schedule_restart(self, process: WorkerProcess, now: float) -> None:
+        if now - process.started_at > STABLE_AFTER:
+            process.failures = 0
+
+        delay = 0.0
+        if process.failures:
+            delay = min(BACKOFF_BASE * 2 ** (process.failures - 1), BACKOFF_MAX)
+            logger.info(
+                f"Restarting worker process [{process.pid}] in {delay} seconds"
+            )
+
+        process.failures += 1
+        process.restart_at = now + delay
 
     def shutdown(self) -> None:
+        # Stop all workers before waiting, so they drain at the same time.
+        if self.replacement is not None:
+            self.processes.append(self.replacement)
+
         for process in self.processes:
-            logger.info(f"Stopping worker process [{process.pid}]")
-            process.terminate()
-            process.join()
+            if process.is_alive():
+                logger.info(f"Stopping worker process [{process.pid}]")
+                process.terminate()
+
+        for process in self.processes + self.retiring:
+            self.join(process)
+
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
         message = "Stopping parent process [{}]".format(str(self.pid))
         color_message = "Stopping parent process [{}]".format(
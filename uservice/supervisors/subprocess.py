@@ -3,9 +3,8 @@ import os
 import multiprocessing
 import threading
 import signal
-from typing import Optional
+from typing import Optional, Dict, Any
 
-spawn = multiprocessing.get_context("spawn")
 
 HANDLED_SIGNALS = (
     signal.SIGINT,  # Unix signal 2. Sent by Ctrl+C.
@@ -35,7 +34,7 @@ class Supervisor:
         raise NotImplementedError
 
 
-def get_subprocess(target):
+def get_subprocess(target, start_method: str = "spawn", **target_kwargs):
     stdin_fileno: Optional[int]
     try:
         stdin_fileno = sys.stdin.fileno()
@@ -44,15 +43,23 @@ def get_subprocess(target):
     kwargs = {
         "target": target,
         "stdin_fileno": stdin_fileno,
+        "target_kwargs": target_kwargs,
     }
-    return spawn.Process(target=subprocess_started, kwargs=kwargs)
+    context = multiprocessing.get_context(start_method)
+    return context.Process(target=subprocess_started, kwargs=kwargs)
 
 
 def subprocess_started(
         target,
         stdin_fileno: Optional[int],
+        target_kwargs: Dict[str, Any],
 ) -> None:
     if stdin_fileno is not None:
         sys.stdin = os.fdopen(stdin_fileno)
 
-    target()
+    # A forked worker inherits the signal handlers of the supervisor, the
+    # service installs its own once it is set up.
+    for sig in (*HANDLED_SIGNALS, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+
+    target(**target_kwargs)
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import multiprocessing
+import resource
+import time
+
+from multiprocessing.connection import Connection
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from .subprocess import get_subprocess
+
+
+logger = logging.getLogger('uservice')
+
+HEARTBEAT = "heartbeat"
+STATS = "stats"
+STARTED = "started"
+RECYCLE = "recycle"
+METRICS = "metrics"
+
+
+def get_rss() -> int:
+    """
+    The resident set size of the current process in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Not Linux, the peak size is the best there is, in bytes on macOS.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class WorkerReporter:
+    """
+    The worker end of the pipe to the supervisor.
+    """
+
+    def __init__(
+            self,
+            connection: Connection,
+            heartbeat_interval: float,
+            stats_interval: Optional[float] = None,
+            metrics_interval: Optional[float] = None,
+    ):
+        self.connection = connection
+        self.heartbeat_interval = heartbeat_interval
+        self.stats_interval = stats_interval
+        self.metrics_interval = metrics_interval
+
+    def send(self, kind: str, *args: Any) -> None:
+        try:
+            self.connection.send((kind, *args))
+        except (BrokenPipeError, OSError):
+            # The supervisor is gone, it will not miss the message.
+            pass
+
+    async def heartbeat(self) -> None:
+        """
+        Report that the event loop of the worker is responsive.
+        """
+        while True:
+            self.send(HEARTBEAT)
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def notify(self, kind: str, event: asyncio.Event) -> None:
+        """
+        Send ``kind`` once ``event`` is set.
+        """
+        await event.wait()
+        self.send(kind)
+
+    async def report(
+            self,
+            kind: str,
+            collect: Callable[[], Awaitable[Any]],
+            interval: float,
+    ) -> None:
+        """
+        Periodically send what ``collect`` returns, unless it is None.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                value = await collect()
+            except Exception:
+                logger.exception(f"Failed to collect {kind} for the supervisor")
+                continue
+
+            if value is not None:
+                self.send(kind, value)
+
+
+class WorkerProcess:
+    """
+    The supervisor end of a worker process and the pipe it reports on.
+    """
+
+    def __init__(
+            self,
+            target: Callable,
+            *,
+            start_method: str,
+            heartbeat_interval: float,
+            stats_interval: Optional[float] = None,
+            metrics_interval: Optional[float] = None,
+            failures: int = 0,
+    ):
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.process = get_subprocess(
+            target,
+            start_method,
+            reporter=WorkerReporter(
+                self.writer,
+                heartbeat_interval,
+                stats_interval,
+                metrics_interval,
+            ),
+        )
+        self.failures = failures
+        self.started_at: Optional[float] = None
+        self.last_heartbeat: Optional[float] = None
+        self.restart_at: Optional[float] = None
+        self.ready = False
+        self.recycling = False
+        self.stats: Optional[Dict[str, Any]] = None
+        self.metrics: Optional[Dict[str, Any]] = None
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self.process.pid
+
+    @property
+    def exitcode(self) -> Optional[int]:
+        return self.process.exitcode
+
+    def start(self) -> None:
+        self.process.start()
+        # Only the worker writes, closing our copy lets the reader see EOF.
+        self.writer.close()
+        self.started_at = self.last_heartbeat = time.monotonic()
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def poll(self) -> None:
+        try:
+            while self.reader.poll():
+                self.handle(self.reader.recv())
+        except (EOFError, OSError):
+            pass
+
+    def handle(self, message: tuple) -> None:
+        kind = message[0]
+        if kind == HEARTBEAT:
+            self.last_heartbeat = time.monotonic()
+        elif kind == STARTED:
+            self.ready = True
+        elif kind == RECYCLE:
+            self.recycling = True
+        elif kind == STATS:
+            self.stats = message[1]
+        elif kind == METRICS:
+            self.metrics = message[1]
+
+    def terminate(self) -> None:
+        self.process.terminate()
+
+    def kill(self) -> None:
+        self.process.kill()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        self.process.join(timeout)
+        if not self.process.is_alive():
+            self.reader.close()
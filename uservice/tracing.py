@@ -0,0 +1,274 @@
+"""
+Spans around handling and sending messages, linked across services by a
+W3C ``traceparent`` header on every message.
+
+Tracing is off unless the ``tracing.exporter`` setting names an exporter.
+Exporters are registered by name like codecs, ``file`` writes every span as
+a line of json.
+"""
+import json
+import logging
+import os
+import random
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+from .settings import TracingSettings
+
+
+logger = logging.getLogger('uservice')
+
+TRACEPARENT = 'traceparent'
+TRACEPARENT_VERSION = '00'
+SAMPLED = '01'
+NOT_SAMPLED = '00'
+
+
+class TracingError(Exception):
+    pass
+
+
+class Span:
+    __slots__ = (
+        'name',
+        'kind',
+        'service',
+        'trace_id',
+        'span_id',
+        'parent_id',
+        'sampled',
+        'start_time',
+        'duration',
+        'attributes',
+        'error',
+        '_started_at',
+    )
+
+    def __init__(
+            self,
+            *,
+            name: str,
+            kind: str,
+            service: str,
+            trace_id: str,
+            parent_id: Optional[str],
+            sampled: bool,
+            attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.kind = kind
+        self.service = service
+        self.trace_id = trace_id
+        self.span_id = f'{random.getrandbits(64):016x}'
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+        self.start_time = time.time()
+        self.duration: Optional[float] = None
+        self._started_at = time.perf_counter()
+
+    def end(self) -> None:
+        self.duration = time.perf_counter() - self._started_at
+
+    @property
+    def traceparent(self) -> str:
+        flags = SAMPLED if self.sampled else NOT_SAMPLED
+        return f'{TRACEPARENT_VERSION}-{self.trace_id}-{self.span_id}-{flags}'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'service': self.service,
+            'start_time': self.start_time,
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+# The span of the message being handled or sent in the current task.
+current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+def parse_traceparent(headers: Optional[Dict[str, Any]]) -> Optional[Tuple[str, str, bool]]:
+    """
+    The trace id, parent span id and sampled flag from the headers of a
+    message, None if there are none or they are malformed.
+    """
+    if not headers:
+        return None
+
+    value = headers.get(TRACEPARENT)
+    if isinstance(value, bytes):
+        value = value.decode(errors='replace')
+
+    if not isinstance(value, str):
+        return None
+
+    parts = value.split('-')
+    if (
+            len(parts) != 4
+            or len(parts[1]) != 32
+            or len(parts[2]) != 16
+            or len(parts[3]) != 2
+    ):
+        return None
+
+    try:
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class SpanExporter:
+    def __init__(self, settings: TracingSettings):
+        self.settings = settings
+
+    def export(self, span: Span) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class FileExporter(SpanExporter):
+    """
+    Appends every span as a line of json to ``tracing.file_path``. Lines are
+    written in whole chunks, so the workers of a service can share a file.
+    """
+
+    # Spans kept in memory, and seconds at most, before they are written.
+    buffer_size = 100
+    flush_interval = 1.0
+
+    def __init__(self, settings: TracingSettings):
+        super().__init__(settings)
+        self.fd = os.open(
+            settings.file_path,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644,
+        )
+        self.buffer: List[str] = []
+        self.flushed_at = time.monotonic()
+
+    def export(self, span: Span) -> None:
+        self.buffer.append(json.dumps(span.to_dict()) + '\n')
+        if (
+                len(self.buffer) >= self.buffer_size
+                or time.monotonic() - self.flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        self.flushed_at = time.monotonic()
+        if not self.buffer:
+            return
+
+        lines, self.buffer = ''.join(self.buffer), []
+        os.write(self.fd, lines.encode())
+
+    def close(self) -> None:
+        self.flush()
+        os.close(self.fd)
+
+
+EXPORTERS: Dict[str, Type[SpanExporter]] = {
+    'file': FileExporter,
+}
+
+
+def register_exporter(name: str, exporter: Type[SpanExporter]) -> None:
+    EXPORTERS[name] = exporter
+
+
+class Tracer:
+    def __init__(self, *, service: str, exporter: SpanExporter, sample_rate: float = 1.0):
+        self.service = service
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @contextmanager
+    def span(
+            self,
+            name: str,
+            kind: str,
+            *,
+            headers: Optional[Dict[str, Any]] = None,
+            attributes: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[Span]:
+        """
+        Time a span as the child of the trace in ``headers``, or of the
+        current span, or as the start of a new trace.
+        """
+        parent = parse_traceparent(headers)
+        if parent is None:
+            span = current_span.get()
+            if span is not None:
+                parent = (span.trace_id, span.span_id, span.sampled)
+
+        if parent is None:
+            trace_id = f'{random.getrandbits(128):032x}'
+            parent_id = None
+            sampled = random.random() < self.sample_rate
+        else:
+            trace_id, parent_id, sampled = parent
+
+        span = Span(
+            name=name,
+            kind=kind,
+            service=self.service,
+            trace_id=trace_id,
+            parent_id=parent_id,
+            sampled=sampled,
+            attributes=attributes,
+        )
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.end()
+            current_span.reset(token)
+            if span.sampled:
+                try:
+                    self.exporter.export(span)
+                except Exception:
+                    logger.exception(f'Failed to export span {span.name}')
+
+    def close(self) -> None:
+        self.exporter.close()
+
+
+def create_tracer(service: str, settings: TracingSettings) -> Optional[Tracer]:
+    if settings.exporter is None:
+        return None
+
+    try:
+        exporter = EXPORTERS[settings.exporter]
+    except KeyError:
+        raise TracingError(f'Unknown span exporter "{settings.exporter}"') from None
+
+    return Tracer(
+        service=service,
+        exporter=exporter(settings),
+        sample_rate=settings.sample_rate,
+    )
+
+
+def trace_headers(span: Optional[Span]) -> Optional[Dict[str, Any]]:
+    if span is None:
+        return None
+
+    return {TRACEPARENT: span.traceparent}
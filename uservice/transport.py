@@ -0,0 +1,20 @@
+from aio_pika import Connection, connect as amqp_connect
+
+from . import memory
+from .settings import Settings
+
+
+AMQP_BACKEND = 'amqp'
+MEMORY_BACKEND = 'memory'
+
+
+async def connect(settings: Settings) -> Connection:
+    """
+    Connect to the broker of ``settings.communication_backend``. The memory
+    broker has the interface of aio_pika, so entrypoints and dependencies
+    work the same on both.
+    """
+    if settings.communication_backend == MEMORY_BACKEND:
+        return await memory.connect()
+
+    return await amqp_connect(settings.amqp.get_url())
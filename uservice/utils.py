@@ -1,9 +1,13 @@
-import json
 import dataclasses
 from typing import Type, Any, Optional
 from pydantic import BaseConfig, BaseModel, ValidationError
 from pydantic.fields import ModelField, FieldInfo
 
+from .codecs import Codec, JsonCodec
+
+
+_json_codec = JsonCodec()
+
 
 def create_field(
     name: str,
@@ -36,16 +40,18 @@ def serialize_payload(
         *,
         field: Optional[ModelField] = None,
         payload_content: Any,
-):
+        codec: Optional[Codec] = None,
+) -> bytes:
+    codec = codec or _json_codec
     payload_content = _prepare_payload_content(payload_content)
     if not field:
-        return _encode(payload_content)
+        return codec.encode(payload_content)
 
     body, errors = field.validate(payload_content, {}, loc='payload')
     if errors:
         raise ValidationError(errors, field)
 
-    return _encode(body.dict())
+    return codec.encode(body.dict())
 
 
 def _prepare_payload_content(
@@ -73,7 +79,3 @@ def _prepare_payload_content(
         return dataclasses.asdict(payload)
 
     return payload
-
-
-def _encode(data: Any) -> bytes:
-    return json.dumps(data).encode()